@@ -0,0 +1,79 @@
+# Copyright (C) 2022 John DeVries
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Time finding the common lines of a large class.
+
+Every student answers the same worksheet; most of them make the same edits
+to its boilerplate, and the rest of each submission is their own.
+
+Usage (from the django directory, with the usual environment defined):
+
+    python benchmarks/common_lines.py [students] [lines per submission]
+"""
+
+import os
+import random
+import sys
+import time
+from pathlib import Path
+
+import django
+
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "fast_grader.settings.test")
+django.setup()
+
+
+from django.conf import settings
+
+from grader.common_lines import find_common_lines
+
+
+def classroom(students: int, length: int) -> list[list[str]]:
+    rng = random.Random(0)
+    template = [
+        f"{i + 1}. Explain the answer to question {i + 1}." for i in range(length)
+    ]
+    boilerplate = [f"Name: ________ (edit {i})" for i in range(10)]
+    ret = []
+    for _ in range(students):
+        lines = []
+        for question in template:
+            lines += [question, f"My answer is {rng.randrange(10 ** 6)}.", ""]
+        if rng.random() < 0.8:
+            lines = boilerplate + lines
+        ret.append(lines)
+    return ret
+
+
+def main():
+    students = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    length = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    documents = classroom(students, length)
+    times = []
+    for _ in range(5):
+        start = time.perf_counter()
+        common = find_common_lines(
+            documents, threshold=settings.GRADER_COMMON_LINE_THRESHOLD
+        )
+        times.append(time.perf_counter() - start)
+    lines = sum(map(len, documents))
+    print(f"{students} students, {lines} lines: {min(times) * 1000:.1f} ms")
+    print(f"{len(common)} common lines")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+# Copyright (C) 2022 John DeVries
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Compare the diff engines in `grader.diff` on a corpus of pathological
+documents.
+
+Each case is a (teacher template, student submission) pair shaped like the
+documents that made `difflib` slow: long runs of blank lines, the same
+answer pasted over and over, shuffled paragraphs, and submissions that
+share nothing with the template. Timings are the best of a few runs, and
+every diff is checked for consistency with its inputs.
+
+Usage (from the django directory, with the usual environment defined):
+
+    python benchmarks/diff_engines.py [scale]
+"""
+
+import os
+import random
+import sys
+import time
+from pathlib import Path
+
+import django
+
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "fast_grader.settings.test")
+django.setup()
+
+
+from django.conf import settings
+
+from grader.diff import DifflibEngine, get_engine, unified_diff
+
+
+def document(sections: dict[str, list[str]]) -> list[str]:
+    ret = []
+    for name, lines in sections.items():
+        ret += [name, "=" * len(name), *lines]
+    return ret
+
+
+def questions(n: int, blank_lines: int = 1) -> list[str]:
+    ret = []
+    for i in range(n):
+        ret += [f"{i + 1}. Explain the answer to question {i + 1}."]
+        ret += [""] * blank_lines
+    return ret
+
+
+def corpus(scale: int) -> dict[str, tuple[list[str], list[str]]]:
+    rng = random.Random(0)
+    template = questions(40 * scale, blank_lines=3)
+
+    answered = []
+    for line in template:
+        answered.append(line)
+        if line:
+            answered.append(f"My answer is {rng.randrange(10 ** 6)}.")
+
+    pasted = [l if l else "I don't know" for l in template]
+
+    shuffled_paragraphs = [template[i : i + 4] for i in range(0, len(template), 4)]
+    rng.shuffle(shuffled_paragraphs)
+
+    shuffled_lines = list(answered)
+    rng.shuffle(shuffled_lines)
+
+    return {
+        "answered worksheet": (
+            document({"worksheet": template}),
+            document({"worksheet": answered}),
+        ),
+        "blank lines everywhere": (
+            document({"worksheet": questions(10 * scale, blank_lines=40)}),
+            document({"worksheet": questions(10 * scale, blank_lines=37)}),
+        ),
+        "same answer pasted": (
+            document({"worksheet": template}),
+            document({"worksheet": pasted}),
+        ),
+        "shuffled paragraphs": (
+            document({"worksheet": template}),
+            document({"worksheet": sum(shuffled_paragraphs, [])}),
+        ),
+        "shuffled lines": (
+            document({"worksheet": answered}),
+            document({"worksheet": shuffled_lines}),
+        ),
+        "nothing in common": (
+            document({"worksheet": template}),
+            document(
+                {
+                    "worksheet": [
+                        f"line {rng.randrange(50)}" for _ in range(len(template))
+                    ]
+                }
+            ),
+        ),
+        "several attachments": (
+            document({f"doc {i}": template[:200] for i in range(5 * scale)}),
+            document(
+                {
+                    f"doc {i}": (answered if i % 2 else template)[:200]
+                    for i in range(5 * scale)
+                }
+            ),
+        ),
+    }
+
+
+def check(diff: list[str], a: list[str], b: list[str]):
+    """Every removed and added line must come from the right side."""
+    body = [l for l in diff[2:] if not l.startswith("@@")]
+    assert all(l[1:] in a for l in body if l[0] in " -"), "bad context"
+    assert all(l[1:] in b for l in body if l[0] == "+"), "bad insertion"
+
+
+def best_of(n, fn):
+    times = []
+    for _ in range(n):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def main():
+    scale = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    engines = {
+        "difflib": DifflibEngine(),
+        settings.GRADER_DIFF_ENGINE["BACKEND"].rsplit(".", 1)[-1]: get_engine(),
+    }
+    print(f"{'case':>24} {'lines':>7}", *(f"{name:>16}" for name in engines))
+    for name, (a, b) in corpus(scale).items():
+        row = []
+        for engine in engines.values():
+            elapsed, diff = best_of(3, lambda: unified_diff(a, b, engine=engine))
+            check(diff, a, b)
+            row.append(f"{elapsed * 1000:9.1f} ms {len(diff):>5}")
+        print(f"{name:>24} {len(a) + len(b):>7}", *row)
+
+
+if __name__ == "__main__":
+    main()
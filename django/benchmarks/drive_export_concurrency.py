@@ -0,0 +1,113 @@
+# Copyright (C) 2022 John DeVries
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Compare sequential and concurrent Drive exports in
+`grader.services.concatenate_attachments`.
+
+A fake Drive endpoint on localhost answers every export after a fixed delay,
+standing in for the real (slow) export call. The real Drive service object is
+pointed at it, so the whole client stack, including the per-thread
+transports, is exercised.
+
+Usage (from the django directory, with the usual environment defined):
+
+    python benchmarks/drive_export_concurrency.py [n_attachments] [latency_ms]
+"""
+
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from unittest.mock import patch
+
+import django
+
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "fast_grader.settings.test")
+django.setup()
+
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from google.auth.credentials import AnonymousCredentials
+from googleapiclient.discovery import build_from_document
+
+from grader.google_api import get_discovery_document
+from grader.services import DriveAttachment, concatenate_attachments
+
+
+def serve_fake_drive(latency: float) -> ThreadingHTTPServer:
+    class FakeDrive(BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(latency)
+            body = bytes(f"exported {self.path}\nsecond line\n", "utf8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *_):
+            ...
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeDrive)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    n_attachments = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    latency = (int(sys.argv[2]) if len(sys.argv) > 2 else 200) / 1000
+
+    server = serve_fake_drive(latency)
+    service = build_from_document(
+        get_discovery_document("drive", "v3"),
+        credentials=AnonymousCredentials(),
+        client_options={"api_endpoint": f"http://127.0.0.1:{server.server_port}/"},
+    )
+    attachments = [
+        DriveAttachment(id_=f"file{i}", name=f"attachment {i}")
+        for i in range(n_attachments)
+    ]
+
+    print(
+        f"{n_attachments} attachments, {latency * 1000:.0f} ms per export, "
+        f"GOOGLE_DRIVE_EXPORT_CONCURRENCY={settings.GOOGLE_DRIVE_EXPORT_CONCURRENCY}"
+    )
+    # batch requests do not honour api_endpoint, and caching would hide the
+    # exports we want to measure, so every file is treated as uncached
+    with patch("grader.services._get_google_api_service", return_value=service), patch(
+        "grader.services._get_file_versions", return_value={}
+    ):
+        results = {}
+        for label, max_workers in (("sequential", 1), ("concurrent", None)):
+            start = time.perf_counter()
+            results[label] = concatenate_attachments(
+                user=User(username="benchmark"),
+                attachments=attachments,
+                max_workers=max_workers,
+            )
+            elapsed = time.perf_counter() - start
+            print(f"{label:>10}: {elapsed * 1000:8.1f} ms")
+
+    assert results["sequential"] == results["concurrent"], "output differs"
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+# Copyright (C) 2022 John DeVries
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Compare calling `googleapiclient.discovery.build` for every operation
+against the cached service factory in `grader.google_api`.
+
+Opening one submission used to build the classroom and drive clients about
+five times, so each "request" below builds that many clients. No network
+access is needed; both approaches use the bundled discovery documents.
+
+Usage (from the django directory, with the usual environment defined):
+
+    python benchmarks/google_service_factory.py [n_requests]
+"""
+
+import os
+import resource
+import sys
+import time
+from pathlib import Path
+
+import django
+
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "fast_grader.settings.test")
+django.setup()
+
+
+from google.oauth2.credentials import Credentials
+from googleapiclient.discovery import build
+
+from grader.google_api import build_service
+
+
+# the api clients needed to open a single submission
+BUILDS_PER_REQUEST = (
+    ("classroom", "v1"),
+    ("classroom", "v1"),
+    ("classroom", "v1"),
+    ("drive", "v3"),
+    ("drive", "v3"),
+)
+
+
+def max_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run(label, make_service, n_requests):
+    credentials = Credentials(token="token", refresh_token="refresh")
+    rss_before = max_rss_mb()
+    start = time.perf_counter()
+    for _ in range(n_requests):
+        for service, version in BUILDS_PER_REQUEST:
+            make_service(service, version, credentials)
+    elapsed = time.perf_counter() - start
+    print(
+        f"{label:>10}: {elapsed / n_requests * 1000:8.2f} ms/request, "
+        f"peak rss {max_rss_mb():7.1f} MB (+{max_rss_mb() - rss_before:.1f})"
+    )
+
+
+def main():
+    n_requests = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+
+    # run the cached factory first, so that it cannot benefit from memory
+    # already touched by the uncached run
+    run(
+        "cached",
+        lambda s, v, c: build_service(service=s, version=v, credentials=c),
+        n_requests,
+    )
+    run(
+        "build()",
+        lambda s, v, c: build(s, v, credentials=c, static_discovery=True),
+        n_requests,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+# Copyright (C) 2022 John DeVries
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Serve the deep session API and the session detail page of a large class,
+with and without `GradingSessionQuerySet.prefetch_active_submissions`.
+
+Every submission has a stored diff and similarity signature, like a class
+that has been graded, which the contentless views never show. The benchmark
+runs against a throwaway test database.
+
+Usage (from the django directory, with the usual environment defined):
+
+    python benchmarks/session_prefetch.py [students] [lines per submission]
+"""
+
+import os
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+import django
+
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "fast_grader.settings.test")
+django.setup()
+
+
+from django.contrib.auth.models import User
+from django.db import connection, reset_queries
+from django.template.loader import render_to_string
+from django.test.utils import CaptureQueriesContext, setup_test_environment
+
+from grader.models import (
+    AssignmentSubmission,
+    CourseModel,
+    GradingSession,
+    TeacherTemplate,
+)
+from grader.serializers import (
+    ContentlessAssignmentSubmissionSerializer,
+    DeepGradingSessionSerializer,
+)
+from grader.views import SESSION_DETAIL_FIELDS
+
+
+def create_class(students: int, length: int) -> GradingSession:
+    user = User.objects.create_user(username="benchmark")
+    course = CourseModel.objects.create(owner=user, name="c", api_course_id="c")
+    template = TeacherTemplate.objects.create(
+        content="\n".join(f"question {i}" for i in range(length))
+    )
+    session = GradingSession.objects.create(
+        course=course, api_assignment_id="a", max_grade=10, template=template
+    )
+    submissions = []
+    for i in range(students):
+        answers = [f"question {j}\nstudent {i} answers {j}" for j in range(length)]
+        submissions.append(
+            AssignmentSubmission(
+                assignment=session,
+                teacher_template=template,
+                api_student_profile_id=str(i),
+                api_student_submission_id=f"s{i}",
+                student_name=f"student {i}",
+                _profile_photo_url="https://example.com/photo",
+                submission="\n".join(answers),
+                stored_diff=[f"+student {i} answers {j}" for j in range(length)],
+                minhash_signature=list(range(128)),
+                grade=i % 11,
+            )
+        )
+    AssignmentSubmission.objects.bulk_create(submissions)
+    return session
+
+
+def measure(label: str, render):
+    times = []
+    for _ in range(5):
+        start = time.perf_counter()
+        render()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    with CaptureQueriesContext(connection) as queries:
+        render()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(
+        f"{label:>28}: {min(times) * 1000:7.1f} ms, "
+        f"{peak / 2 ** 20:6.1f} MiB peak, {len(queries)} queries"
+    )
+
+
+def main():
+    students = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    length = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        session = create_class(students, length)
+        reset_queries()
+        print(f"{students} students, {length} answers each")
+
+        bare = GradingSession.objects.filter(pk=session.pk)
+        deep = bare.prefetch_active_submissions(
+            *ContentlessAssignmentSubmissionSerializer.model_fields
+        )
+        detail = bare.prefetch_active_submissions(*SESSION_DETAIL_FIELDS)
+
+        for label, qs in (("deep_session before", bare), ("deep_session after", deep)):
+            measure(label, lambda: DeepGradingSessionSerializer(qs.get()).data)
+        for label, qs in (
+            ("session_detail before", bare),
+            ("session_detail after", detail),
+        ):
+            measure(
+                label,
+                lambda: render_to_string(
+                    "grader/partials/session_detail.html", {"session": qs.get()}
+                ),
+            )
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+if __name__ == "__main__":
+    main()
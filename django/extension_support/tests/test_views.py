@@ -110,7 +110,9 @@ class TestViews(TestCase):
                 "assignment_name": "foo assignment",
                 "average_grade": 13,
             }
-            mock.objects.get.return_value = mock_session
+            mock.objects.prefetch_active_submissions.return_value.get.return_value = (
+                mock_session
+            )
             res = self.client.get(reverse("ext_session_detail", kwargs={"pk": 1}))
             # the full session object is passed into the template context
             self.assertEqual(res.data["session"], mock_session)  # type: ignore
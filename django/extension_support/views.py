@@ -19,6 +19,7 @@ from rest_framework.permissions import IsAuthenticated
 from rest_framework import status
 
 from grader.models import GradingSession
+from grader.views import SESSION_DETAIL_FIELDS
 from .serializers import FrontendLogRecordSerializer
 
 
@@ -44,7 +45,9 @@ def sessions_list(request):
 @permission_classes([IsAuthenticated])
 def session_detail(_, pk):
     try:
-        session = GradingSession.objects.get(pk=pk)  # type: ignore
+        session = GradingSession.objects.prefetch_active_submissions(  # type: ignore
+            *SESSION_DETAIL_FIELDS
+        ).get(pk=pk)
     except GradingSession.DoesNotExist:  # type: ignore
         return Response(status=status.HTTP_404_NOT_FOUND)
 
@@ -26,6 +26,7 @@ https://docs.djangoproject.com/en/3.2/ref/settings/
 """
 
 import os
+from datetime import timedelta
 from pathlib import Path
 
 
@@ -320,3 +321,63 @@ LOGGING = {
         },
     },
 }
+
+
+# Built Google API service objects are cached per process and per credential.
+# This bounds the number of service objects held in memory by each worker.
+GOOGLE_API_SERVICE_CACHE_SIZE = 64
+
+# Live Google credentials are cached per process and per user, so that a
+# refreshed access token is reused until it expires.
+GOOGLE_CREDENTIALS_CACHE_SIZE = 256
+
+# The most Google Drive exports that may run at once while downloading the
+# attachments of a single assignment or submission.
+GOOGLE_DRIVE_EXPORT_CONCURRENCY = 4
+
+# Course rosters fetched from Google Classroom are reused for this long.
+GOOGLE_ROSTER_TTL = timedelta(hours=12)
+
+# Total size of cached Google Drive exports, after which the least recently
+# used ones are evicted.
+DRIVE_EXPORT_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# Token bucket rate limits for Google API calls, in calls per second, and the
+# largest burst allowed. Google's own quotas are per project and per user; the
+# per user limit is the documented default of 1,200 Classroom API queries per
+# minute per user, which is the tightest of the APIs we call. Only background
+# jobs wait for these; calls that a teacher is waiting on are counted, but
+# never throttled.
+GOOGLE_API_RATE_LIMITS = {
+    "project": {"rate": 40, "capacity": 80},
+    "user": {"rate": 1200 / 60, "capacity": 40},
+}
+
+# Background jobs leave this fraction of each rate limit's burst capacity
+# unused, for requests that a teacher is waiting on.
+GOOGLE_API_BACKGROUND_RESERVE = 0.25
+
+# Computes the diffs between teacher templates and student submissions; see
+# `grader.diff`. `grader.diff.DifflibEngine` matches difflib exactly, but can
+# be very slow. The patience engine falls back to a coarse diff of whole
+# attachments when a diff runs over `timeout` seconds, spans more than
+# `max_lines`, or needs more than `max_edits` edits in one region.
+GRADER_DIFF_ENGINE = {
+    "BACKEND": "grader.diff.PatienceEngine",
+    "OPTIONS": {"timeout": 0.5, "max_lines": 50_000, "max_edits": 2_000},
+}
+
+# Teacher templates are split and hashed once for diffing, and reused for
+# every submission in the session. This many are kept per process.
+GRADER_TEMPLATE_CACHE_SIZE = 32
+
+# Added lines which at least this fraction of the students in a session have
+# in common are flagged in diffs, so that boilerplate edits can be skimmed.
+GRADER_COMMON_LINE_THRESHOLD = 0.5
+
+# Near-duplicate submissions are found using MinHash signatures with this
+# many `PERMUTATIONS`, split into `BANDS` bands for the per-course LSH index.
+# Candidates from the index are clustered if their estimated similarity is
+# at least `THRESHOLD`. With 128 permutations in 16 bands, pairs around 70%
+# similar are likely to become candidates.
+GRADER_SIMILARITY = {"PERMUTATIONS": 128, "BANDS": 16, "THRESHOLD": 0.8}
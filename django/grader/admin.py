@@ -15,8 +15,18 @@
 
 from django.contrib import admin
 
-from .models import GradingSession, AssignmentSubmission, CourseModel
+from .models import (
+    AssignmentSubmission,
+    BackgroundJob,
+    CourseModel,
+    CourseStudent,
+    DriveExport,
+    GradingSession,
+)
 
+admin.site.register(BackgroundJob)
 admin.site.register(CourseModel)
+admin.site.register(CourseStudent)
+admin.site.register(DriveExport)
 admin.site.register(GradingSession)
 admin.site.register(AssignmentSubmission)
@@ -0,0 +1,82 @@
+# Copyright (C) 2022 John DeVries
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Lines that most of the class has in common.
+
+When an assignment comes with boilerplate, every student tends to make the
+same edits to it, and the teacher ends up reading the same added lines in
+every diff. Here, every line of every submission in a session is numbered,
+so that each submission becomes an integer array, and NumPy counts how many
+students have each line. Stable hashes of the lines shared by most of the
+class are stored on the session, so that the diff endpoint can flag them."""
+
+import hashlib
+import math
+from typing import Iterable, Sequence
+
+import numpy as np
+
+
+def line_hash(line: str) -> int:
+    """Stable 64 bit hash of a line. Unlike `hash`, this is the same in every
+    process, so it can be stored."""
+    return int.from_bytes(
+        hashlib.blake2b(line.encode("utf8"), digest_size=8).digest(),
+        "little",
+        signed=True,
+    )
+
+
+def count_lines(documents: Iterable[Sequence[str]]) -> tuple[list[str], np.ndarray]:
+    """Count how many of `documents` contain each distinct line, ignoring
+    blank lines. Returns the distinct lines, and the number of documents
+    which contain each of them."""
+    # lines are numbered in order of appearance, so that each document
+    # becomes an array of integers
+    ids: dict[str, int] = {}
+    chunks = [np.empty(0, dtype=np.int64)]
+    for lines in documents:
+        distinct = {line for line in lines if line.strip()}
+        chunks.append(
+            np.fromiter(
+                (ids.setdefault(line, len(ids)) for line in distinct),
+                dtype=np.int64,
+                count=len(distinct),
+            )
+        )
+    return list(ids), np.bincount(np.concatenate(chunks), minlength=len(ids))
+
+
+def find_common_lines(
+    documents: Sequence[Sequence[str]], *, threshold: float
+) -> list[int]:
+    """Hashes of the lines found in at least `threshold` (a fraction) of
+    `documents`, and in at least two of them."""
+    lines, counts = count_lines(documents)
+    minimum = max(2, math.ceil(threshold * len(documents)))
+    return [line_hash(lines[i]) for i in np.flatnonzero(counts >= minimum)]
+
+
+def flag_common_lines(diff: Sequence[str], common: Iterable[int]) -> list[int]:
+    """Indices of the lines in a unified diff which add a common line."""
+    common = set(common)
+    if not common:
+        return []
+    # the first two lines are the `---` and `+++` file headers
+    return [
+        i
+        for i, line in enumerate(diff[2:], start=2)
+        if line.startswith("+") and line_hash(line[1:]) in common
+    ]
@@ -0,0 +1,663 @@
+# Copyright (C) 2022 John DeVries
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Line diffs between teacher templates and student submissions.
+
+A diff engine turns two lists of lines into opcodes, in the same format as
+`difflib.SequenceMatcher.get_opcodes`, and `unified_diff` renders opcodes
+exactly like `difflib.unified_diff` does. The engine is chosen by
+`settings.GRADER_DIFF_ENGINE`.
+
+`difflib.SequenceMatcher` is quadratic on many inputs, and student documents
+full of blank or repeated lines can take seconds to diff. The default
+`PatienceEngine` anchors the diff on lines that appear exactly once on each
+side, and runs Myers' algorithm on the small gaps in between. It also has a
+hard budget; when that runs out, it falls back to a coarse diff of whole
+sections (see `section_starts`), so a single pathological document cannot
+hold up a request.
+
+Every submission in a session is diffed against the same teacher template,
+so the template's side of the work is done once, by `prepare`, and shared
+through `get_prepared_template`.
+
+Documents are made of sections, one per attachment. Submissions are diffed
+one section at a time (see `section_opcodes`), and the opcodes of each pair
+of sections can be cached by their content hashes, so that when a single
+attachment changes only its section is diffed again."""
+
+import threading
+import time
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from collections import Counter
+from dataclasses import dataclass, field
+from difflib import SequenceMatcher
+from typing import Callable, Iterator, Sequence, Union
+
+from cachetools import LRUCache
+from django.conf import settings
+from django.core import checks
+from django.utils.module_loading import import_string
+
+from .utils import content_hash
+
+
+# (tag, i1, i2, j1, j2), see `difflib.SequenceMatcher.get_opcodes`
+Opcode = tuple[str, int, int, int, int]
+
+
+class DiffBudgetExceeded(Exception):
+    ...
+
+
+@dataclass
+class Section:
+    """Lines `start:end` of a document. `name` is the header of the
+    attachment, or empty for any lines before the first header."""
+
+    name: str
+    start: int
+    end: int
+    hash: str
+
+    def to_json(self) -> list:
+        return [self.name, self.start, self.end, self.hash]
+
+    @classmethod
+    def from_json(cls, data: list) -> "Section":
+        return cls(*data)
+
+
+def split_sections(lines: Sequence[str]) -> list[Section]:
+    starts = section_starts(lines)
+    headers = set(starts)
+    bounds = [0, *starts, len(lines)]
+    return [
+        Section(
+            name=lines[start].strip() if start in headers else "",
+            start=start,
+            end=end,
+            hash=content_hash("\n".join(lines[start:end])),
+        )
+        for start, end in zip(bounds, bounds[1:])
+        if start < end
+    ]
+
+
+@dataclass
+class PreparedTemplate:
+    """The teacher template's side of a diff, which can be reused for every
+    submission diffed against it."""
+
+    lines: list[str]
+
+    # each distinct line is interned as a small integer, so that comparisons
+    # are cheap no matter how long the lines are
+    line_ids: dict[str, int]
+    hashed: list[int]
+
+    # one section per attachment, and the header names; see
+    # `services.parse_order`
+    sections: list[Section]
+    headers: list[str]
+
+    # each section, prepared on its own as it is needed
+    _prepared_sections: dict = field(default_factory=dict, repr=False)
+
+    def prepare_section(self, section: Section) -> "PreparedTemplate":
+        if (section.start, section.end) == (0, len(self.lines)):
+            return self
+        key = (section.start, section.end)
+        if (prepared := self._prepared_sections.get(key)) is None:
+            prepared = self._prepared_sections.setdefault(
+                key, prepare(self.lines[section.start : section.end])
+            )
+        return prepared
+
+
+def prepare(lines: Sequence[str]) -> PreparedTemplate:
+    line_ids: dict[str, int] = {}
+    hashed = [line_ids.setdefault(line, len(line_ids)) for line in lines]
+    sections = split_sections(lines)
+    return PreparedTemplate(
+        lines=list(lines),
+        line_ids=line_ids,
+        hashed=hashed,
+        sections=sections,
+        headers=[lines[i].strip() for i in section_starts(lines)],
+    )
+
+
+_prepared_cache = LRUCache(maxsize=settings.GRADER_TEMPLATE_CACHE_SIZE)
+_prepared_cache_lock = threading.Lock()
+
+
+def get_prepared_template(template) -> PreparedTemplate:
+    """`prepare` a `TeacherTemplate`, caching the result by the template's id
+    and content hash."""
+    key = (template.pk, template.get_content_hash())
+    with _prepared_cache_lock:
+        if (prepared := _prepared_cache.get(key)) is not None:
+            return prepared
+    prepared = prepare(template.content.split("\n"))
+    with _prepared_cache_lock:
+        _prepared_cache[key] = prepared
+    return prepared
+
+
+def clear_prepared_template_cache():
+    with _prepared_cache_lock:
+        _prepared_cache.clear()
+
+
+class DiffEngine(ABC):
+    """Interface for diff engines."""
+
+    @abstractmethod
+    def get_opcodes(
+        self,
+        a: Sequence[str],
+        b: Sequence[str],
+        *,
+        prepared: Union[PreparedTemplate, None] = None,
+    ) -> list[Opcode]:
+        """Return opcodes describing how to turn `a` into `b`. If `prepared`
+        is passed, it must be `prepare(a)`."""
+
+
+class DifflibEngine(DiffEngine):
+    """The standard library's matcher; what `difflib.unified_diff` uses."""
+
+    def get_opcodes(self, a, b, *, prepared=None):
+        return SequenceMatcher(None, a, b).get_opcodes()
+
+
+class PatienceEngine(DiffEngine):
+    """Patience diff over hashed lines, with Myers' algorithm for the regions
+    between unique lines.
+
+    If the inputs have more than `max_lines` lines between them, or the diff
+    takes more than `timeout` seconds or needs more than `max_edits` edits in
+    a single region, a coarse diff of whole sections is returned instead."""
+
+    def __init__(
+        self, *, timeout: float = 0.5, max_lines: int = 50_000, max_edits: int = 2_000
+    ):
+        self.timeout = timeout
+        self.max_lines = max_lines
+        self.max_edits = max_edits
+
+    def get_opcodes(self, a, b, *, prepared=None):
+        if len(a) + len(b) > self.max_lines:
+            return coarse_opcodes(a, b)
+
+        prepared = prepared or prepare(a)
+        ids, ha = prepared.line_ids, prepared.hashed
+        # lines which are not in the template get ids of their own, without
+        # modifying the shared table
+        extra: dict[str, int] = {}
+        hb = [
+            ids[line] if line in ids else extra.setdefault(line, len(ids) + len(extra))
+            for line in b
+        ]
+        try:
+            matches = _patience_matches(
+                ha,
+                hb,
+                deadline=time.monotonic() + self.timeout,
+                max_edits=self.max_edits,
+            )
+        except DiffBudgetExceeded:
+            return coarse_opcodes(a, b)
+        return _opcodes_from_matches(matches, len(a), len(b))
+
+
+def get_engine() -> DiffEngine:
+    """The engine configured by `settings.GRADER_DIFF_ENGINE`."""
+    config = settings.GRADER_DIFF_ENGINE
+    return import_string(config["BACKEND"])(**config.get("OPTIONS", {}))
+
+
+@checks.register
+def check_diff_engine(**_) -> list[checks.CheckMessage]:
+    """Fail at startup, rather than on the first diff, if the configured
+    engine cannot be built."""
+    try:
+        get_engine()
+    except Exception as e:
+        return [
+            checks.Error(
+                f"GRADER_DIFF_ENGINE is misconfigured: {e!r}",
+                id="grader.E001",
+            )
+        ]
+    return []
+
+
+def section_starts(lines: Sequence[str]) -> list[int]:
+    """Index of the first line of each section, which is the header of an
+    attachment (see `services.ConcatOutput`). Like `services.parse_order`,
+    any line containing "===" underlines the header above it."""
+    return [i - 1 for i in range(1, len(lines)) if "===" in lines[i]]
+
+
+def coarse_opcodes(a: Sequence[str], b: Sequence[str]) -> list[Opcode]:
+    """A cheap diff, where each section is either equal or replaced
+    entirely. Unchanged lines at the start and end are always matched."""
+    lo = 0
+    while lo < min(len(a), len(b)) and a[lo] == b[lo]:
+        lo += 1
+    ahi, bhi = len(a), len(b)
+    while ahi > lo and bhi > lo and a[ahi - 1] == b[bhi - 1]:
+        ahi -= 1
+        bhi -= 1
+
+    def sections(lines, hi):
+        bounds = [lo, *[i for i in section_starts(lines) if lo < i < hi], hi]
+        return [(s, e) for s, e in zip(bounds, bounds[1:]) if s < e]
+
+    a_sections, b_sections = sections(a, ahi), sections(b, bhi)
+    ids: dict[tuple, int] = {}
+    ha = [ids.setdefault(tuple(a[s:e]), len(ids)) for s, e in a_sections]
+    hb = [ids.setdefault(tuple(b[s:e]), len(ids)) for s, e in b_sections]
+
+    matches = [(i, i) for i in range(lo)]
+    # sections are few, so this is cheap; equal sections become equal runs
+    for i, j in _patience_matches(ha, hb, deadline=None, max_edits=None):
+        (a_start, a_end), (b_start, _) = a_sections[i], b_sections[j]
+        matches += [(a_start + k, b_start + k) for k in range(a_end - a_start)]
+    matches += [(ahi + k, bhi + k) for k in range(len(a) - ahi)]
+    return _opcodes_from_matches(matches, len(a), len(b))
+
+
+def _patience_matches(
+    a: list[int], b: list[int], *, deadline, max_edits
+) -> list[tuple[int, int]]:
+    """Return pairs of indices of matching lines, in increasing order."""
+    matches = []
+    regions = [(0, len(a), 0, len(b))]
+    while regions:
+        if deadline is not None and time.monotonic() > deadline:
+            raise DiffBudgetExceeded
+        alo, ahi, blo, bhi = regions.pop()
+
+        # common prefix and suffix
+        while alo < ahi and blo < bhi and a[alo] == b[blo]:
+            matches.append((alo, blo))
+            alo += 1
+            blo += 1
+        while alo < ahi and blo < bhi and a[ahi - 1] == b[bhi - 1]:
+            ahi -= 1
+            bhi -= 1
+            matches.append((ahi, bhi))
+        if alo == ahi or blo == bhi:
+            continue
+
+        anchors = _unique_anchors(a, alo, ahi, b, blo, bhi)
+        if not anchors and not set(a[alo:ahi]).intersection(b[blo:bhi]):
+            continue
+        if not anchors:
+            matches += _myers_matches(
+                a, alo, ahi, b, blo, bhi, deadline=deadline, max_edits=max_edits
+            )
+            continue
+
+        matches += anchors
+        for (i, j), (next_i, next_j) in zip(
+            [(alo - 1, blo - 1), *anchors], [*anchors, (ahi, bhi)]
+        ):
+            if i + 1 < next_i or j + 1 < next_j:
+                regions.append((i + 1, next_i, j + 1, next_j))
+
+    matches.sort()
+    return matches
+
+
+def _unique_anchors(a, alo, ahi, b, blo, bhi) -> list[tuple[int, int]]:
+    """The longest increasing run of lines that occur exactly once in each
+    region, as index pairs."""
+    a_counts = Counter(a[alo:ahi])
+    b_counts = Counter(b[blo:bhi])
+    b_index = {
+        line: j
+        for j, line in enumerate(b[blo:bhi], blo)
+        if b_counts[line] == 1 and a_counts[line] == 1
+    }
+    candidates = [
+        (i, b_index[line]) for i, line in enumerate(a[alo:ahi], alo) if line in b_index
+    ]
+    if not candidates:
+        return []
+
+    # patience sorting: longest increasing subsequence of the `b` indices
+    tails: list[int] = []
+    tail_idx: list[int] = []
+    previous = [-1] * len(candidates)
+    for n, (_, j) in enumerate(candidates):
+        pos = bisect_left(tails, j)
+        if pos == len(tails):
+            tails.append(j)
+            tail_idx.append(n)
+        else:
+            tails[pos] = j
+            tail_idx[pos] = n
+        previous[n] = tail_idx[pos - 1] if pos else -1
+
+    ret = []
+    n = tail_idx[-1]
+    while n != -1:
+        ret.append(candidates[n])
+        n = previous[n]
+    return ret[::-1]
+
+
+def _myers_matches(
+    a, alo, ahi, b, blo, bhi, *, deadline, max_edits
+) -> list[tuple[int, int]]:
+    """Myers' O(ND) shortest edit script, returning the matched lines."""
+    n, m = ahi - alo, bhi - blo
+    v = {1: 0}
+    trace = []
+    for d in range(n + m + 1):
+        if (max_edits is not None and d > max_edits) or (
+            deadline is not None and time.monotonic() > deadline
+        ):
+            raise DiffBudgetExceeded
+        trace.append(v.copy())
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[k - 1] < v[k + 1]):
+                x = v[k + 1]
+            else:
+                x = v[k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[alo + x] == b[blo + y]:
+                x += 1
+                y += 1
+            v[k] = x
+            if x >= n and y >= m:
+                return _myers_backtrack(trace, n, m, alo, blo)
+    raise AssertionError("unreachable")
+
+
+def _myers_backtrack(trace, x, y, alo, blo) -> list[tuple[int, int]]:
+    matches = []
+    for d in range(len(trace) - 1, -1, -1):
+        v = trace[d]
+        k = x - y
+        if k == -d or (k != d and v[k - 1] < v[k + 1]):
+            prev_k = k + 1
+        else:
+            prev_k = k - 1
+        prev_x = v[prev_k]
+        prev_y = prev_x - prev_k
+        while x > prev_x and y > prev_y:
+            x -= 1
+            y -= 1
+            matches.append((alo + x, blo + y))
+        x, y = prev_x, prev_y
+    return matches
+
+
+def _opcodes_from_matches(
+    matches: list[tuple[int, int]], len_a: int, len_b: int
+) -> list[Opcode]:
+    opcodes: list[Opcode] = []
+
+    def add(tag, i1, i2, j1, j2):
+        if opcodes and opcodes[-1][0] == tag == "equal":
+            opcodes[-1] = (tag, opcodes[-1][1], i2, opcodes[-1][3], j2)
+        else:
+            opcodes.append((tag, i1, i2, j1, j2))
+
+    i = j = 0
+    for mi, mj in [*matches, (len_a, len_b)]:
+        if i < mi and j < mj:
+            add("replace", i, mi, j, mj)
+        elif i < mi:
+            add("delete", i, mi, j, j)
+        elif j < mj:
+            add("insert", i, i, j, mj)
+        if (mi, mj) != (len_a, len_b):
+            add("equal", mi, mi + 1, mj, mj + 1)
+        i, j = mi + 1, mj + 1
+    return opcodes
+
+
+def _grouped_opcodes(codes: list[Opcode], n: int) -> Iterator[list[Opcode]]:
+    """`difflib.SequenceMatcher.get_grouped_opcodes`, for any opcodes."""
+    codes = list(codes) or [("equal", 0, 1, 0, 1)]
+    if codes[0][0] == "equal":
+        tag, i1, i2, j1, j2 = codes[0]
+        codes[0] = tag, max(i1, i2 - n), i2, max(j1, j2 - n), j2
+    if codes[-1][0] == "equal":
+        tag, i1, i2, j1, j2 = codes[-1]
+        codes[-1] = tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)
+
+    group = []
+    for tag, i1, i2, j1, j2 in codes:
+        if tag == "equal" and i2 - i1 > n * 2:
+            group.append((tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)))
+            yield group
+            group = []
+            i1, j1 = max(i1, i2 - n), max(j1, j2 - n)
+        group.append((tag, i1, i2, j1, j2))
+    if group and not (len(group) == 1 and group[0][0] == "equal"):
+        yield group
+
+
+def _format_range(start: int, stop: int) -> str:
+    """`difflib._format_range_unified`"""
+    beginning = start + 1
+    length = stop - start
+    if length == 1:
+        return f"{beginning}"
+    if not length:
+        beginning -= 1
+    return f"{beginning},{length}"
+
+
+def align_sections(
+    a: list[Section], b: list[Section]
+) -> list[tuple[Union[Section, None], Union[Section, None]]]:
+    """Pair up the sections of two documents by name, in order. Sections
+    with no counterpart are paired with None."""
+    ids: dict[str, int] = {}
+    ha = [ids.setdefault(s.name, len(ids)) for s in a]
+    hb = [ids.setdefault(s.name, len(ids)) for s in b]
+    pairs = []
+    i = j = 0
+    for mi, mj in [
+        *_patience_matches(ha, hb, deadline=None, max_edits=None),
+        (len(a), len(b)),
+    ]:
+        pairs += [(s, None) for s in a[i:mi]]
+        pairs += [(None, s) for s in b[j:mj]]
+        if mi < len(a):
+            pairs.append((a[mi], b[mj]))
+        i, j = mi + 1, mj + 1
+    return pairs
+
+
+def section_pair_key(a: Section, b: Section) -> str:
+    return f"{a.hash}:{b.hash}"
+
+
+def _pair_opcodes(
+    a_section: Union[Section, None],
+    b_section: Union[Section, None],
+    get_cached: Callable[[Section, Section], list[Opcode]],
+) -> list[Opcode]:
+    """Opcodes for one pair from `align_sections`, relative to the start of
+    each section."""
+    if a_section is None:
+        return [("insert", 0, 0, 0, b_section.end - b_section.start)]  # type: ignore
+    if b_section is None:
+        return [("delete", 0, a_section.end - a_section.start, 0, 0)]
+    return get_cached(a_section, b_section)
+
+
+def section_opcodes(
+    prepared: PreparedTemplate,
+    b: Sequence[str],
+    b_sections: list[Section],
+    *,
+    engine: Union[DiffEngine, None] = None,
+    cache: Union[dict[str, list], None] = None,
+) -> tuple[list[Opcode], dict[str, list]]:
+    """Diff `b` against the template, one pair of sections at a time.
+
+    `cache` holds the opcodes of pairs of sections that were diffed before,
+    keyed by `section_pair_key`; pairs found there are not diffed again.
+    Returns the opcodes for the whole document, and the cache entries for
+    the pairs in this diff, to be passed in next time."""
+    engine = engine or get_engine()
+    cache = cache or {}
+    used: dict[str, list] = {}
+
+    def get_cached(a_section: Section, b_section: Section) -> list[Opcode]:
+        key = section_pair_key(a_section, b_section)
+        if key not in cache:
+            cache[key] = engine.get_opcodes(  # type: ignore
+                prepared.lines[a_section.start : a_section.end],
+                b[b_section.start : b_section.end],
+                prepared=prepared.prepare_section(a_section),
+            )
+        used[key] = [list(op) for op in cache[key]]
+        return [tuple(op) for op in cache[key]]  # type: ignore
+
+    opcodes: list[Opcode] = []
+    i = j = 0
+    for a_section, b_section in align_sections(prepared.sections, b_sections):
+        i = a_section.start if a_section else i
+        j = b_section.start if b_section else j
+        for tag, i1, i2, j1, j2 in _pair_opcodes(a_section, b_section, get_cached):
+            op = (tag, i + i1, i + i2, j + j1, j + j2)
+            if opcodes and opcodes[-1][0] == tag == "equal":
+                op = (tag, opcodes[-1][1], op[2], opcodes[-1][3], op[4])
+                opcodes.pop()
+            opcodes.append(op)
+        i = a_section.end if a_section else i
+        j = b_section.end if b_section else j
+    return opcodes, used
+
+
+def section_diff(
+    prepared: PreparedTemplate,
+    b: Sequence[str],
+    b_sections: list[Section],
+    name: str,
+    *,
+    engine: Union[DiffEngine, None] = None,
+    cache: Union[dict[str, list], None] = None,
+    **kwargs,
+) -> list[str]:
+    """Unified diff of just the section called `name`, with line numbers
+    relative to the start of the section. Raises KeyError if neither side
+    has a section with that name."""
+    engine = engine or get_engine()
+    cache = cache or {}
+    for a_section, b_section in align_sections(prepared.sections, b_sections):
+        if (a_section or b_section).name != name:  # type: ignore
+            continue
+
+        def get_cached(a_section: Section, b_section: Section) -> list[Opcode]:
+            key = section_pair_key(a_section, b_section)
+            if key in cache:
+                return [tuple(op) for op in cache[key]]  # type: ignore
+            return engine.get_opcodes(  # type: ignore
+                prepared.lines[a_section.start : a_section.end],
+                b[b_section.start : b_section.end],
+                prepared=prepared.prepare_section(a_section),
+            )
+
+        return render_unified_diff(
+            prepared.lines[a_section.start : a_section.end] if a_section else [],
+            b[b_section.start : b_section.end] if b_section else [],
+            _pair_opcodes(a_section, b_section, get_cached),
+            **kwargs,
+        )
+    raise KeyError(name)
+
+
+def compact_opcodes(
+    opcodes: list[Opcode], a: Sequence[str], b: Sequence[str]
+) -> list[list]:
+    """A compact form of `opcodes` for clients that already have `a`:
+    `["=", i1, i2]` keeps lines `i1:i2` of `a`, while `["-", lines]` and
+    `["+", lines]` are deleted and inserted text."""
+    ret = []
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag == "equal":
+            ret.append(["=", i1, i2])
+            continue
+        if tag in {"replace", "delete"}:
+            ret.append(["-", list(a[i1:i2])])
+        if tag in {"replace", "insert"}:
+            ret.append(["+", list(b[j1:j2])])
+    return ret
+
+
+def unified_diff(
+    a: Sequence[str],
+    b: Sequence[str],
+    *,
+    fromfile: str = "",
+    tofile: str = "",
+    n: int = 3,
+    engine: Union[DiffEngine, None] = None,
+    prepared: Union[PreparedTemplate, None] = None,
+) -> list[str]:
+    """Render a diff exactly like `difflib.unified_diff` (with the default
+    `lineterm`), using `engine`, or the configured engine by default. If
+    `prepared` is passed, it must be `prepare(a)`."""
+    engine = engine or get_engine()
+    return render_unified_diff(
+        a,
+        b,
+        engine.get_opcodes(a, b, prepared=prepared),
+        fromfile=fromfile,
+        tofile=tofile,
+        n=n,
+    )
+
+
+def render_unified_diff(
+    a: Sequence[str],
+    b: Sequence[str],
+    opcodes: list[Opcode],
+    *,
+    fromfile: str = "",
+    tofile: str = "",
+    n: int = 3,
+) -> list[str]:
+    """Render `opcodes` like `difflib.unified_diff`."""
+    ret = []
+    for group in _grouped_opcodes(opcodes, n):
+        if not ret:
+            ret += [f"--- {fromfile}\n", f"+++ {tofile}\n"]
+        first, last = group[0], group[-1]
+        ret.append(
+            f"@@ -{_format_range(first[1], last[2])} "
+            f"+{_format_range(first[3], last[4])} @@\n"
+        )
+        for tag, i1, i2, j1, j2 in group:
+            if tag == "equal":
+                ret += [" " + line for line in a[i1:i2]]
+                continue
+            if tag in {"replace", "delete"}:
+                ret += ["-" + line for line in a[i1:i2]]
+            if tag in {"replace", "insert"}:
+                ret += ["+" + line for line in b[j1:j2]]
+    return ret
@@ -0,0 +1,429 @@
+# Copyright (C) 2022 John DeVries
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Adapter between our services and the Google API client library.
+
+Building a service object is expensive; `googleapiclient.discovery.build`
+reads and parses a large discovery document every time it is called. Here,
+we read the discovery documents that ship with the client library exactly
+once per process, and keep a bounded cache of built service objects so that
+repeated operations for the same credential reuse the same client.
+
+Credentials are also cached per user, and access tokens that get refreshed
+are written back to the user's `SocialToken`, so that we only go back to
+oauth2.googleapis.com when the stored token has actually expired.
+
+Every request should be executed through `execute` or `execute_batch`, which
+apply our rate limits and retry policy, and count errors by endpoint."""
+
+import datetime
+import json
+import logging
+import random
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import lru_cache
+from typing import Any, Union
+
+from allauth.socialaccount.models import SocialToken
+from cachetools import LRUCache
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.utils import timezone
+from google.auth import _helpers as google_auth_helpers
+from google.oauth2.credentials import Credentials
+from google_auth_httplib2 import AuthorizedHttp
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+from googleapiclient.errors import HttpError
+from googleapiclient.http import build_http
+
+
+GOOGLE_CLIENT_ID = settings.SOCIALACCOUNT_PROVIDERS["google"]["APP"]["client_id"]
+GOOGLE_CLIENT_SECRET = settings.SOCIALACCOUNT_PROVIDERS["google"]["APP"]["secret"]
+GOOGLE_TOKEN_URI = "https://oauth2.googleapis.com/token"
+
+# Google rejects batch requests with more calls than this in them
+BATCH_LIMIT = 50
+
+# errors which are worth retrying after backing off
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+RETRYABLE_403_REASONS = {"rateLimitExceeded", "userRateLimitExceeded"}
+MAX_RETRIES = 5
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 32
+
+
+logger = logging.getLogger(__name__)
+
+
+_credentials_cache = LRUCache(maxsize=settings.GOOGLE_CREDENTIALS_CACHE_SIZE)
+_credentials_cache_lock = threading.Lock()
+
+_service_cache = LRUCache(maxsize=settings.GOOGLE_API_SERVICE_CACHE_SIZE)
+_service_cache_lock = threading.Lock()
+
+
+def _get_newest_token(user_pk: int, *, lock: bool = False) -> SocialToken:
+    qs = SocialToken.objects.filter(
+        account__user_id=user_pk,
+        account__provider="google",
+    )
+    if lock:
+        qs = qs.select_for_update(of=("self",))
+    token = qs.order_by("-expires_at").first()
+    assert token
+    return token
+
+
+def _to_google_expiry(expires_at):
+    """google-auth expects naive UTC datetimes, allauth stores aware ones."""
+    if expires_at is None:
+        return None
+    return timezone.make_naive(expires_at, datetime.timezone.utc)
+
+
+def _from_google_expiry(expiry):
+    if expiry is None:
+        return None
+    return timezone.make_aware(expiry, datetime.timezone.utc)
+
+
+class PersistedCredentials(Credentials):
+    """Credentials which write refreshed access tokens back to the
+    `SocialToken` they came from.
+
+    Refreshing takes a row lock on the token, so if another worker (or
+    another thread in this one) already refreshed it, we adopt the stored
+    token instead of asking Google for yet another one."""
+
+    def __init__(self, *a, user_pk: int, **kw):
+        super().__init__(*a, **kw)
+        self._user_pk = user_pk
+        self._refresh_lock = threading.Lock()
+
+    def _adopt(self, token: SocialToken) -> bool:
+        """Take the stored token if it is newer than ours and still good.
+        Returns whether the stored token was adopted."""
+        expiry = _to_google_expiry(token.expires_at)
+        if token.token == self.token or expiry is None:
+            return False
+        if (
+            google_auth_helpers.utcnow()
+            >= expiry - google_auth_helpers.REFRESH_THRESHOLD
+        ):
+            return False
+        self.token = token.token
+        self.expiry = expiry
+        if token.token_secret:
+            self._refresh_token = token.token_secret
+        return True
+
+    def refresh(self, request):
+        stale_token = self.token
+        with self._refresh_lock:
+            if self.token != stale_token:
+                # another thread refreshed while we waited for the lock
+                return
+
+            with transaction.atomic():
+                token = _get_newest_token(self._user_pk, lock=True)
+                if self._adopt(token):
+                    logger.debug("adopted access token refreshed by another worker")
+                    return
+
+                if token.token_secret and token.token_secret != self.refresh_token:
+                    # the user signed in again since these were cached
+                    self._refresh_token = token.token_secret
+
+                super().refresh(request)
+
+                token.token = self.token
+                token.expires_at = _from_google_expiry(self.expiry)
+                if self.refresh_token:
+                    token.token_secret = self.refresh_token
+                token.save(update_fields=["token", "token_secret", "expires_at"])
+
+
+def get_credentials(*, user: User) -> Credentials:
+    """Return the live credentials for `user`. They are cached in-process, so
+    a refreshed access token is reused by every later call."""
+    with _credentials_cache_lock:
+        if (cached := _credentials_cache.get(user.pk)) is not None:
+            return cached
+
+    token = _get_newest_token(user.pk)
+    credentials = PersistedCredentials(
+        token=token.token,
+        refresh_token=token.token_secret,
+        expiry=_to_google_expiry(token.expires_at),
+        token_uri=GOOGLE_TOKEN_URI,
+        client_id=GOOGLE_CLIENT_ID,
+        client_secret=GOOGLE_CLIENT_SECRET,
+        user_pk=user.pk,
+    )
+
+    with _credentials_cache_lock:
+        return _credentials_cache.setdefault(user.pk, credentials)
+
+
+def clear_credentials_cache():
+    with _credentials_cache_lock:
+        _credentials_cache.clear()
+
+
+@lru_cache(maxsize=None)
+def get_discovery_document(service: str, version: str) -> str:
+    """Return the discovery document bundled with the client library. We
+    never want to fetch these over the network at request time."""
+    doc = get_static_doc(service, version)
+    if doc is None:
+        raise ValueError(f"no bundled discovery document for {service} {version}")
+    return doc
+
+
+def _credential_key(credentials: Credentials) -> str:
+    """The refresh token identifies the grant, and stays the same when the
+    access token is refreshed in place."""
+    return credentials.refresh_token or credentials.token
+
+
+def build_service(*, service: str, version: str, credentials: Credentials):
+    """Return a service object for `credentials`, building one only if the
+    least-recently-used cache does not already have it."""
+    key = (service, version, _credential_key(credentials))
+    with _service_cache_lock:
+        if (cached := _service_cache.get(key)) is not None:
+            return cached
+
+    resource = build_from_document(
+        get_discovery_document(service, version), credentials=credentials
+    )
+
+    with _service_cache_lock:
+        # another thread may have beaten us here; either object is fine
+        return _service_cache.setdefault(key, resource)
+
+
+def clear_service_cache():
+    with _service_cache_lock:
+        _service_cache.clear()
+
+
+def new_http(service) -> AuthorizedHttp:
+    """Return a new transport with the same credentials as `service`.
+
+    The httplib2 transport inside a service object is not thread safe, so
+    each thread that executes requests needs its own. Pass it to
+    `request.execute(http=...)`."""
+    return AuthorizedHttp(service._http.credentials, http=build_http())
+
+
+def execute_batch(
+    *,
+    service,
+    requests: dict[str, Any],
+    user: User,
+    batch_size: Union[int, None] = None,
+) -> dict[str, Union[dict, Exception]]:
+    """Execute `requests`, a mapping of our own ids to unexecuted request
+    objects, as a few multipart batch requests instead of one round trip
+    each. Like `execute`, this waits for the rate limits, and calls that fail
+    with a transient error are retried.
+
+    Returns a mapping of the same ids to each response. If an individual
+    call failed, its exception is in the mapping in place of a response, so
+    that callers can decide whether one failure should sink the rest."""
+    results: dict[str, Union[dict, Exception]] = {}
+
+    def callback(request_id, response, exception):
+        results[request_id] = exception if exception is not None else response
+
+    batch_size = batch_size or BATCH_LIMIT
+    pending = dict(requests)
+    for attempt in range(MAX_RETRIES + 1):
+        items = list(pending.items())
+        # calls that failed with their whole batch, whose error was already
+        # recorded once for the batch
+        batch_failed = set()
+        for i in range(0, len(items), batch_size):
+            chunk = items[i : i + batch_size]
+            batch = service.new_batch_http_request(callback=callback)
+            for request_id, request in chunk:
+                batch.add(request, request_id=request_id)
+            _acquire(user, len(chunk))
+            try:
+                batch.execute()
+            except Exception as e:
+                _record_error("batch", e)
+                if attempt == MAX_RETRIES or not is_retryable(e):
+                    raise
+                # the whole chunk is retried below
+                for request_id, _ in chunk:
+                    results[request_id] = e
+                    batch_failed.add(request_id)
+
+        pending = {}
+        for request_id, request in items:
+            if isinstance(error := results.get(request_id), Exception):
+                if request_id not in batch_failed:
+                    _record_error(
+                        getattr(request, "methodId", None) or "unknown", error
+                    )
+                if is_retryable(error) and attempt < MAX_RETRIES:
+                    pending[request_id] = request
+        if not pending:
+            break
+        logger.warning("retrying %d calls from a batch request", len(pending))
+        _backoff(attempt)
+
+    return results
+
+
+class TokenBucket:
+    """Allows `rate` calls per second on average, with bursts of up to
+    `capacity` calls."""
+
+    def __init__(self, *, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, *, reserve: float = 0):
+        """Take one token, waiting for it if necessary. `reserve` is a
+        fraction of the bucket which must be left for other callers."""
+        floor = 1 + reserve * self.capacity
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= floor:
+                    self.tokens -= 1
+                    return
+                wait = (floor - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def take(self):
+        """Take one token without waiting. The bucket may go into debt, which
+        callers of `acquire` then wait out."""
+        with self.lock:
+            self._refill()
+            self.tokens -= 1
+
+
+_project_bucket = TokenBucket(**settings.GOOGLE_API_RATE_LIMITS["project"])
+_user_buckets = LRUCache(maxsize=settings.GOOGLE_CREDENTIALS_CACHE_SIZE)
+_user_buckets_lock = threading.Lock()
+
+_is_background: ContextVar[bool] = ContextVar("is_background", default=False)
+
+_error_counts: Counter = Counter()
+_error_counts_lock = threading.Lock()
+
+
+@contextmanager
+def background_priority():
+    """Google API calls made inside this context are throttled, and leave
+    part of each rate limit unused, so that background work cannot starve
+    teachers who are waiting on a response. Other calls are counted against
+    the rate limits, but never wait."""
+    token = _is_background.set(True)
+    try:
+        yield
+    finally:
+        _is_background.reset(token)
+
+
+def _get_user_bucket(user: User) -> TokenBucket:
+    with _user_buckets_lock:
+        if (bucket := _user_buckets.get(user.pk)) is None:
+            bucket = _user_buckets[user.pk] = TokenBucket(
+                **settings.GOOGLE_API_RATE_LIMITS["user"]
+            )
+        return bucket
+
+
+def _acquire(user: User, n: int = 1):
+    user_bucket = _get_user_bucket(user)
+    if not _is_background.get():
+        for _ in range(n):
+            _project_bucket.take()
+            user_bucket.take()
+        return
+    reserve = settings.GOOGLE_API_BACKGROUND_RESERVE
+    for _ in range(n):
+        _project_bucket.acquire(reserve=reserve)
+        user_bucket.acquire(reserve=reserve)
+
+
+def _status(e: Exception) -> Union[int, None]:
+    return getattr(getattr(e, "resp", None), "status", None)
+
+
+def is_retryable(e: Exception) -> bool:
+    if isinstance(e, HttpError):
+        if (status := _status(e)) in RETRYABLE_STATUSES:
+            return True
+        if status == 403:
+            try:
+                errors = json.loads(e.content)["error"].get("errors", [])
+            except (ValueError, KeyError, TypeError):
+                return False
+            return any(err.get("reason") in RETRYABLE_403_REASONS for err in errors)
+        return False
+    return isinstance(e, (ConnectionError, TimeoutError))
+
+
+def _record_error(endpoint: str, e: Exception):
+    with _error_counts_lock:
+        _error_counts[(endpoint, _status(e) or type(e).__name__)] += 1
+
+
+def get_error_counts() -> dict:
+    """Errors since this process started, keyed by `(endpoint, status)`."""
+    with _error_counts_lock:
+        return dict(_error_counts)
+
+
+def _backoff(attempt: int):
+    """Exponential backoff with full jitter."""
+    time.sleep(random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt)))
+
+
+def execute(request, *, user: User, **kwargs):
+    """Execute `request` on behalf of `user`, waiting for the rate limits and
+    retrying errors that are likely to be transient. `kwargs` are passed
+    through to `request.execute`."""
+    endpoint = getattr(request, "methodId", None) or "unknown"
+    for attempt in range(MAX_RETRIES + 1):
+        _acquire(user)
+        try:
+            return request.execute(**kwargs)
+        except Exception as e:
+            _record_error(endpoint, e)
+            if attempt == MAX_RETRIES or not is_retryable(e):
+                raise
+            logger.warning("retrying %s after %r", endpoint, e)
+            _backoff(attempt)
@@ -0,0 +1,248 @@
+# Copyright (C) 2022 John DeVries
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""A small job queue that lives in the database.
+
+Exporting submissions from Google Drive is slow, so when a grading session is
+created we queue up a refresh of every submission, followed by diffing the
+whole session. `manage.py run_worker` processes the queue, so that content,
+names, photos and diffs are usually in place before the teacher opens each
+submission.
+
+Workers claim jobs with `SELECT ... FOR UPDATE SKIP LOCKED`, so any number of
+them can run side by side."""
+
+import logging
+from collections import defaultdict
+from datetime import timedelta
+from typing import Callable, Iterable, Union
+
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .google_api import background_priority
+from .models import AssignmentSubmission, BackgroundJob, GradingSession
+
+
+logger = logging.getLogger(__name__)
+
+
+# failed jobs are retried until they have been attempted this many times
+MAX_ATTEMPTS = 3
+
+# a job that has been running for this long was probably orphaned by a
+# worker that died, and can be claimed again
+STALE_AFTER = timedelta(minutes=15)
+
+# finished jobs are kept this long, for debugging, before they are deleted
+FINISHED_JOB_RETENTION = timedelta(days=7)
+
+
+def _refresh_submissions(payloads: list[dict]):
+    # avoid circular import
+    from .services import update_submissions
+
+    # a submission is forced if any of its jobs asked for it
+    force_update = defaultdict(bool)
+    for p in payloads:
+        force_update[p["submission_pk"]] |= p.get("force_update", False)
+
+    batches = defaultdict(list)
+    for submission in AssignmentSubmission.objects.filter(
+        pk__in=list(force_update)
+    ).select_related(
+        "assignment__course__owner", "assignment__template", "teacher_template"
+    ):
+        key = (submission.assignment_id, force_update[submission.pk])  # type: ignore
+        batches[key].append(submission)
+
+    for (_, force), submissions in batches.items():
+        update_submissions(submissions=submissions, force_update=force)
+
+
+def _diff_sessions(payloads: list[dict]):
+    # avoid circular import
+    from .services import (
+        diff_all_submissions,
+        refresh_minhash_signatures,
+        update_common_lines,
+    )
+
+    for session in GradingSession.objects.filter(
+        pk__in={p["session_pk"] for p in payloads}
+    ):
+        diff_all_submissions(session)
+        update_common_lines(session)
+        refresh_minhash_signatures(session)
+
+
+HANDLERS: dict[str, Callable[[list[dict]], None]] = {
+    BackgroundJob.Kind.REFRESH_SUBMISSION: _refresh_submissions,
+    BackgroundJob.Kind.DIFF_SESSION: _diff_sessions,
+}
+
+
+def enqueue_submission_refreshes(
+    submissions: Iterable[AssignmentSubmission], *, force_update: bool = False
+) -> list[BackgroundJob]:
+    """Queue a refresh for each submission, unless one is already pending."""
+    submissions = {s.pk: s for s in submissions}.values()
+    pks = {s.pk for s in submissions}
+    already_pending = set(
+        BackgroundJob.objects.filter(
+            kind=BackgroundJob.Kind.REFRESH_SUBMISSION,
+            state=BackgroundJob.State.PENDING,
+            payload__submission_pk__in=pks,
+        ).values_list("payload__submission_pk", flat=True)
+    )
+    return BackgroundJob.objects.bulk_create(
+        [
+            BackgroundJob(
+                kind=BackgroundJob.Kind.REFRESH_SUBMISSION,
+                payload={
+                    "submission_pk": s.pk,
+                    "session_pk": s.assignment_id,  # type: ignore
+                    "force_update": force_update,
+                },
+            )
+            for s in sorted(submissions, key=lambda s: s.pk)
+            if s.pk not in already_pending
+        ]
+    )
+
+
+def enqueue_session_diff(session: GradingSession) -> Union[BackgroundJob, None]:
+    """Queue diffing every submission in the session, unless that is already
+    pending. The diff is not claimed while any refresh of the session is
+    pending or running, so a pending diff also covers refreshes that are
+    queued after it."""
+    if BackgroundJob.objects.filter(
+        kind=BackgroundJob.Kind.DIFF_SESSION,
+        state=BackgroundJob.State.PENDING,
+        payload__session_pk=session.pk,
+    ).exists():
+        return None
+    return BackgroundJob.objects.create(
+        kind=BackgroundJob.Kind.DIFF_SESSION, payload={"session_pk": session.pk}
+    )
+
+
+def _without_blocked_diffs(jobs: list[BackgroundJob]) -> list[BackgroundJob]:
+    # ordering by `created` isn't enough when there are several workers, so
+    # a diff waits until no refresh of its session is pending or running
+    diff_sessions = [
+        j.payload["session_pk"]
+        for j in jobs
+        if j.kind == BackgroundJob.Kind.DIFF_SESSION
+    ]
+    if not diff_sessions:
+        return jobs
+    refreshing = set(
+        BackgroundJob.objects.filter(
+            kind=BackgroundJob.Kind.REFRESH_SUBMISSION,
+            state__in=[BackgroundJob.State.PENDING, BackgroundJob.State.RUNNING],
+            payload__session_pk__in=diff_sessions,
+        ).values_list("payload__session_pk", flat=True)
+    )
+    return [
+        j
+        for j in jobs
+        if j.kind != BackgroundJob.Kind.DIFF_SESSION
+        or j.payload["session_pk"] not in refreshing
+    ]
+
+
+def claim_jobs(*, limit: int) -> list[BackgroundJob]:
+    """Mark up to `limit` of the oldest runnable jobs as running, and return
+    them. Rows locked by other workers are skipped, and so are session diffs
+    that would race with refreshes of the same session."""
+    runnable = Q(state=BackgroundJob.State.PENDING) | Q(
+        state=BackgroundJob.State.RUNNING,
+        last_updated__lt=timezone.now() - STALE_AFTER,
+    )
+    with transaction.atomic():
+        jobs = list(
+            BackgroundJob.objects.select_for_update(skip_locked=True)
+            .filter(runnable)
+            .order_by("created")[:limit]
+        )
+        jobs = _without_blocked_diffs(jobs)
+        for job in jobs:
+            job.state = BackgroundJob.State.RUNNING
+            job.attempts += 1
+        BackgroundJob.objects.bulk_update(jobs, ["state", "attempts"])
+        # bulk_update skips auto_now, but the stale check depends on it
+        BackgroundJob.objects.filter(pk__in=[j.pk for j in jobs]).update(
+            last_updated=timezone.now()
+        )
+    return jobs
+
+
+def _batch_key(job: BackgroundJob) -> tuple:
+    return (
+        job.kind,
+        job.payload.get("session_pk"),
+        job.payload.get("force_update", False),
+    )
+
+
+def run_jobs(jobs: list[BackgroundJob]):
+    """Run claimed jobs, batched by kind and session so that handlers can
+    batch their API calls. A failure fails every job in its batch, but not
+    the other batches; failed jobs are retried until they run out of
+    attempts.
+
+    Google API calls made by jobs yield to interactive traffic; see
+    `google_api.background_priority`."""
+    batches = defaultdict(list)
+    for job in jobs:
+        batches[_batch_key(job)].append(job)
+
+    for (kind, *_), group in batches.items():
+        try:
+            with background_priority():
+                HANDLERS[kind]([j.payload for j in group])
+        except Exception as e:
+            logger.exception("%d %s jobs failed", len(group), kind)
+            for job in group:
+                job.error = repr(e)
+                job.state = (
+                    BackgroundJob.State.PENDING
+                    if job.attempts < MAX_ATTEMPTS
+                    else BackgroundJob.State.FAILED
+                )
+        else:
+            for job in group:
+                job.error = ""
+                job.state = BackgroundJob.State.DONE
+        BackgroundJob.objects.bulk_update(group, ["state", "error"])
+
+
+def delete_finished_jobs(*, older_than: timedelta = FINISHED_JOB_RETENTION) -> int:
+    """Delete done and failed jobs that finished more than `older_than` ago,
+    so that the queue does not grow without bound. Returns the number of
+    jobs deleted."""
+    return BackgroundJob.objects.filter(
+        state__in=[BackgroundJob.State.DONE, BackgroundJob.State.FAILED],
+        last_updated__lt=timezone.now() - older_than,
+    ).delete()[0]
+
+
+def run_pending_jobs(*, limit: int = 50) -> int:
+    """Claim and run one batch of jobs. Returns the number of jobs run."""
+    jobs = claim_jobs(limit=limit)
+    run_jobs(jobs)
+    return len(jobs)
@@ -0,0 +1,88 @@
+# Copyright (C) 2022 John DeVries
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from grader.jobs import delete_finished_jobs, run_pending_jobs
+from grader.models import ContentBlob
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Process background jobs, like pre-fetching submission content."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=50,
+            help="Maximum number of jobs to claim at once.",
+        )
+        parser.add_argument(
+            "--poll-interval",
+            type=float,
+            default=2.0,
+            help="Seconds to wait before polling again when the queue is empty.",
+        )
+        parser.add_argument(
+            "--gc-interval",
+            type=float,
+            default=600.0,
+            help=(
+                "Seconds between deleting content blobs that are no longer "
+                "used, and old finished jobs."
+            ),
+        )
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Exit when the queue is empty instead of polling forever.",
+        )
+
+    def handle(self, *_, batch_size, poll_interval, gc_interval, once, **__):
+        next_gc = time.monotonic()
+        while True:
+            # a long running worker has to drop connections that the database
+            # closed or that went bad, like a request would
+            close_old_connections()
+            try:
+                if time.monotonic() >= next_gc:
+                    n_deleted = ContentBlob.objects.delete_unused()
+                    if n_deleted:
+                        self.stdout.write(f"deleted {n_deleted} unused blobs")
+                    n_deleted = delete_finished_jobs()
+                    if n_deleted:
+                        self.stdout.write(f"deleted {n_deleted} finished jobs")
+                    next_gc = time.monotonic() + gc_interval
+                n_run = run_pending_jobs(limit=batch_size)
+            except Exception:
+                # e.g. the database went away while claiming jobs; wait for
+                # it to come back instead of exiting
+                logger.exception("failed to run jobs")
+                n_run = 0
+                if once:
+                    raise
+            if n_run:
+                self.stdout.write(f"ran {n_run} jobs")
+            elif once:
+                return
+            else:
+                time.sleep(poll_interval)
@@ -0,0 +1,66 @@
+# Copyright (C) 2022 John DeVries
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Generated by Django 4.0.2 on 2026-10-18 07:39
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("grader", "0016_backgroundjob"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="coursemodel",
+            name="roster_last_synced",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name="CourseStudent",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("api_student_profile_id", models.CharField(max_length=50)),
+                ("name", models.CharField(max_length=200)),
+                ("photo_url", models.CharField(blank=True, default="", max_length=200)),
+                (
+                    "course",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="students",
+                        to="grader.coursemodel",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="coursestudent",
+            constraint=models.UniqueConstraint(
+                fields=("course", "api_student_profile_id"),
+                name="unique_student_per_course",
+            ),
+        ),
+    ]
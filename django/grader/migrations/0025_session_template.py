@@ -0,0 +1,67 @@
+# Copyright (C) 2022 John DeVries
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Generated by Django 4.0.2 on 2026-10-18 08:13
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def share_session_templates(apps, schema_editor):
+    """Point every submission in a session at one template, the one which was
+    updated most recently, and delete the templates this leaves unused."""
+    GradingSession = apps.get_model("grader", "GradingSession")
+    AssignmentSubmission = apps.get_model("grader", "AssignmentSubmission")
+    TeacherTemplate = apps.get_model("grader", "TeacherTemplate")
+
+    for session in GradingSession.objects.all().iterator():
+        template = (
+            TeacherTemplate.objects.filter(assignmentsubmission__assignment=session)
+            .order_by("-last_updated", "-pk")
+            .first()
+        )
+        if template is None:
+            continue
+        AssignmentSubmission.objects.filter(assignment=session).exclude(
+            teacher_template=None
+        ).update(teacher_template=template)
+        session.template = template
+        session.save(update_fields=["template"])
+
+    TeacherTemplate.objects.filter(
+        assignmentsubmission__isnull=True, sessions__isnull=True
+    ).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("grader", "0024_similarity_index"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="gradingsession",
+            name="template",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="sessions",
+                to="grader.teachertemplate",
+            ),
+        ),
+        migrations.RunPython(share_session_templates, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,113 @@
+# Copyright (C) 2022 John DeVries
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Generated by Django 4.0.2 on 2026-10-18 08:16
+
+import zlib
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+from grader.utils import content_hash
+
+
+BATCH_SIZE = 500
+
+
+def _store(ContentBlob, texts: set[str]):
+    blobs = []
+    for text in texts:
+        data = text.encode("utf8")
+        blobs.append(
+            ContentBlob(
+                hash=content_hash(text), data=zlib.compress(data), size=len(data)
+            )
+        )
+    ContentBlob.objects.bulk_create(blobs, ignore_conflicts=True)
+
+
+def move_content_to_blobs(apps, schema_editor):
+    ContentBlob = apps.get_model("grader", "ContentBlob")
+    for model_name, text_field, blob_field in (
+        ("AssignmentSubmission", "submission", "submission_blob"),
+        ("TeacherTemplate", "content", "content_blob"),
+    ):
+        Model = apps.get_model("grader", model_name)
+        rows = Model.objects.only("pk", text_field).order_by("pk")
+        last_pk = 0
+        while batch := list(rows.filter(pk__gt=last_pk)[:BATCH_SIZE]):
+            last_pk = batch[-1].pk
+            _store(ContentBlob, {getattr(row, text_field) for row in batch})
+            for row in batch:
+                setattr(row, f"{blob_field}_id", content_hash(getattr(row, text_field)))
+            Model.objects.bulk_update(batch, [blob_field])
+
+
+def move_content_out_of_blobs(apps, schema_editor):
+    ContentBlob = apps.get_model("grader", "ContentBlob")
+    for model_name, text_field, hash_field, blob_field in (
+        ("AssignmentSubmission", "submission", "submission_hash", "submission_blob"),
+        ("TeacherTemplate", "content", "content_hash", "content_blob"),
+    ):
+        Model = apps.get_model("grader", model_name)
+        rows = Model.objects.select_related(blob_field).exclude(**{blob_field: None})
+        for row in rows.iterator(chunk_size=BATCH_SIZE):
+            blob = getattr(row, blob_field)
+            setattr(row, text_field, zlib.decompress(blob.data).decode("utf8"))
+            setattr(row, hash_field, blob.hash)
+            row.save(update_fields=[text_field, hash_field])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("grader", "0025_session_template"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ContentBlob",
+            fields=[
+                (
+                    "hash",
+                    models.CharField(max_length=64, primary_key=True, serialize=False),
+                ),
+                ("data", models.BinaryField()),
+                ("size", models.PositiveIntegerField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name="assignmentsubmission",
+            name="submission_blob",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.PROTECT,
+                related_name="submissions",
+                to="grader.contentblob",
+            ),
+        ),
+        migrations.AddField(
+            model_name="teachertemplate",
+            name="content_blob",
+            field=models.ForeignKey(
+                null=True,
+                on_delete=django.db.models.deletion.PROTECT,
+                related_name="templates",
+                to="grader.contentblob",
+            ),
+        ),
+        migrations.RunPython(move_content_to_blobs, move_content_out_of_blobs),
+    ]
@@ -0,0 +1,54 @@
+# Copyright (C) 2022 John DeVries
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Generated by Django 4.0.2 on 2026-10-18 08:16
+
+from django.db import migrations, models
+
+
+# separate from 0026, because PostgreSQL cannot alter a table with pending
+# deferred foreign key checks from the rows updated there. `content` gets a
+# default first, so that it can be added back if this is reversed
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("grader", "0026_content_blobs"),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name="assignmentsubmission",
+            name="submission",
+        ),
+        migrations.RemoveField(
+            model_name="assignmentsubmission",
+            name="submission_hash",
+        ),
+        migrations.AlterField(
+            model_name="teachertemplate",
+            name="content",
+            field=models.TextField(default=""),
+        ),
+        migrations.RemoveField(
+            model_name="teachertemplate",
+            name="content",
+        ),
+        migrations.RemoveField(
+            model_name="teachertemplate",
+            name="content_hash",
+        ),
+    ]
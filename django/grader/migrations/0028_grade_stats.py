@@ -0,0 +1,99 @@
+# Copyright (C) 2022 John DeVries
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Generated by Django 4.0.2 on 2026-10-18 08:19
+
+from django.db import migrations, models
+
+
+# copied from the models, since historical models do not have their methods
+GRADE_HISTOGRAM_BUCKETS = 10
+
+
+def update_session_grade_stats(AssignmentSubmission, session):
+    """Recompute the grade statistics of `session`, a historical model."""
+    counts = dict(
+        AssignmentSubmission.objects.filter(assignment=session, removed=False)
+        .exclude(grade=None)
+        .values_list("grade")
+        .annotate(n=models.Count("pk"))
+        .order_by()
+    )
+    histogram = [0] * GRADE_HISTOGRAM_BUCKETS
+    for grade, n in counts.items():
+        if session.max_grade > 0:
+            bucket = grade * GRADE_HISTOGRAM_BUCKETS // session.max_grade
+            bucket = min(max(bucket, 0), GRADE_HISTOGRAM_BUCKETS - 1)
+        else:
+            bucket = 0
+        histogram[bucket] += n
+    session.graded_count = sum(counts.values())
+    session.grade_sum = sum(grade * n for grade, n in counts.items())
+    session.grade_min = min(counts, default=None)
+    session.grade_max = max(counts, default=None)
+    session.grade_histogram = histogram
+    session.save(
+        update_fields=[
+            "graded_count",
+            "grade_sum",
+            "grade_min",
+            "grade_max",
+            "grade_histogram",
+        ]
+    )
+
+
+def compute_grade_stats(apps, schema_editor):
+    GradingSession = apps.get_model("grader", "GradingSession")
+    AssignmentSubmission = apps.get_model("grader", "AssignmentSubmission")
+
+    for session in GradingSession.objects.all().iterator():
+        update_session_grade_stats(AssignmentSubmission, session)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("grader", "0027_remove_inline_content"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="gradingsession",
+            name="grade_histogram",
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.AddField(
+            model_name="gradingsession",
+            name="grade_max",
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="gradingsession",
+            name="grade_min",
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="gradingsession",
+            name="grade_sum",
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="gradingsession",
+            name="graded_count",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(compute_grade_stats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,65 @@
+# Copyright (C) 2022 John DeVries
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from importlib import import_module
+
+from django.db import migrations
+from django.db.models import Count
+
+# the duplicates may have been counted in the grade statistics, so those are
+# recomputed the same way as when they were added
+update_session_grade_stats = import_module(
+    "grader.migrations.0028_grade_stats"
+).update_session_grade_stats
+
+
+def delete_duplicate_submissions(apps, schema_editor):
+    """Keep the most recently updated of each student's submissions in a
+    session, so that they can be made unique."""
+    GradingSession = apps.get_model("grader", "GradingSession")
+    AssignmentSubmission = apps.get_model("grader", "AssignmentSubmission")
+
+    duplicated = (
+        AssignmentSubmission.objects.values("assignment", "api_student_submission_id")
+        .annotate(n=Count("pk"))
+        .filter(n__gt=1)
+        .order_by()
+    )
+    touched = set()
+    for row in duplicated.iterator():
+        pks = list(
+            AssignmentSubmission.objects.filter(
+                assignment=row["assignment"],
+                api_student_submission_id=row["api_student_submission_id"],
+            )
+            .order_by("-last_updated", "-pk")
+            .values_list("pk", flat=True)
+        )
+        AssignmentSubmission.objects.filter(pk__in=pks[1:]).delete()
+        touched.add(row["assignment"])
+
+    for session in GradingSession.objects.filter(pk__in=touched).iterator():
+        update_session_grade_stats(AssignmentSubmission, session)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("grader", "0028_grade_stats"),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_duplicate_submissions, migrations.RunPython.noop),
+    ]
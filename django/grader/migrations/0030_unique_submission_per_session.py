@@ -0,0 +1,39 @@
+# Copyright (C) 2022 John DeVries
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Generated by Django 4.0.2 on 2026-10-18 08:26
+
+from django.db import migrations, models
+
+
+# separate from 0029, because PostgreSQL cannot alter a table with pending
+# deferred foreign key checks from the rows deleted there
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("grader", "0029_dedupe_submissions"),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name="assignmentsubmission",
+            constraint=models.UniqueConstraint(
+                fields=("assignment", "api_student_submission_id"),
+                name="unique_submission_per_session",
+            ),
+        ),
+    ]
@@ -13,15 +13,41 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-from difflib import unified_diff
+import zlib
+from datetime import timedelta
+from typing import Iterable, Union
 
+from django.conf import settings
 from django.utils import timezone
 from django.contrib.auth.models import User
-from django.db import models
+from django.db import models, transaction
 from django.utils.translation import gettext_lazy as _
 
 
-from .utils import normalize_protocol_url
+from .diff import (
+    Section,
+    compact_opcodes,
+    get_prepared_template,
+    render_unified_diff,
+    section_diff,
+    section_opcodes,
+    split_sections,
+)
+from .similarity import band_keys, minhash, normalize, shingles
+from .utils import content_hash, normalize_protocol_url
+
+
+# the content of submissions that have not been fetched yet
+DEFAULT_SUBMISSION = "no attachments found"
+
+EMPTY_CONTENT_HASH = content_hash("")
+
+# grades are counted in this many equal parts of `GradingSession.max_grade`
+GRADE_HISTOGRAM_BUCKETS = 10
+
+# blobs that nothing refers to are kept for this long after they were last
+# stored, so that the row referring to a new blob can be saved first
+UNUSED_BLOB_GRACE = timedelta(hours=1)
 
 
 class CourseModel(models.Model):
@@ -29,10 +55,59 @@ class CourseModel(models.Model):
     name = models.CharField(max_length=255)
     api_course_id = models.CharField(max_length=50, unique=True)
 
+    # when the roster (`students`) was last fetched from Google
+    roster_last_synced = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return self.name
+
+    @property
+    def roster_needs_update(self) -> bool:
+        return (
+            self.roster_last_synced is None
+            or timezone.now() - self.roster_last_synced > settings.GOOGLE_ROSTER_TTL
+        )
+
+
+class CourseStudent(models.Model):
+    """A student on a course roster. The whole roster can be listed with a
+    few requests, which is much cheaper than fetching each student's profile
+    for each of their submissions."""
+
+    course = models.ForeignKey(
+        CourseModel, related_name="students", on_delete=models.CASCADE
+    )
+    api_student_profile_id = models.CharField(max_length=50)
+    name = models.CharField(max_length=200)
+    photo_url = models.CharField(max_length=200, blank=True, default="")
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["course", "api_student_profile_id"],
+                name="unique_student_per_course",
+            )
+        ]
+
     def __str__(self):
         return self.name
 
 
+class GradingSessionQuerySet(models.QuerySet):
+    def prefetch_active_submissions(self, *fields: str):
+        """Load the active submissions of every session in one query; see
+        `GradingSession.get_active_submissions`. Only `fields` are loaded,
+        so that pages listing students do not load their diffs."""
+        queryset = AssignmentSubmission.objects.filter(removed=False)
+        if fields:
+            queryset = queryset.only("assignment", *fields)
+        return self.prefetch_related(
+            models.Prefetch(
+                "submissions", queryset=queryset, to_attr="_active_submissions"
+            )
+        )
+
+
 class GradingSession(models.Model):
     created = models.DateTimeField(auto_now_add=True)
 
@@ -55,6 +130,16 @@ class GradingSession(models.Model):
     max_grade = models.IntegerField()
     teacher_template = models.TextField(blank=True)
 
+    # the template shared by every submission in the session. It is written
+    # under a lock on this row; see `services.get_session_template`
+    template = models.ForeignKey(
+        "TeacherTemplate",
+        related_name="sessions",
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+    )
+
     class SyncState(models.TextChoices):
         UNSYNCED = "U", _("UNSYNCED")
         SYNCED = "S", _("SYNCED")
@@ -63,15 +148,116 @@ class GradingSession(models.Model):
         max_length=2, choices=SyncState.choices, default=SyncState.UNSYNCED
     )
 
+    # hashes of the lines that most students' submissions have in common;
+    # see `grader.common_lines`
+    common_line_hashes = models.JSONField(default=list, blank=True)
+
+    objects = GradingSessionQuerySet.as_manager()
+
+    # statistics of the grades of the active submissions, kept up to date as
+    # grades change so that reading them does not take an aggregate query;
+    # see `update_grade_stats`
+    graded_count = models.PositiveIntegerField(default=0)
+    grade_sum = models.BigIntegerField(default=0)
+    grade_min = models.IntegerField(null=True, blank=True)
+    grade_max = models.IntegerField(null=True, blank=True)
+    grade_histogram = models.JSONField(default=list, blank=True)
+
+    GRADE_STATS_FIELDS = (
+        "graded_count",
+        "grade_sum",
+        "grade_min",
+        "grade_max",
+        "grade_histogram",
+    )
+
     @property
     def is_graded(self) -> bool:
         return bool(self.max_grade)
 
+    def get_histogram_bucket(self, grade: int) -> int:
+        """Grades from 0 to `max_grade` fall into `GRADE_HISTOGRAM_BUCKETS`
+        buckets; grades outside of that go in the first or last one."""
+        if self.max_grade <= 0:  # type: ignore
+            return 0
+        bucket = grade * GRADE_HISTOGRAM_BUCKETS // self.max_grade
+        return min(max(bucket, 0), GRADE_HISTOGRAM_BUCKETS - 1)
+
+    def update_grade_stats(
+        self, *, removed: Iterable[int] = (), added: Iterable[int] = ()
+    ):
+        """Take `removed` grades out of the statistics, and count `added`
+        ones. The row is locked while it is updated, so that concurrent
+        grade changes are not lost. Only removing the current minimum or
+        maximum needs a query over the submissions."""
+        removed, added = list(removed), list(added)
+        if not removed and not added:
+            return
+        with transaction.atomic():
+            locked = GradingSession.objects.select_for_update().get(pk=self.pk)
+            if len(locked.grade_histogram) != GRADE_HISTOGRAM_BUCKETS:  # type: ignore
+                # stored before max_grade was known, or never computed
+                locked.recompute_grade_stats()
+            else:
+                for grade in removed:
+                    locked.graded_count -= 1
+                    locked.grade_sum -= grade
+                    locked.grade_histogram[locked.get_histogram_bucket(grade)] -= 1  # type: ignore
+                for grade in added:
+                    locked.graded_count += 1
+                    locked.grade_sum += grade
+                    locked.grade_histogram[locked.get_histogram_bucket(grade)] += 1  # type: ignore
+                if {locked.grade_min, locked.grade_max} & set(removed):
+                    stats = locked.active_submissions.aggregate(
+                        min=models.Min("grade"), max=models.Max("grade")
+                    )
+                    locked.grade_min, locked.grade_max = stats["min"], stats["max"]
+                elif added:
+                    locked.grade_min = min(
+                        g for g in (locked.grade_min, *added) if g is not None
+                    )
+                    locked.grade_max = max(
+                        g for g in (locked.grade_max, *added) if g is not None
+                    )
+                locked.save(update_fields=self.GRADE_STATS_FIELDS)
+        for field in self.GRADE_STATS_FIELDS:
+            setattr(self, field, getattr(locked, field))
+
+    def recompute_grade_stats(self):
+        """Compute the grade statistics from scratch, after grades were
+        changed in bulk."""
+        counts = dict(
+            self.active_submissions.exclude(grade=None)
+            .values_list("grade")
+            .annotate(n=models.Count("pk"))
+            .order_by()
+        )
+        self.graded_count = sum(counts.values())
+        self.grade_sum = sum(grade * n for grade, n in counts.items())
+        self.grade_min = min(counts, default=None)
+        self.grade_max = max(counts, default=None)
+        self.grade_histogram = [0] * GRADE_HISTOGRAM_BUCKETS
+        for grade, n in counts.items():
+            self.grade_histogram[self.get_histogram_bucket(grade)] += n
+        self.save(update_fields=self.GRADE_STATS_FIELDS)
+
+    @property
+    def active_submissions(self):
+        """Submissions which are still listed in Google Classroom."""
+        return self.submissions.filter(removed=False)  # type: ignore
+
+    def get_active_submissions(self) -> Iterable["AssignmentSubmission"]:
+        """`active_submissions`, unless they were loaded by
+        `GradingSessionQuerySet.prefetch_active_submissions`."""
+        if hasattr(self, "_active_submissions"):
+            return self._active_submissions
+        return self.active_submissions
+
     @property
     def average_grade(self):
-        if not self.is_graded:
+        if not self.is_graded or not self.graded_count:
             return None
-        return list(self.submissions.aggregate(models.Avg("grade")).values())[0]  # type: ignore
+        return self.grade_sum / self.graded_count
 
     @property
     def google_classroom_detail_view_url(self):
@@ -91,6 +277,71 @@ class GradingSession(models.Model):
         return self.assignment_name
 
 
+class ContentBlobManager(models.Manager):
+    def store(self, text: str) -> str:
+        """Store `text`, unless an identical blob exists. Returns its hash."""
+        key = content_hash(text)
+        # marking an existing blob as used keeps `delete_unused` away from it
+        # until the row that will refer to it is saved
+        if self.filter(hash=key).update(last_used=timezone.now()):
+            return key
+        data = text.encode("utf8")
+        self.bulk_create(
+            [ContentBlob(hash=key, data=zlib.compress(data), size=len(data))],
+            ignore_conflicts=True,
+        )
+        return key
+
+    def load_many(self, hashes: Iterable[str]) -> dict[str, str]:
+        """The text of each blob, by hash."""
+        return {blob.hash: blob.text for blob in self.filter(hash__in=set(hashes))}
+
+    def delete_unused(self, *, grace: timedelta = UNUSED_BLOB_GRACE) -> int:
+        """Delete blobs that nothing refers to, and that have not been stored
+        within `grace`. Returns the number of blobs deleted.
+
+        Blobs are shared, so this runs periodically from the worker instead
+        of after each save or delete. The rows are locked while they are
+        deleted, so a concurrent `store` of the same text waits, and then
+        stores it again."""
+        with transaction.atomic():
+            unused = list(
+                self.select_for_update(skip_locked=True, of=("self",))
+                .filter(
+                    submissions=None,
+                    templates=None,
+                    last_used__lt=timezone.now() - grace,
+                )
+                .values_list("hash", flat=True)
+            )
+            return self.filter(hash__in=unused).delete()[0]
+
+
+class ContentBlob(models.Model):
+    """Text stored once per distinct content, compressed, and keyed by its
+    hash. Many students hand in the template untouched or nearly untouched,
+    so submissions and templates refer to blobs instead of each holding
+    their own copy, and an unchanged refresh is only a hash comparison."""
+
+    hash = models.CharField(max_length=64, primary_key=True)
+    data = models.BinaryField()
+
+    # bytes of the uncompressed text
+    size = models.PositiveIntegerField()
+
+    # when the blob was last stored; see `ContentBlobManager.delete_unused`
+    last_used = models.DateTimeField(default=timezone.now)
+
+    objects = ContentBlobManager()
+
+    @property
+    def text(self) -> str:
+        return zlib.decompress(self.data).decode("utf8")  # type: ignore
+
+    def __str__(self):
+        return self.hash
+
+
 class TeacherTemplate(models.Model):
     """This string is diffed against to provide the differences template. Here,
     the individual attachments Google Drive objects are irrelevant. Like the
@@ -99,13 +350,70 @@ class TeacherTemplate(models.Model):
     stage, we don't really care what is in here – it just gives us something
     to diff against while we are serving student submissions"""
 
-    content = models.TextField()
+    # the text is stored in a blob, named by its hash; see `content`
+    content_blob = models.ForeignKey(
+        ContentBlob, related_name="templates", on_delete=models.PROTECT, null=True
+    )
     last_updated = models.DateTimeField(auto_now=True)
 
+    @property
+    def content(self) -> str:
+        """The template's text, loaded from `content_blob` on first use."""
+        if "_content" not in self.__dict__:
+            self._content = self.content_blob.text if self.content_blob_id else ""  # type: ignore
+        return self._content
+
+    @content.setter
+    def content(self, value: str):
+        self._content = value
+
     @property
     def needs_update(self):
         return bool((timezone.now() - self.last_updated).days > 2)  # type: ignore
 
+    def get_content_hash(self) -> str:
+        return self.content_blob_id or content_hash(self.content)  # type: ignore
+
+    def save(self, *a, **kw):
+        update_fields = kw.get("update_fields")
+        previous = self.content_blob_id  # type: ignore
+        if "_content" in self.__dict__ and (
+            not update_fields or "content" in update_fields
+        ):
+            if content_hash(self.content) != previous:
+                self.content_blob_id = ContentBlob.objects.store(self.content)
+        if update_fields and "content" in update_fields:
+            kw["update_fields"] = {*update_fields, "content_blob"} - {"content"}
+        super().save(*a, **kw)
+
+
+class DriveExport(models.Model):
+    """Cached plain text export of a Google Drive file. Exports are by far the
+    slowest Google API call we make, and most files do not change between
+    refreshes. Before exporting, we fetch the file's metadata, which is
+    cheap, and reuse this export if the `version` has not changed."""
+
+    file_id = models.CharField(max_length=100, unique=True)
+    version = models.CharField(max_length=50)
+    modified_time = models.CharField(max_length=50, blank=True)
+    content = models.TextField()
+
+    # bytes of `content`, for bounding the size of the cache
+    size = models.PositiveIntegerField()
+    last_used = models.DateTimeField(default=timezone.now, db_index=True)
+
+    def __str__(self):
+        return f"{self.file_id} v{self.version}"
+
+
+class AssignmentSubmissionManager(models.Manager):
+    def bulk_create(self, objs, *a, **kw):
+        # `save` is skipped, so content has to be stored here
+        objs = list(objs)
+        for obj in objs:
+            obj.store_submission()
+        return super().bulk_create(objs, *a, **kw)
+
 
 class AssignmentSubmission(models.Model):
     # relations
@@ -120,6 +428,16 @@ class AssignmentSubmission(models.Model):
     api_student_profile_id = models.CharField(max_length=50)
     api_student_submission_id = models.CharField(max_length=50)
 
+    # studentSubmission fields as of the last sync, used to tell which
+    # submissions changed in Google Classroom since then
+    api_update_time = models.CharField(max_length=50, blank=True, default="")
+    api_state = models.CharField(max_length=50, blank=True, default="")
+
+    # the submission is no longer listed by Google Classroom; for example,
+    # the student left the course. It is kept, along with our grade and
+    # comments, in case they come back
+    removed = models.BooleanField(default=False)
+
     # student information
     # this information is nullable, because it requires a separate request to
     # fetch, and this allows us to do that lazily.
@@ -129,15 +447,225 @@ class AssignmentSubmission(models.Model):
     # grading information
     grade = models.IntegerField(null=True)
 
-    # submission content
-    submission = models.TextField(default="no attachments found")
+    # incremented by `save` whenever the grade changes. Clients send back the
+    # version they last saw with grade updates, so that grades changed by
+    # someone else in the meantime are not overwritten; see
+    # `services.update_grades`
+    grade_version = models.PositiveIntegerField(default=0)
+
+    # submission content is stored in a blob, named by its hash; see
+    # `submission`. Until the content is fetched, there is no blob
+    submission_blob = models.ForeignKey(
+        ContentBlob,
+        related_name="submissions",
+        on_delete=models.PROTECT,
+        null=True,
+        blank=True,
+    )
+
+    # the name, line range and hash of each section of the submission (see
+    # `grader.diff.Section`), maintained by `save`
+    submission_sections = models.JSONField(default=list, blank=True)
+
+    # the rendered diff is stored along with the hashes of the template and
+    # submission it was computed from; it is stale if either has changed
+    stored_diff = models.JSONField(null=True, blank=True)
+    stored_diff_template_hash = models.CharField(max_length=64, blank=True)
+    stored_diff_submission_hash = models.CharField(max_length=64, blank=True)
+
+    # the opcodes of each pair of template and submission sections, keyed by
+    # their hashes, so that only sections that change are diffed again
+    stored_section_opcodes = models.JSONField(default=dict, blank=True)
+
+    # MinHash signature of the lines the student wrote, maintained by `save`,
+    # and indexed by `SimilarityBucket`; see `grader.similarity`
+    minhash_signature = models.JSONField(null=True, blank=True)
+    # hash of the template content the signature was computed against; when
+    # the template changes, `services.refresh_minhash_signatures` catches up
+    minhash_template_hash = models.CharField(max_length=64, blank=True)
 
     # metadata
     last_updated = models.DateTimeField(auto_now=True)
 
+    objects = AssignmentSubmissionManager()
+
+    class Meta:
+        constraints = [
+            # concurrent syncs of a session cannot both add a student's
+            # submission; see `services.sync_submissions`
+            models.UniqueConstraint(
+                fields=["assignment", "api_student_submission_id"],
+                name="unique_submission_per_session",
+            )
+        ]
+
     def __str__(self):
         return self.student_name or "no name"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._counted_grade = instance.get_counted_grade()
+        if "grade" in instance.__dict__:
+            instance._loaded_grade = instance.grade
+        if "teacher_template_id" in instance.__dict__:
+            instance._loaded_template_id = instance.teacher_template_id
+        return instance
+
+    def get_counted_grade(self) -> Union[int, None]:
+        """The grade, as counted in the session's grade statistics."""
+        if "grade" not in self.__dict__ or "removed" not in self.__dict__:
+            # deferred; not changed by this instance
+            return getattr(self, "_counted_grade", None)
+        return None if self.removed else self.grade  # type: ignore
+
+    @property
+    def submission(self) -> str:
+        """The submission's text, loaded from `submission_blob` on first
+        use."""
+        if "_submission" not in self.__dict__:
+            self._submission = (
+                self.submission_blob.text  # type: ignore
+                if self.submission_blob_id  # type: ignore
+                else DEFAULT_SUBMISSION
+            )
+        return self._submission
+
+    @submission.setter
+    def submission(self, value: str):
+        self._submission = value
+
+    def store_submission(self):
+        """Store the submission in a blob, if it has been assigned and is not
+        already stored. An unchanged submission is not written again."""
+        if "_submission" not in self.__dict__:
+            return
+        if content_hash(self.submission) != self.submission_blob_id:  # type: ignore
+            self.submission_blob_id = ContentBlob.objects.store(self.submission)
+            self.submission_sections = [
+                s.to_json() for s in split_sections(self.submission.split("\n"))
+            ]
+
+    def save(self, *a, **kw):
+        update_fields = kw.get("update_fields")
+        may_change = not update_fields or "submission" in update_fields
+        previous = self.submission_blob_id  # type: ignore
+        if may_change:
+            self.store_submission()
+        # the signature only depends on the content and the template, so
+        # saving grades, names and the like does not recompute it
+        signature_changed = False
+        template_saved = not update_fields or "teacher_template" in update_fields
+        if (may_change and previous != self.submission_blob_id) or (  # type: ignore
+            template_saved
+            and self.teacher_template_id  # type: ignore
+            != getattr(self, "_loaded_template_id", None)
+        ):
+            signature_changed = self.refresh_minhash_signature()
+            if update_fields:
+                update_fields = kw["update_fields"] = {
+                    *update_fields,
+                    "minhash_signature",
+                    "minhash_template_hash",
+                }
+        self._loaded_template_id = self.teacher_template_id  # type: ignore
+        if (not update_fields or "grade" in update_fields) and self.grade != getattr(
+            self, "_loaded_grade", self.grade
+        ):
+            self.grade_version += 1
+        if "grade" in self.__dict__:
+            self._loaded_grade = self.grade
+        if update_fields:
+            fields = set(update_fields)
+            if "submission" in fields:
+                fields |= {"submission_blob", "submission_sections"}
+                fields.remove("submission")
+            if "grade" in fields:
+                fields.add("grade_version")
+            kw["update_fields"] = fields
+        super().save(*a, **kw)
+        if signature_changed:
+            self.update_similarity_buckets()
+        if not update_fields or {"grade", "removed"} & set(update_fields):
+            self._update_grade_stats()
+
+    def _update_grade_stats(self):
+        before = getattr(self, "_counted_grade", None)
+        after = self.get_counted_grade()
+        if before == after:
+            return
+        session = (
+            self.assignment
+            if self._meta.get_field("assignment").is_cached(self)
+            else GradingSession(pk=self.assignment_id)  # type: ignore
+        )
+        session.update_grade_stats(
+            removed=[] if before is None else [before],
+            added=[] if after is None else [after],
+        )
+        self._counted_grade = after
+
+    def refresh_minhash_signature(self) -> bool:
+        """Compute `minhash_signature` against the current template. Returns
+        whether it changed, in which case the similarity index needs to be
+        updated once it is saved."""
+        signature = self.compute_minhash_signature()
+        self.minhash_template_hash = (
+            self.teacher_template.get_content_hash()  # type: ignore
+            if self.teacher_template_id  # type: ignore
+            else ""
+        )
+        changed = signature != self.minhash_signature
+        self.minhash_signature = signature
+        return changed
+
+    def compute_minhash_signature(self) -> Union[list[int], None]:
+        """Signature of the lines of the submission that are not in the
+        teacher template. Submissions that have not been fetched yet, or
+        that only contain template lines, do not have one."""
+        if not self.teacher_template_id:  # type: ignore
+            return None
+        template_lines = {
+            normalize(line)
+            for line in get_prepared_template(self.teacher_template).lines
+        }
+        return minhash(
+            shingles(self.submission.split("\n"), exclude=template_lines),  # type: ignore
+            num_perm=settings.GRADER_SIMILARITY["PERMUTATIONS"],
+        )
+
+    def update_similarity_buckets(self):
+        """Replace this submission's entries in the similarity index."""
+        SimilarityBucket.objects.filter(submission=self).delete()
+        if self.minhash_signature is None:
+            return
+        course_id = GradingSession.objects.values_list("course_id", flat=True).get(
+            pk=self.assignment_id  # type: ignore
+        )
+        SimilarityBucket.objects.bulk_create(
+            [
+                SimilarityBucket(
+                    course_id=course_id, band=band, key=key, submission=self
+                )
+                for band, key in enumerate(
+                    band_keys(
+                        self.minhash_signature,  # type: ignore
+                        bands=settings.GRADER_SIMILARITY["BANDS"],
+                    )
+                )
+            ]
+        )
+
+    # rows that have not been fetched yet do not have a blob or sections
+
+    def get_submission_hash(self) -> str:
+        return self.submission_blob_id or content_hash(self.submission)  # type: ignore
+
+    def get_sections(self) -> list[Section]:
+        if self.submission_blob_id and self.submission_sections:  # type: ignore
+            return [Section.from_json(s) for s in self.submission_sections]  # type: ignore
+        return split_sections(self.submission.split("\n"))  # type: ignore
+
     @property
     def profile_photo_url(self):
         return normalize_protocol_url(url=self._profile_photo_url)  # type: ignore
@@ -154,17 +682,36 @@ class AssignmentSubmission(models.Model):
         is_old = bool((timezone.now() - self.last_updated).days > 2)  # type: ignore
         missing_fields = False
         for field in (
-            "teacher_template",
+            # by id, so that the template is not loaded
+            "teacher_template_id",
             "student_name",
             "_profile_photo_url",
-            "submission",
         ):
             if not getattr(self, field):
                 missing_fields = True
+        # without loading the content
+        if self.submission_blob_id == EMPTY_CONTENT_HASH:  # type: ignore
+            missing_fields = True
         return is_old or missing_fields
 
+    @property
+    def diff_is_stored(self) -> bool:
+        """Whether `stored_diff` is up to date. It is not loaded to find
+        out, so `stored_diff` can be deferred."""
+        return bool(self.teacher_template) and (
+            self.stored_diff_template_hash,
+            self.stored_diff_submission_hash,
+        ) == (
+            self.teacher_template.get_content_hash(),  # type: ignore
+            self.get_submission_hash(),
+        )
+
     @property
     def diff(self) -> list[str]:
+        """Unified diff of the teacher template against the submission. It is
+        computed once, and served from `stored_diff` until the content of
+        either side changes. Then, only the sections which changed are
+        diffed again."""
         # avoid circular import
         from grader.services import update_submission
 
@@ -175,12 +722,125 @@ class AssignmentSubmission(models.Model):
         if not self.submission:
             return ["no attachments found"]
 
-        return list(
-            unified_diff(
-                self.teacher_template.content.split("\n"),
-                self.submission.split("\n"),
-                fromfile="teacher template",
-                tofile="student submission",
-                n=3,
+        template_hash = self.teacher_template.get_content_hash()
+        submission_hash = self.get_submission_hash()
+        if self.diff_is_stored and self.stored_diff is not None:
+            return self.stored_diff
+
+        prepared = get_prepared_template(self.teacher_template)
+        lines = self.submission.split("\n")
+        opcodes, self.stored_section_opcodes = section_opcodes(
+            prepared,
+            lines,
+            self.get_sections(),
+            cache=self.stored_section_opcodes,  # type: ignore
+        )
+        self.stored_diff = render_unified_diff(
+            prepared.lines,
+            lines,
+            opcodes,
+            fromfile="teacher template",
+            tofile="student submission",
+            n=3,
+        )
+        self.stored_diff_template_hash = template_hash
+        self.stored_diff_submission_hash = submission_hash
+        if self.pk is not None:
+            # not `save`, which would bump `last_updated`
+            AssignmentSubmission.objects.filter(pk=self.pk).update(
+                stored_diff=self.stored_diff,
+                stored_diff_template_hash=template_hash,
+                stored_diff_submission_hash=submission_hash,
+                stored_section_opcodes=self.stored_section_opcodes,
             )
+        return self.stored_diff
+
+    @property
+    def diff_ops(self) -> list[list]:
+        """The same diff as `diff`, as compact opcodes to be applied to the
+        lines of the teacher template; see `grader.diff.compact_opcodes`."""
+        # brings `stored_section_opcodes` up to date
+        diff = self.diff
+        if not self.submission:
+            return [["+", diff]]
+
+        assert self.teacher_template
+        prepared = get_prepared_template(self.teacher_template)
+        lines = self.submission.split("\n")  # type: ignore
+        opcodes, _ = section_opcodes(
+            prepared,
+            lines,
+            self.get_sections(),
+            cache=self.stored_section_opcodes,  # type: ignore
         )
+        return compact_opcodes(opcodes, prepared.lines, lines)
+
+    def section_diff(self, name: str) -> list[str]:
+        """Like `diff`, but only for the attachment called `name`, with line
+        numbers counted from its header. Raises KeyError if there is no such
+        attachment."""
+        if not self.diff_is_stored:
+            self.diff
+        assert self.teacher_template
+        return section_diff(
+            get_prepared_template(self.teacher_template),
+            self.submission.split("\n"),  # type: ignore
+            self.get_sections(),
+            name,
+            cache=self.stored_section_opcodes,  # type: ignore
+            fromfile="teacher template",
+            tofile="student submission",
+            n=3,
+        )
+
+
+class SimilarityBucket(models.Model):
+    """The LSH index of submission signatures: submissions in the same course
+    with the same `key` in the same `band` are candidate near-duplicates. See
+    `grader.similarity`."""
+
+    course = models.ForeignKey(CourseModel, on_delete=models.CASCADE)
+    submission = models.ForeignKey(
+        AssignmentSubmission,
+        related_name="similarity_buckets",
+        on_delete=models.CASCADE,
+    )
+    band = models.PositiveSmallIntegerField()
+    key = models.BigIntegerField()
+
+    class Meta:
+        indexes = [models.Index(fields=["course", "key"])]
+
+    def __str__(self):
+        return f"{self.submission} band {self.band}"
+
+
+class BackgroundJob(models.Model):
+    """A unit of work for the `run_worker` management command. Jobs are
+    stored in the database, so that no message broker is needed; see
+    `grader.jobs`."""
+
+    class Kind(models.TextChoices):
+        REFRESH_SUBMISSION = "refresh_submission", _("REFRESH_SUBMISSION")
+        DIFF_SESSION = "diff_session", _("DIFF_SESSION")
+
+    class State(models.TextChoices):
+        PENDING = "P", _("PENDING")
+        RUNNING = "R", _("RUNNING")
+        DONE = "D", _("DONE")
+        FAILED = "F", _("FAILED")
+
+    kind = models.CharField(max_length=50, choices=Kind.choices)
+    payload = models.JSONField(default=dict)
+    state = models.CharField(max_length=2, choices=State.choices, default=State.PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    error = models.TextField(blank=True)
+
+    created = models.DateTimeField(auto_now_add=True)
+    last_updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["state", "created"])]
+
+    def __str__(self):
+        return f"{self.kind} ({self.get_state_display()})"  # type: ignore
@@ -14,13 +14,21 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import logging
+import re
+from itertools import islice
+from typing import Iterable, Iterator, Union
 
 from django.core.exceptions import ValidationError
 from rest_framework import serializers
+from rest_framework.exceptions import NotFound, ParseError
+from rest_framework.utils.encoders import JSONEncoder
 
 from grader.services import update_submission
 
-from .models import GradingSession, AssignmentSubmission
+from .common_lines import flag_common_lines
+from .diff import get_prepared_template
+from .models import GradingSession, AssignmentSubmission, TeacherTemplate
+from .utils import iter_lines, stream_json
 
 
 logger = logging.getLogger(__name__)
@@ -31,6 +39,9 @@ class AssignmentSubmissionSerializer(serializers.ModelSerializer):
     causing API calls due to self-updating behavior. Never use this serializer
     in a `many` context."""
 
+    # stored in a blob; see `AssignmentSubmission.submission`
+    submission = serializers.CharField(required=False)
+
     class Meta:
         model = AssignmentSubmission
         fields = (
@@ -41,7 +52,9 @@ class AssignmentSubmissionSerializer(serializers.ModelSerializer):
             "submission",
             "student_name",
             "grade",
+            "grade_version",
         )
+        read_only_fields = ("grade_version",)
 
     def validate_submission(self, data):
         if isinstance(data, list):
@@ -52,28 +65,120 @@ class AssignmentSubmissionSerializer(serializers.ModelSerializer):
         return data
 
     def to_representation(self, instance):
+        ret, content, _ = self.represent(instance)
+        ret["submission"] = list(content)
+        return ret
+
+    def to_streaming_representation(self, instance) -> Iterator[str]:
+        """JSON chunks of the representation, where the content is streamed
+        instead of being built up in memory. Only the content lines in the
+        `lines=<start>-<stop>` query param are included; either end may be
+        left out."""
+        ret, content, total = self.represent(instance)
+        request = self.context.get("request")
+        start, stop = parse_line_range(
+            request and request.query_params.get("lines"), total=total
+        )
+        ret["lines"] = [start, stop]
+        ret["total_lines"] = total
+        if "common_lines" in ret:
+            ret["common_lines"] = [i for i in ret["common_lines"] if start <= i < stop]
+        return stream_json(
+            ret, "submission", islice(content, start, stop), encoder=JSONEncoder
+        )
+
+    def represent(self, instance) -> tuple[dict, Iterable, int]:
+        """The representation without its content, the content as an
+        iterable of lines (or opcodes), and the number of lines."""
         if instance:
             # this is very slow. should this be in the serializer? should it be
             # in this # method? not sure...
             update_submission(submission=instance)
         ret = super().to_representation(instance)
-
-        # when diff is requested by query param, render the diff
-        if (request := self.context.get("request")) and (
-            request.query_params.get("diff") == "true"
-        ):
-            ret["submission"] = instance.diff
+        submission = ret.pop("submission")
+
+        request = self.context.get("request")
+        diff_mode = request and request.query_params.get("diff")
+
+        # `diff=ops` renders the diff as compact opcodes against the lines of
+        # the teacher template, which clients fetch once per template from
+        # TeacherTemplateViewSet
+        if diff_mode == "ops":
+            content = instance.diff_ops
+            ret["teacher_template"] = instance.teacher_template.pk
+            ret["teacher_template_hash"] = instance.teacher_template.get_content_hash()
+
+        # when diff is requested by query param, render the diff. It can be
+        # narrowed down to one attachment with `section=<attachment name>`.
+        # `common_lines` are the indices of added lines that most of the
+        # class also has
+        elif diff_mode == "true":
+            if (section := request.query_params.get("section")) is not None:
+                try:
+                    content = instance.section_diff(section)
+                except KeyError:
+                    raise NotFound(f"no attachment named {section}") from None
+            else:
+                content = instance.diff
+            ret["common_lines"] = flag_common_lines(
+                content, instance.assignment.common_line_hashes
+            )
+            ret["sections"] = [s.name for s in instance.get_sections() if s.name]
 
         # otherwise, just normalize the submission by breaking it into a list
-        # of strings
+        # of strings, lazily
         else:
-            # split up into an array of strings
-            ret["submission"] = ret["submission"].split("\n")
+            return ret, iter_lines(submission), submission.count("\n") + 1
+
+        return ret, content, len(content)
+
+
+def parse_line_range(value: Union[str, None], *, total: int) -> tuple[int, int]:
+    """Parse `<start>-<stop>` into a half-open range of line numbers, clamped
+    to `total`. Either end may be left out, and so may the whole range."""
+    if not value:
+        return 0, total
+    if not (match := re.fullmatch(r"(\d*)-(\d*)", value)):
+        raise ParseError(f"lines must look like <start>-<stop>, not {value}")
+    start, stop = (int(g) if g else None for g in match.groups())
+    start = min(start or 0, total)
+    stop = total if stop is None else min(stop, total)
+    if stop < start:
+        raise ParseError(f"lines {value} end before they start")
+    return start, stop
+
+
+class GradeUpdateListSerializer(serializers.ListSerializer):
+    def validate(self, attrs):
+        pks = [a["pk"] for a in attrs]
+        if len(set(pks)) != len(pks):
+            raise serializers.ValidationError("each submission can appear only once")
+        return attrs
 
-        return ret
+
+class GradeUpdateSerializer(serializers.Serializer):
+    """One item of a bulk grade update; see `services.update_grades`."""
+
+    pk = serializers.IntegerField()
+    grade = serializers.IntegerField(allow_null=True)
+    grade_version = serializers.IntegerField(min_value=0)
+
+    class Meta:
+        list_serializer_class = GradeUpdateListSerializer
 
 
 class ContentlessAssignmentSubmissionSerializer(serializers.ModelSerializer):
+    # the model fields behind `Meta.fields`, for
+    # `GradingSessionQuerySet.prefetch_active_submissions`
+    model_fields = (
+        "api_student_profile_id",
+        "api_student_submission_id",
+        "_profile_photo_url",
+        "student_name",
+        "grade",
+        "grade_version",
+    )
+
     class Meta:
         model = AssignmentSubmission
         fields = (
@@ -83,10 +188,15 @@ class ContentlessAssignmentSubmissionSerializer(serializers.ModelSerializer):
             "profile_photo_url",
             "student_name",
             "grade",
+            "grade_version",
         )
 
 
 class GradingSessionSerializer(serializers.ModelSerializer):
+    submissions = serializers.PrimaryKeyRelatedField(
+        many=True, read_only=True, source="get_active_submissions"
+    )
+
     class Meta:
         model = GradingSession
         fields = (
@@ -97,9 +207,19 @@ class GradingSessionSerializer(serializers.ModelSerializer):
             "teacher_template",
             "submissions",
             "average_grade",
+            "graded_count",
+            "grade_min",
+            "grade_max",
+            "grade_histogram",
             "google_classroom_detail_view_url",
             "sync_state",
         )
+        read_only_fields = (
+            "graded_count",
+            "grade_min",
+            "grade_max",
+            "grade_histogram",
+        )
 
 
 class DeepGradingSessionSerializer(GradingSessionSerializer):
@@ -110,4 +230,21 @@ class DeepGradingSessionSerializer(GradingSessionSerializer):
     and should therefore always be fetched just one submission at a time.
     """
 
-    submissions = ContentlessAssignmentSubmissionSerializer(many=True)
+    submissions = ContentlessAssignmentSubmissionSerializer(
+        many=True, read_only=True, source="get_active_submissions"
+    )
+
+
+class TeacherTemplateSerializer(serializers.ModelSerializer):
+    """The lines of a template, which `diff=ops` submission diffs refer to
+    by index."""
+
+    content_hash = serializers.CharField(source="get_content_hash")
+    lines = serializers.SerializerMethodField()
+
+    class Meta:
+        model = TeacherTemplate
+        fields = ("pk", "content_hash", "lines")
+
+    def get_lines(self, instance):
+        return get_prepared_template(instance).lines
@@ -14,21 +14,45 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import contextvars
 import json
 import logging
+import threading
 
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from typing import Union, Tuple
 
-from allauth.socialaccount.models import SocialToken
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.db import connections, transaction
+from django.db.models import Sum
 from django.http.response import Http404
-from django.conf import settings
-from googleapiclient.discovery import build
-from google.oauth2.credentials import Credentials
+from django.utils import timezone
 from googleapiclient.errors import HttpError as GoogClientHttpError
 
-from .models import AssignmentSubmission, CourseModel, GradingSession, TeacherTemplate
+from .common_lines import find_common_lines
+from .diff import get_prepared_template, section_starts
+from .google_api import (
+    build_service,
+    execute,
+    execute_batch,
+    get_credentials,
+    new_http,
+)
+from .jobs import enqueue_session_diff, enqueue_submission_refreshes
+from .models import (
+    AssignmentSubmission,
+    ContentBlob,
+    CourseModel,
+    CourseStudent,
+    DriveExport,
+    GradingSession,
+    SimilarityBucket,
+    TeacherTemplate,
+)
+from .similarity import cluster, group_buckets
+from .utils import content_hash
 
 
 # TODO: refactor this into smaller modules by factoring out:
@@ -36,31 +60,33 @@ from .models import AssignmentSubmission, CourseModel, GradingSession, TeacherTe
 # - google api adapter
 
 
-GOOGLE_CLIENT_ID = settings.SOCIALACCOUNT_PROVIDERS["google"]["APP"]["client_id"]
-GOOGLE_CLIENT_SECRET = settings.SOCIALACCOUNT_PROVIDERS["google"]["APP"]["secret"]
-
-
 logger = logging.getLogger(__name__)
 
 
-def _get_google_api_service(*, user: User, service: str, version: str):
-    qs = SocialToken.objects.filter(
-        account__user=user,
-        account__provider="google",
-    )
+# the classroom api returns at most this many items per page
+CLASSROOM_MAX_PAGE_SIZE = 1000
 
-    token = qs.order_by("-expires_at").first()
-    assert token
+# partial response masks for each classroom resource, naming only the fields
+# that we actually read. Full resources are many times larger; see
+# https://developers.google.com/classroom/guides/performance#partial
+COURSE_FIELDS = "id,name,teacherFolder/id"
+STUDENT_FIELDS = "userId,profile(name/fullName,photoUrl)"
+COURSEWORK_FIELDS = (
+    "id,title,alternateLink,maxPoints,materials/driveFile/driveFile(id,title)"
+)
+COURSEWORK_LIST_FIELDS = (
+    "nextPageToken,courseWork(id,title,materials/driveFile/shareMode)"
+)
+SUBMISSION_SUMMARY_FIELDS = "id,userId,state,updateTime,assignedGrade,draftGrade"
+SUBMISSION_FIELDS = (
+    f"{SUBMISSION_SUMMARY_FIELDS},assignmentSubmission/attachments/driveFile(id,title)"
+)
 
-    credentials = Credentials(
-        token=token.token,
-        refresh_token=token.token_secret,
-        token_uri="https://oauth2.googleapis.com/token",
-        client_id=GOOGLE_CLIENT_ID,
-        client_secret=GOOGLE_CLIENT_SECRET,
-    )
 
-    return build(service, version, credentials=credentials)
+def _get_google_api_service(*, user: User, service: str, version: str):
+    return build_service(
+        service=service, version=version, credentials=get_credentials(user=user)
+    )
 
 
 def get_google_classroom_service(*, user: User):
@@ -90,9 +116,14 @@ def get_course(*, user: User, course_id: str) -> dict:
     """Return the top-level course object from the classroom api, documented
     here
     https://googleapis.github.io/google-api-python-client/docs/dyn/classroom_v1.courses.html
+
+    Only the fields in `COURSE_FIELDS` are included.
     """
     service = get_google_classroom_service(user=user)
-    response = service.courses().get(id=course_id).execute()  # type: ignore
+    response = execute(
+        service.courses().get(id=course_id, fields=COURSE_FIELDS),  # type: ignore
+        user=user,
+    )
     return response
 
 
@@ -101,28 +132,124 @@ class StudentResource(APIItem):
     photo_url: str
 
 
+def _to_student_resource(student: dict) -> StudentResource:
+    return StudentResource(
+        id_=student["userId"],
+        name=student["profile"]["name"]["fullName"],
+        photo_url=student["profile"].get("photoUrl", ""),
+    )
+
+
 def get_student_data(
     *, user: User, course_id: str, student_id: str, service=None
 ) -> StudentResource:
-    """We are going to ignore paging here and just get 200 students. If anyone
-    is grading more than 200 assignments in one session, they are just too
-    hardcore for us."""
+    """Fetch a single student's profile. Prefer the course roster, see
+    `sync_course_roster`, which gets every student in a few requests."""
     if not service:
         service = get_google_classroom_service(user=user)
-    student = (
+    student = execute(
         service.courses()  # type: ignore
         .students()
         .get(  # type: ignore
             courseId=course_id,
             userId=student_id,
-        )
-        .execute()
+            fields=STUDENT_FIELDS,
+        ),
+        user=user,
     )
-    return StudentResource(
-        id_=student_id,
-        name=student["profile"]["name"]["fullName"],
-        photo_url=student["profile"].get("photoUrl", ""),
+    return _to_student_resource(student)
+
+
+def sync_course_roster(*, course: CourseModel, force: bool = False) -> bool:
+    """Page through every student on the course roster, and store them as
+    `CourseStudent`s. Unless `force` is set, nothing is fetched if the roster
+    was synced within `settings.GOOGLE_ROSTER_TTL`. Returns whether a sync
+    happened."""
+    if not force and not course.roster_needs_update:
+        return False
+
+    service = get_google_classroom_service(user=course.owner)
+    students: dict[str, StudentResource] = {}
+    page_token = None
+    while True:
+        res = execute(
+            service.courses()  # type: ignore
+            .students()
+            .list(
+                courseId=course.api_course_id,
+                pageSize=CLASSROOM_MAX_PAGE_SIZE,
+                pageToken=page_token,
+                fields=f"nextPageToken,students({STUDENT_FIELDS})",
+            ),
+            user=course.owner,
+        )
+        for student in res.get("students", []):
+            resource = _to_student_resource(student)
+            students[resource.id_] = resource
+        if (page_token := res.get("nextPageToken")) is None:
+            break
+
+    with transaction.atomic():
+        existing = {s.api_student_profile_id: s for s in course.students.all()}  # type: ignore
+        CourseStudent.objects.filter(
+            pk__in=[s.pk for id_, s in existing.items() if id_ not in students]
+        ).delete()
+        to_update = []
+        to_create = []
+        for id_, student in students.items():
+            if (row := existing.get(id_)) is not None:
+                row.name = student.name
+                row.photo_url = student.photo_url
+                to_update.append(row)
+            else:
+                to_create.append(
+                    CourseStudent(
+                        course=course,
+                        api_student_profile_id=id_,
+                        name=student.name,
+                        photo_url=student.photo_url,
+                    )
+                )
+        CourseStudent.objects.bulk_update(to_update, ["name", "photo_url"])
+        CourseStudent.objects.bulk_create(to_create)
+        course.roster_last_synced = timezone.now()
+        course.save(update_fields=["roster_last_synced"])
+
+    return True
+
+
+def get_roster(*, course: CourseModel) -> dict[str, StudentResource]:
+    """Mapping of student profile ids to the students on the course roster,
+    which is synced first if it is out of date."""
+    sync_course_roster(course=course)
+    return {
+        s.api_student_profile_id: StudentResource(
+            id_=s.api_student_profile_id, name=s.name, photo_url=s.photo_url
+        )
+        for s in CourseStudent.objects.filter(course=course)
+    }
+
+
+def apply_roster(session: GradingSession) -> int:
+    """Fill in the name and photo of every submission in the session from
+    the course roster, in a single query. Returns the number of submissions
+    updated."""
+    roster = get_roster(course=session.course)
+    changed = []
+    for submission in session.submissions.defer("stored_diff", "stored_section_opcodes"):  # type: ignore
+        if (student := roster.get(submission.api_student_profile_id)) is None:
+            continue
+        if (submission.student_name, submission._profile_photo_url) != (
+            student.name,
+            student.photo_url,
+        ):
+            submission.student_name = student.name
+            submission._profile_photo_url = student.photo_url
+            changed.append(submission)
+    AssignmentSubmission.objects.bulk_update(
+        changed, ["student_name", "_profile_photo_url"]
     )
+    return len(changed)
 
 
 def list_all_class_names(
@@ -132,7 +259,15 @@ def list_all_class_names(
     service = get_google_classroom_service(user=user)
 
     # fetch data
-    res = service.courses().list(courseStates="ACTIVE", pageSize=30, pageToken=page_token).execute()  # type: ignore
+    res = execute(
+        service.courses().list(  # type: ignore
+            courseStates="ACTIVE",
+            pageSize=CLASSROOM_MAX_PAGE_SIZE,
+            pageToken=page_token,
+            fields=f"nextPageToken,courses({COURSE_FIELDS})",
+        ),
+        user=user,
+    )
     result = res.get("courses")
 
     # validate response
@@ -183,11 +318,17 @@ def list_all_assignment_names(
     service = get_google_classroom_service(user=user)
 
     # fetch data
-    response = (
+    response = execute(
         service.courses()  # type: ignore
         .courseWork()
-        .list(pageSize=30, pageToken=page_token, courseId=course.id_, orderBy="dueDate")
-        .execute()
+        .list(
+            pageSize=CLASSROOM_MAX_PAGE_SIZE,
+            pageToken=page_token,
+            courseId=course.id_,
+            orderBy="dueDate",
+            fields=COURSEWORK_LIST_FIELDS,
+        ),
+        user=user,
     )
     data = response.get("courseWork")
 
@@ -211,8 +352,8 @@ def download_drive_file_as(*, user: User, id_: str, mime_type: str) -> str:
     """
 
     service = _get_google_api_service(user=user, service="drive", version="v3")
-    return (
-        service.files().export(fileId=id_, mimeType=mime_type).execute()  # type: ignore
+    return execute(
+        service.files().export(fileId=id_, mimeType=mime_type), user=user  # type: ignore
     )
 
 
@@ -250,13 +391,84 @@ class ConcatOutput:
         return out
 
 
+def evict_drive_exports(*, max_bytes: Union[int, None] = None) -> int:
+    """Delete the least recently used cached exports until the cache fits in
+    `max_bytes`, by default `settings.DRIVE_EXPORT_CACHE_MAX_BYTES`. Returns
+    the number of exports evicted."""
+    max_bytes = (
+        settings.DRIVE_EXPORT_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    )
+    excess = (
+        DriveExport.objects.aggregate(total=Sum("size"))["total"] or 0
+    ) - max_bytes
+    if excess <= 0:
+        return 0
+
+    evict = []
+    for pk, size in DriveExport.objects.order_by("last_used").values_list("pk", "size"):
+        evict.append(pk)
+        excess -= size
+        if excess <= 0:
+            break
+    DriveExport.objects.filter(pk__in=evict).delete()
+    return len(evict)
+
+
+def _get_file_versions(
+    service, attachments: list[DriveAttachment], *, user: User
+) -> dict[str, dict]:
+    """Fetch the metadata that tells us whether each file has changed, in as
+    few requests as possible. Files whose metadata could not be fetched are
+    left out."""
+    results = execute_batch(
+        service=service,
+        requests={
+            a.id_: service.files().get(fileId=a.id_, fields="id,version,modifiedTime")  # type: ignore
+            for a in attachments
+            if a.id_
+        },
+        user=user,
+    )
+    return {id_: r for id_, r in results.items() if not isinstance(r, Exception)}
+
+
+def _store_exports(exports: dict[str, str], versions: dict[str, dict]):
+    now = timezone.now()
+    existing = {e.file_id: e for e in DriveExport.objects.filter(file_id__in=exports)}
+    to_create = []
+    for file_id, text in exports.items():
+        row = existing.get(file_id) or DriveExport(file_id=file_id)
+        row.version = versions[file_id]["version"]
+        row.modified_time = versions[file_id].get("modifiedTime", "")
+        row.content = text
+        row.size = len(text.encode("utf8"))
+        row.last_used = now
+        if row.pk is None:
+            to_create.append(row)
+    DriveExport.objects.bulk_update(
+        existing.values(), ["version", "modified_time", "content", "size", "last_used"]
+    )
+    # another worker may have cached the same file in the meantime
+    DriveExport.objects.bulk_create(to_create, ignore_conflicts=True)
+    evict_drive_exports()
+
+
 def concatenate_attachments(
-    *, user: User, attachments: list[DriveAttachment]
+    *,
+    user: User,
+    attachments: list[DriveAttachment],
+    max_workers: Union[int, None] = None,
 ) -> ConcatOutput:
     """Download each attachment as plain text and concatenate them together,
     returning a ConcatOutput object. Outputted files are sorted in alphabetical
     order by filename.
 
+    Exports are cached (see `DriveExport`), and files that have not changed
+    since they were last exported are not exported again. Exports are slow,
+    so up to `max_workers` of them run at once; by default,
+    `settings.GOOGLE_DRIVE_EXPORT_CONCURRENCY`. The output is in the same
+    order as `attachments` regardless.
+
     Note:
         An object is returned because we can separate the header, which
         includes the name of the document, from the content body. This is
@@ -265,24 +477,31 @@ def concatenate_attachments(
         of diffing.
     """
     service = _get_google_api_service(user=user, service="drive", version="v3")
-    output: list[StringifiedAttachment] = []
+    max_workers = max_workers or settings.GOOGLE_DRIVE_EXPORT_CONCURRENCY
 
-    for a in attachments:
-        # header
-        if a.name is not None:
-            header = [a.name, "=" * len(a.name)]
-        else:
-            header = ["No Name", "======="]
+    versions = _get_file_versions(service, attachments, user=user)
+    texts: dict[str, Union[str, None]] = {}
+    for cached in DriveExport.objects.filter(file_id__in=versions):
+        if cached.version == versions[cached.file_id].get("version"):
+            texts[cached.file_id] = cached.content
+    DriveExport.objects.filter(file_id__in=texts).update(last_used=timezone.now())
+
+    # each worker thread gets its own transport
+    thread_state = threading.local()
+
+    def export(a: DriveAttachment) -> Union[str, None]:
+        """Returns the exported text, or None if the file cannot be exported."""
         try:
-            data = (
-                service.files()  # type: ignore
-                .export(fileId=a.id_, mimeType="text/plain")  # type: ignore
-                .execute()
+            if not hasattr(thread_state, "http"):
+                thread_state.http = new_http(service)
+            data = execute(
+                service.files().export(fileId=a.id_, mimeType="text/plain"),  # type: ignore
+                user=user,
+                http=thread_state.http,
             )
             # localization/internationalization: this may become an issue if
             # utf8 is not the encoding in all locales
-            content = [l.strip() for l in str(data, "utf8").split("\n") if l]
-            output.append(StringifiedAttachment(header, content))
+            return str(data, "utf8")
 
         except GoogClientHttpError as e:
             messages = [e["message"] for e in json.loads(e.content).get("errors", [])]
@@ -294,6 +513,53 @@ def concatenate_attachments(
             else:
                 logger.error("Unexpected condition prevented file export")
                 logger.exception(e)
+            return None
+
+    def export_in_pool(a: DriveAttachment) -> Union[str, None]:
+        try:
+            return export(a)
+        finally:
+            # refreshing the user's credentials goes through the ORM, which
+            # opens a connection per thread; close it, or each pool thread
+            # leaks one
+            connections.close_all()
+
+    to_export = [a for a in attachments if a.id_ not in texts]
+    if max_workers == 1 or len(to_export) <= 1:
+        exported = [export(a) for a in to_export]
+    else:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(to_export))) as pool:
+            # run each export in a copy of our context, so that it keeps the
+            # caller's api priority (see `google_api.background_priority`)
+            futures = [
+                pool.submit(contextvars.copy_context().run, export_in_pool, a)
+                for a in to_export
+            ]
+            exported = [f.result() for f in futures]
+    for a, text in zip(to_export, exported):
+        texts[a.id_] = text
+
+    _store_exports(
+        {
+            a.id_: text
+            for a, text in zip(to_export, exported)
+            if text is not None and a.id_ in versions
+        },
+        versions,
+    )
+
+    output: list[StringifiedAttachment] = []
+    for a in attachments:
+        # header
+        if a.name is not None:
+            header = [a.name, "=" * len(a.name)]
+        else:
+            header = ["No Name", "======="]
+
+        if (text := texts[a.id_]) is not None:
+            content = [l.strip() for l in text.split("\n") if l]
+            output.append(StringifiedAttachment(header, content))
+        else:
             output.append(
                 StringifiedAttachment(
                     header,
@@ -307,23 +573,35 @@ def concatenate_attachments(
     return ConcatOutput(output)
 
 
-def _update_teacher_template(
-    user: User,
-    course_id: str,
-    assignment_id: str,
-    template: Union[TeacherTemplate, None],
-) -> Tuple[TeacherTemplate, bool]:
-    """Returns a boolean indicating whether the template was created."""
-    service = get_google_classroom_service(user=user)
-    assignment_data = (
+def _get_assignment_request(service, *, course_id: str, assignment_id: str):
+    return (
         service.courses()  # type: ignore
         .courseWork()
         .get(  # type: ignore
             courseId=course_id,
             id=assignment_id,
+            fields=COURSEWORK_FIELDS,
         )
-        .execute()
     )
+
+
+def _export_template_content(
+    user: User,
+    course_id: str,
+    assignment_id: str,
+    assignment_data: Union[dict, None] = None,
+) -> str:
+    """Export and concatenate the teacher's attachments. The courseWork
+    resource is fetched unless the caller already has it, and passes it in
+    as `assignment_data`."""
+    if assignment_data is None:
+        service = get_google_classroom_service(user=user)
+        assignment_data = execute(
+            _get_assignment_request(
+                service, course_id=course_id, assignment_id=assignment_id
+            ),
+            user=user,
+        )
     attachments = [
         DriveAttachment(
             id_=i.get("driveFile", {}).get("driveFile", {}).get("id"),
@@ -338,64 +616,77 @@ def _update_teacher_template(
         raise ValueError("assignment does not contain any teacher attachments")
 
     template_content = concatenate_attachments(user=user, attachments=attachments)
-
-    was_created = False
-    if template is not None:
-        stringified = "\n".join(template_content.combine_content())
-        if stringified != template.content:
-            template.content = stringified
-            template.save()
-    else:
-        was_created = True
-        template = TeacherTemplate.objects.create(
-            content="\n".join(template_content.combine_content())
+    return "\n".join(template_content.combine_content())
+
+
+def get_session_template(
+    session: GradingSession,
+    *,
+    force_update: bool = False,
+    assignment_data: Union[dict, None] = None,
+) -> TeacherTemplate:
+    """The template shared by every submission in the session, created or
+    updated if it is stale.
+
+    The teacher's attachments are exported before taking a lock on the
+    session, so that the slow Drive export does not hold a transaction open.
+    The template is then written under the lock, so that concurrent
+    refreshes of the same session share one template instead of each
+    creating their own."""
+    current = GradingSession.objects.select_related("course__owner", "template").get(
+        pk=session.pk
+    )
+    template = current.template
+    if not (template is None or force_update or template.needs_update):
+        session.template = template
+        return template
+
+    content = _export_template_content(
+        current.course.owner,
+        current.course.api_course_id,
+        current.api_assignment_id,
+        assignment_data=assignment_data,
+    )
+    with transaction.atomic():
+        locked = (
+            GradingSession.objects.select_for_update()
+            .select_related("template")
+            .only("template")
+            .get(pk=session.pk)
         )
-    return template, was_created
+        # another refresh may have written the template while we were
+        # exporting, in which case this is usually a no-op
+        template = locked.template
+        if template is None:
+            template = TeacherTemplate.objects.create(content=content)
+            locked.template = template
+            locked.save(update_fields=["template"])
+        elif template.get_content_hash() != content_hash(content):
+            template.content = content
+            template.save()
+            # the diffs and similarity signatures are now out of date
+            enqueue_session_diff(locked)
+    session.template = template
+    return template
 
 
 def parse_order(template_content: str):
     """Given a teacher template already combined into a single string by
     ConcatOutput.combine_content(), parse the headers back out."""
     lines = template_content.split("\n")
-    headers = []
-    for i, l in enumerate(lines):
-        if "===" in l:
-            try:
-                headers.append(lines[i - 1])
-            except IndexError:
-                pass
-    return [h.strip() for h in headers]
+    return [lines[i].strip() for i in section_starts(lines)]
 
 
 def _update_submission(
-    user: User, submission: AssignmentSubmission
+    user: User,
+    submission: AssignmentSubmission,
+    submission_data: dict,
+    student_data: StudentResource,
 ) -> AssignmentSubmission:
+    """Apply the studentSubmission and student resources fetched from the
+    Classroom API to `submission`, and download its attachments."""
     assert submission.teacher_template
 
-    # pull repetitively used values out of the submission
-    course_id = submission.assignment.course.api_course_id  # type: ignore
-    assignment_id = submission.assignment.api_assignment_id  # type: ignore
-
-    # get submission from Classroom API
-    service = get_google_classroom_service(user=user)
-    submission_data = (
-        service.courses()  # type: ignore
-        .courseWork()
-        .studentSubmissions()
-        .get(  # type: ignore
-            courseId=course_id,
-            courseWorkId=assignment_id,
-            id=submission.api_student_submission_id,
-        )
-        .execute()
-    )
-    student_data = get_student_data(
-        user=user,
-        course_id=course_id,
-        student_id=submission_data["userId"],
-        service=service,
-    )
-
     # update top-level submission fields
     submission.student_name = student_data.name
     submission._profile_photo_url = student_data.photo_url
@@ -419,7 +710,7 @@ def _update_submission(
     #
     # >>> assert teacher_attachment_name in student_submission_name
 
-    template_item_order = parse_order(submission.teacher_template.content)
+    template_item_order = get_prepared_template(submission.teacher_template).headers
     attachments = submission_data.get("assignmentSubmission", {}).get("attachments", {})
     ordered_student_attachments = []
     for teacher_item in template_item_order:
@@ -438,40 +729,124 @@ def _update_submission(
         user=user, attachments=ordered_student_attachments
     )
 
-    # update models
-    if content != submission.submission:
-        submission.submission = "\n".join(content.combine_content())
-        submission.save()
+    # update models; unchanged content is not written again
+    text = "\n".join(content.combine_content())
+    if content_hash(text) != submission.get_submission_hash():
+        submission.submission = text
+    submission.save()
     return submission
 
 
+def update_submissions(
+    *, submissions: list[AssignmentSubmission], force_update: bool = False
+) -> list[AssignmentSubmission]:
+    """Update the content of many submissions from the same GradingSession,
+    along with their teacher template. Like `update_submission`, only items
+    that are out of date are updated unless `force_update` is True.
+
+    Student names and photos come from the course roster. The other Classroom
+    API reads (the courseWork, each studentSubmission, and the profiles of
+    students who are no longer on the roster) are grouped into as few batch
+    requests as possible.
+    If individual reads fail, the other submissions are still updated before
+    the first failure is raised."""
+    if not submissions:
+        return submissions
+
+    session = submissions[0].assignment
+    assert all(s.assignment_id == session.pk for s in submissions)
+    user = session.course.owner
+    course_id = session.course.api_course_id
+
+    template_is_stale = (
+        force_update or session.template is None or session.template.needs_update
+    )
+    stale_submissions = [
+        s
+        for s in submissions
+        if force_update or not s.teacher_template_id or s.needs_update  # type: ignore
+    ]
+    if not template_is_stale and not stale_submissions:
+        return submissions
+
+    roster = get_roster(course=session.course) if stale_submissions else {}
+
+    service = get_google_classroom_service(user=user)
+    requests = {}
+    if template_is_stale:
+        requests["assignment"] = _get_assignment_request(
+            service, course_id=course_id, assignment_id=session.api_assignment_id
+        )
+    for s in stale_submissions:
+        requests[f"submission-{s.pk}"] = (
+            service.courses()  # type: ignore
+            .courseWork()
+            .studentSubmissions()
+            .get(  # type: ignore
+                courseId=course_id,
+                courseWorkId=session.api_assignment_id,
+                id=s.api_student_submission_id,
+                fields=SUBMISSION_FIELDS,
+            )
+        )
+        # students who have left the course are not on the roster
+        if s.api_student_profile_id not in roster:
+            requests[f"student-{s.api_student_profile_id}"] = (
+                service.courses()  # type: ignore
+                .students()
+                .get(  # type: ignore
+                    courseId=course_id,
+                    userId=s.api_student_profile_id,
+                    fields=STUDENT_FIELDS,
+                )
+            )
+    if not requests:
+        return submissions
+
+    results = execute_batch(service=service, requests=requests, user=user)
+
+    if template_is_stale:
+        if isinstance(assignment_data := results["assignment"], Exception):
+            raise assignment_data
+        get_session_template(
+            session, force_update=force_update, assignment_data=assignment_data
+        )
+
+    # every submission shares the session's template
+    for s in submissions:
+        if s.teacher_template_id != session.template_id:  # type: ignore
+            s.teacher_template = session.template
+            s.save()
+
+    errors = []
+    for s in stale_submissions:
+        submission_data = results[f"submission-{s.pk}"]
+        student = roster.get(s.api_student_profile_id) or results.get(
+            f"student-{s.api_student_profile_id}"
+        )
+        if error := next(
+            (r for r in (submission_data, student) if isinstance(r, Exception)), None
+        ):
+            logger.error("failed to fetch submission %s from classroom api", s.pk)
+            errors.append(error)
+            continue
+        if isinstance(student, dict):
+            student = _to_student_resource(student)
+        _update_submission(user, s, submission_data, student)
+
+    if errors:
+        raise errors[0]
+
+    return submissions
+
+
 def update_submission(
     *, submission: AssignmentSubmission, force_update: bool = False
 ) -> AssignmentSubmission:
     """Update the content of the submission and the teacher template. By
     default, only update items that are more than one day old, unless the
     `force_update` parameter is set to True."""
-    user = submission.assignment.course.owner
-
-    if (
-        force_update
-        or not submission.teacher_template
-        or submission.teacher_template.needs_update
-    ):
-        template, was_created = _update_teacher_template(
-            user,
-            submission.assignment.course.api_course_id,
-            submission.assignment.api_assignment_id,
-            submission.teacher_template,
-        )
-        if was_created:
-            submission.teacher_template = template
-            submission.save()
-
-    if force_update or submission.needs_update:
-        submission = _update_submission(user, submission)
-
-    return submission
+    return update_submissions(submissions=[submission], force_update=force_update)[0]
 
 
 def _list_assignment_submissions(session: GradingSession) -> list:
@@ -483,16 +858,18 @@ def _list_assignment_submissions(session: GradingSession) -> list:
     ret = []
     page_token = None
     while True:
-        res = (
+        res = execute(
             service.courses()  # type: ignore
             .courseWork()
             .studentSubmissions()
             .list(
                 courseId=session.course.api_course_id,
                 courseWorkId=session.api_assignment_id,
+                pageSize=CLASSROOM_MAX_PAGE_SIZE,
                 pageToken=page_token,
-            )
-            .execute()
+                fields=f"nextPageToken,studentSubmissions({SUBMISSION_SUMMARY_FIELDS})",
+            ),
+            user=session.course.owner,
         )
         ret += res["studentSubmissions"]
         if (page_token := res.get("nextPageToken")) is None:
@@ -501,38 +878,270 @@ def _list_assignment_submissions(session: GradingSession) -> list:
     return ret
 
 
-def overwrite_submissions_using_api_data(session: GradingSession):
-    """Delete all AssignmentSubmission objects for a session, and use the
-    response from the courses.courseWork Classroom API endpoint to make new
-    ones. This service is used on GradingSession creation, and also could
-    be helpful for "syncing" an assignment with Google Classroom.
-
-    Note:
-        submission content and student profile information are lost in this
-        operation, and will be lazily re-fetched in a future operation when
-        needed. This obviously has a hidden downstream cost.
-
-        this also causes comments to be lost, which mostly makes this service
-        useless for updating, since I don't think we'd ever want that. **IT
-        SHOULD BE MODIFIED TO PRESERVE THE COMMENT BEFORE BEING USED FOR
-        UPDATING**
-    """
-    submissions = AssignmentSubmission.objects.filter(assignment=session)
-    submissions.delete()
-
+def sync_submissions(session: GradingSession) -> list[AssignmentSubmission]:
+    """Reconcile the session's submissions with the courses.courseWork
+    Classroom API endpoint. This service is used on GradingSession creation,
+    and to pick up changes made in Google Classroom afterwards.
+
+    Only submissions whose `updateTime` or `state` changed since the last
+    sync are touched; the content, names, photos and comments that we
+    already have are kept. Submissions from new students are added, and
+    submissions that are no longer listed are marked as `removed` rather
+    than deleted. A background job to re-fetch the content of new and
+    changed submissions is queued, so a sync where nothing changed costs a
+    single list call.
+
+    Returns the submissions that were added or changed."""
+    existing = {
+        s.api_student_submission_id: s
+        for s in session.submissions.defer("stored_diff", "stored_section_opcodes")  # type: ignore
+    }
     new_submissions = []
+    changed = []
+    listed = set()
     for goog_submission in _list_assignment_submissions(session):
-        new_submissions.append(
-            AssignmentSubmission(
-                assignment=session,
-                api_student_profile_id=goog_submission["userId"],
-                api_student_submission_id=goog_submission["id"],
-                grade=goog_submission.get("assignedGrade")
-                or goog_submission.get("draftGrade"),
+        listed.add(goog_submission["id"])
+        api_grade = goog_submission.get("assignedGrade") or goog_submission.get(
+            "draftGrade"
+        )
+        update_time = goog_submission.get("updateTime", "")
+        state = goog_submission.get("state", "")
+
+        if (submission := existing.get(goog_submission["id"])) is None:
+            new_submissions.append(
+                AssignmentSubmission(
+                    assignment=session,
+                    api_student_profile_id=goog_submission["userId"],
+                    api_student_submission_id=goog_submission["id"],
+                    api_update_time=update_time,
+                    api_state=state,
+                    grade=api_grade,
+                )
             )
+        elif (
+            submission.api_update_time != update_time
+            or submission.api_state != state
+            or submission.removed
+        ):
+            submission.api_update_time = update_time
+            submission.api_state = state
+            submission.removed = False
+            # like `_update_submission`, only let google classroom grades
+            # overwrite ours if the whole assignment is marked as synced
+            if session.is_synced and submission.grade != api_grade:
+                submission.grade = api_grade
+                submission.grade_version += 1
+            changed.append(submission)
+
+    removed = [s for id_, s in existing.items() if id_ not in listed and not s.removed]
+    for submission in removed:
+        submission.removed = True
+
+    with transaction.atomic():
+        AssignmentSubmission.objects.bulk_update(
+            changed + removed,
+            ["api_update_time", "api_state", "grade", "grade_version", "removed"],
         )
-
-    AssignmentSubmission.objects.bulk_create(new_submissions)
+        # rows added by a concurrent sync are left alone. Primary keys are
+        # not returned when conflicts are ignored, so the rows are selected
+        # again
+        if new_submissions:
+            AssignmentSubmission.objects.bulk_create(
+                new_submissions, ignore_conflicts=True
+            )
+            new_submissions = list(
+                session.submissions.filter(  # type: ignore
+                    api_student_submission_id__in=[
+                        s.api_student_submission_id for s in new_submissions
+                    ]
+                ).defer("stored_diff", "stored_section_opcodes")
+            )
+        # bulk_update and bulk_create skip `save`, which keeps these up to date
+        if new_submissions or changed or removed:
+            session.recompute_grade_stats()
+    if new_submissions:
+        apply_roster(session)
+
+    # pre-fetch content, names and photos before the teacher gets to them,
+    # and then diff everything
+    enqueue_submission_refreshes(new_submissions)
+    enqueue_submission_refreshes(changed, force_update=True)
+    if new_submissions or changed:
+        enqueue_session_diff(session)
+
+    return new_submissions + changed
+
+
+class GradeConflict(Exception):
+    """Grades were changed by someone else since the client loaded them.
+    `versions` are the current `grade_version`s of those submissions, by
+    pk."""
+
+    def __init__(self, versions: dict[int, int]):
+        super().__init__(f"grades changed since they were loaded: {versions}")
+        self.versions = versions
+
+
+def update_grades(session: GradingSession, updates: list[dict]) -> dict[int, int]:
+    """Set the grades of many of the session's active submissions in one
+    transaction. Each update has the `pk`, the new `grade`, and the
+    `grade_version` the client last saw, and each submission appears at most
+    once. If any of those versions is out of date, nothing is saved, and
+    `GradeConflict` is raised; an out of date update which sets the grade it
+    already has is not a conflict, and is left alone.
+
+    The grades are written with a single bulk update, and the session's
+    grade statistics are updated once. Returns the new `grade_version` of
+    each submission, by pk."""
+    with transaction.atomic():
+        submissions = {
+            s.pk: s
+            for s in session.active_submissions.select_for_update()
+            .filter(pk__in=[u["pk"] for u in updates])
+            .only("assignment", "grade", "grade_version", "removed")
+        }
+        if missing := {u["pk"] for u in updates} - submissions.keys():
+            raise Http404(f"no submissions {sorted(missing)} in this session")
+        if conflicts := {
+            u["pk"]: submissions[u["pk"]].grade_version
+            for u in updates
+            if u["grade_version"] != submissions[u["pk"]].grade_version
+            and u["grade"] != submissions[u["pk"]].grade
+        }:
+            raise GradeConflict(conflicts)
+
+        changed = []
+        removed_grades = []
+        for update in updates:
+            submission = submissions[update["pk"]]
+            if submission.grade == update["grade"]:
+                continue
+            if submission.grade is not None:
+                removed_grades.append(submission.grade)
+            submission.grade = update["grade"]
+            submission.grade_version += 1
+            changed.append(submission)
+        if not changed:
+            return {pk: s.grade_version for pk, s in submissions.items()}
+
+        AssignmentSubmission.objects.bulk_update(changed, ["grade", "grade_version"])
+        session.update_grade_stats(
+            removed=removed_grades,
+            added=[s.grade for s in changed if s.grade is not None],
+        )
+        # the grades in Google Classroom are now out of date
+        GradingSession.objects.filter(pk=session.pk).update(
+            sync_state=GradingSession.SyncState.UNSYNCED
+        )
+        session.sync_state = GradingSession.SyncState.UNSYNCED
+
+    return {pk: s.grade_version for pk, s in submissions.items()}
+
+
+def diff_all_submissions(session: GradingSession, *, chunk_size: int = 100) -> int:
+    """Compute and store the diff of every submission in the session that
+    does not have an up to date one, streaming through the submissions
+    `chunk_size` at a time. Each template is loaded and prepared once, and
+    shared by all of its submissions. Submissions that have not been fetched
+    yet are skipped. Returns the number of diffs computed."""
+    templates: dict[int, TeacherTemplate] = {}
+    count = 0
+    for submission in (
+        session.active_submissions.filter(teacher_template__isnull=False)
+        .select_related("submission_blob")
+        .defer("stored_diff")
+        .iterator(chunk_size=chunk_size)
+    ):
+        if (template := templates.get(submission.teacher_template_id)) is None:
+            template = templates[
+                submission.teacher_template_id
+            ] = TeacherTemplate.objects.get(pk=submission.teacher_template_id)
+        submission.teacher_template = template
+        if not submission.diff_is_stored:
+            submission.diff
+            count += 1
+    return count
+
+
+def update_common_lines(session: GradingSession) -> int:
+    """Find the lines that most of the submissions in the session have in
+    common, and store their hashes on the session. Submissions that have not
+    been fetched yet are skipped. Returns the number of common lines."""
+    blobs = list(
+        session.active_submissions.filter(
+            teacher_template__isnull=False, submission_blob__isnull=False
+        ).values_list("submission_blob_id", flat=True)
+    )
+    # identical submissions share a blob, and are only loaded and split once
+    lines = {
+        key: text.split("\n")
+        for key, text in ContentBlob.objects.load_many(blobs).items()
+    }
+    documents = [lines[key] for key in blobs]
+    session.common_line_hashes = find_common_lines(
+        documents, threshold=settings.GRADER_COMMON_LINE_THRESHOLD
+    )
+    session.save(update_fields=["common_line_hashes"])
+    return len(session.common_line_hashes)
+
+
+def refresh_minhash_signatures(session: GradingSession) -> int:
+    """Recompute the similarity signatures which were computed against an
+    older version of their template, and update the similarity index for
+    them. Submissions that have not been fetched yet are skipped. Returns the
+    number of signatures recomputed."""
+    count = 0
+    for template in TeacherTemplate.objects.filter(
+        assignmentsubmission__assignment=session
+    ).distinct():
+        for submission in (
+            session.active_submissions.filter(teacher_template=template)
+            .exclude(minhash_template_hash=template.get_content_hash())
+            .select_related("submission_blob")
+            .defer("stored_diff", "stored_section_opcodes")
+        ):
+            submission.teacher_template = template
+            changed = submission.refresh_minhash_signature()
+            submission.save(
+                update_fields=["minhash_signature", "minhash_template_hash"]
+            )
+            if changed:
+                submission.update_similarity_buckets()
+            count += 1
+    return count
+
+
+def cluster_similar_submissions(
+    session: GradingSession, *, course_wide: bool = False
+) -> list[list[AssignmentSubmission]]:
+    """Clusters of near-identical submissions in the session, found through
+    the similarity index (see `grader.similarity`) rather than by comparing
+    every pair. If `course_wide`, submissions from the other sessions in the
+    course are included, and each cluster has at least one submission from
+    this session."""
+    buckets = SimilarityBucket.objects.filter(
+        course_id=session.course_id, submission__removed=False  # type: ignore
+    )
+    session_buckets = buckets.filter(submission__assignment=session)
+    if course_wide:
+        buckets = buckets.filter(key__in=session_buckets.values("key"))
+    else:
+        buckets = session_buckets
+    groups = group_buckets(buckets.values_list("band", "key", "submission_id"))
+
+    submissions = AssignmentSubmission.objects.only(
+        "pk", "assignment_id", "student_name", "minhash_signature"
+    ).in_bulk({pk for group in groups for pk in group})
+    clusters = cluster(
+        groups,
+        {pk: s.minhash_signature for pk, s in submissions.items()},
+        threshold=settings.GRADER_SIMILARITY["THRESHOLD"],
+    )
+    return [
+        [submissions[pk] for pk in c]
+        for c in clusters
+        if any(submissions[pk].assignment_id == session.pk for pk in c)  # type: ignore
+    ]
 
 
 def create_or_get_grading_session(
@@ -544,11 +1153,11 @@ def create_or_get_grading_session(
 
     # first, get the source of truth from Google API
     service = get_google_classroom_service(user=user)
-    goog_detail = (
-        service.courses()  # type: ignore
-        .courseWork()
-        .get(courseId=course.api_course_id, id=assignment_id)  # type: ignore
-        .execute()
+    goog_detail = execute(
+        _get_assignment_request(
+            service, course_id=course.api_course_id, assignment_id=assignment_id
+        ),
+        user=user,
     )
 
     # get or update operation on our database
@@ -562,7 +1171,7 @@ def create_or_get_grading_session(
 
     # reach into deeper nesting if necessary
     if created or full_update:
-        overwrite_submissions_using_api_data(session)
+        sync_submissions(session)
         return session, True
 
     return session, False
@@ -0,0 +1,141 @@
+# Copyright (C) 2022 John DeVries
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Near-duplicate detection with MinHash and locality sensitive hashing.
+
+Comparing every pair of submissions is quadratic, so instead, each
+submission gets a MinHash signature of the lines the student wrote (lines
+from the teacher template are left out, since everybody has those). The
+fraction of positions at which two signatures agree estimates the Jaccard
+similarity of their lines.
+
+Signatures are cut into bands, and each band is hashed into a bucket key.
+Submissions which share a bucket key in any band are candidates; with `b`
+bands of `r` rows, pairs with a similarity of `s` become candidates with a
+probability of `1 - (1 - s ** r) ** b`, which rises steeply around
+`(1 / b) ** (1 / r)`. Bucket keys are stored per course by
+`models.SimilarityBucket`, so finding the clusters in a session takes
+roughly linear time."""
+
+import hashlib
+from collections import defaultdict
+from functools import lru_cache
+from typing import Container, Iterable, Sequence, Union
+
+import numpy as np
+
+from .common_lines import line_hash
+
+
+def normalize(line: str) -> str:
+    return " ".join(line.split()).lower()
+
+
+def shingles(lines: Iterable[str], *, exclude: Container[str] = ()) -> set[str]:
+    """The distinct, normalized, non-blank lines which are not in
+    `exclude`."""
+    ret = {normalize(line) for line in lines}
+    return {line for line in ret if line and line not in exclude}
+
+
+@lru_cache
+def _permutations(num_perm: int) -> tuple[np.ndarray, np.ndarray]:
+    # fixed seed: signatures are stored, and must be comparable across
+    # processes
+    rng = np.random.default_rng(0)
+    return (
+        rng.integers(0, 1 << 64, num_perm, dtype=np.uint64) | np.uint64(1),
+        rng.integers(0, 1 << 64, num_perm, dtype=np.uint64),
+    )
+
+
+def minhash(items: set[str], *, num_perm: int) -> Union[list[int], None]:
+    """MinHash signature of `items`, or None if it is empty."""
+    if not items:
+        return None
+    x = np.fromiter(
+        (line_hash(item) for item in items), dtype=np.int64, count=len(items)
+    ).view(np.uint64)
+    # multiply-shift hashing: `a * x + b` wraps around at 2 ** 64, and the
+    # high 32 bits are kept
+    a, b = _permutations(num_perm)
+    return ((np.outer(x, a) + b) >> np.uint64(32)).min(axis=0).tolist()
+
+
+def band_keys(signature: Sequence[int], *, bands: int) -> list[int]:
+    """One bucket key per band of the signature."""
+    rows = len(signature) // bands
+    values = np.asarray(signature, dtype=np.uint64)
+    return [
+        int.from_bytes(
+            hashlib.blake2b(
+                values[i * rows : (i + 1) * rows].tobytes(), digest_size=8
+            ).digest(),
+            "little",
+            signed=True,
+        )
+        for i in range(bands)
+    ]
+
+
+def similarity(a: Sequence[int], b: Sequence[int]) -> float:
+    """Estimated Jaccard similarity of the sets behind two signatures."""
+    return float(np.mean(np.asarray(a) == np.asarray(b)))
+
+
+def cluster(
+    buckets: Iterable[Sequence[int]],
+    signatures: dict[int, Sequence[int]],
+    *,
+    threshold: float,
+) -> list[list[int]]:
+    """Group items which share a bucket, and whose signatures are at least
+    `threshold` similar, into clusters. Items are joined transitively.
+    Returns clusters of two or more items, largest first."""
+    parent = {}
+
+    def find(item):
+        parent.setdefault(item, item)
+        while parent[item] != item:
+            parent[item] = parent[parent[item]]
+            item = parent[item]
+        return item
+
+    compared = set()
+    for bucket in buckets:
+        for i, a in enumerate(bucket):
+            for b in bucket[i + 1 :]:
+                pair = (a, b) if a < b else (b, a)
+                if pair in compared or find(a) == find(b):
+                    continue
+                compared.add(pair)
+                if similarity(signatures[a], signatures[b]) >= threshold:
+                    parent[find(a)] = find(b)
+
+    clusters = defaultdict(list)
+    for item in parent:
+        clusters[find(item)].append(item)
+    return sorted(
+        (sorted(c) for c in clusters.values() if len(c) > 1),
+        key=lambda c: (-len(c), c),
+    )
+
+
+def group_buckets(rows: Iterable[tuple[int, int, int]]) -> list[list[int]]:
+    """Group `(band, key, item)` rows into buckets of two or more items."""
+    buckets = defaultdict(list)
+    for band, key, item in rows:
+        buckets[band, key].append(item)
+    return [b for b in buckets.values() if len(b) > 1]
@@ -39,6 +39,10 @@ const state = {
 
   viewDiffOnly: false,
 
+  // the save that is in flight, if any. Saves are sent one at a time, so
+  // that each one sends the grade_version returned by the one before
+  pendingSave: Promise.resolve(),
+
   // all google classroom data
   assignmentData: {
     pk: 1,
@@ -251,8 +255,62 @@ async function initSubmissionData() {
 }
 
 /**
- * Save the current submission object individually. Should be fired after
- * any change to ensure there are no out-of-sync changes.
+ * Save the grades of many submissions with a single request, and update
+ * their `grade_version` from the response. Only submissions whose grade was
+ * changed here are sent.
+ *
+ * Throws if any of the grades was changed by someone else since it was
+ * loaded, in which case nothing is saved. The current versions are adopted
+ * from the response, so saving again overwrites the other change.
+ */
+async function saveGrades(submissions) {
+  submissions = submissions.filter((submission) => submission.changed);
+  if (!submissions.length) {
+    return;
+  }
+  const sent = submissions.map(({ pk, grade, grade_version }) => ({
+    pk,
+    grade,
+    grade_version,
+  }));
+  const res = await fetch(
+    `/grader/session_viewset/${state.assignmentData.pk}/grades/`,
+    {
+      body: JSON.stringify(sent),
+      method: "POST",
+      headers: new Headers({
+        "Content-Type": "application/json",
+        "X-CSRFToken": getCookie("csrftoken"),
+      }),
+    }
+  );
+  const result = await res.json();
+  const versions = {};
+  (result.grade_versions || []).forEach(({ pk, grade_version }) => {
+    versions[pk] = grade_version;
+  });
+  submissions.forEach((submission, i) => {
+    if (versions[submission.pk] !== undefined) {
+      submission.grade_version = versions[submission.pk];
+    }
+    // the grade may have been edited again while the request was in flight
+    if (res.ok && submission.grade === sent[i].grade) {
+      submission.changed = false;
+    }
+  });
+  if (res.status === 409) {
+    throw new Error(
+      "This grade was changed somewhere else. Save again to overwrite it."
+    );
+  }
+  if (!res.ok) {
+    throw new Error(result.message || "failed to save grades");
+  }
+}
+
+/**
+ * Save the current submission's grade. Should be fired after any change to
+ * ensure there are no out-of-sync changes.
  */
 async function saveSubmission(retries = 0) {
   // race condition: while quickly moving through submissions, we might try
@@ -270,29 +328,13 @@ async function saveSubmission(retries = 0) {
     }
   }
 
-  // this could change while we await other stuff, so we'll grab out own copies
-  // to make sure we are async safe
-  const index = state.currentlyViewingIndex;
-  const current = {
-    ...state.assignmentData.submissions[index],
-  };
-
-  // no point in sending the submission content
-  delete current.submission;
-
-  const res = await fetch(
-    `/grader/assignment_submission/${current.pk}/?diff=${state.viewDiffOnly}`,
-    {
-      body: JSON.stringify(current),
-      method: "PATCH",
-      headers: new Headers({
-        "Content-Type": "application/json",
-        "X-CSRFToken": getCookie("csrftoken"),
-      }),
-    }
-  );
-  const result = await res.json();
-  state.assignmentData.submissions[index] = result;
+  // this could change while we await other stuff, so we'll grab our own
+  // reference to make sure we are async safe
+  const current = state.assignmentData.submissions[state.currentlyViewingIndex];
+  const save = state.pendingSave.then(() => saveGrades([current]));
+  // a failed save does not hold up the ones after it
+  state.pendingSave = save.catch(() => {});
+  return save;
 }
 
 /****************************************************************************
@@ -531,8 +573,11 @@ async function switchStudent() {
   if (newIndex >= 0 && newIndex < state.assignmentData.submissions.length) {
     const removeLoading = indicateLoading();
 
-    // TODO(optimization): only save changed submissions
-    saveSubmission();
+    // saves are queued behind each other, so there is no need to wait for
+    // this one before moving on
+    saveSubmission().catch((e) => {
+      indicateFailure(e.message);
+    });
 
     state.currentlyViewingIndex = newIndex;
     const promises = await getSubmissionDetails();
@@ -554,7 +599,11 @@ async function switchStudent() {
 
 function giveFullGrade() {
   const current = state.assignmentData.submissions[state.currentlyViewingIndex];
-  current.grade = state.assignmentData.max_grade;
+  if (current.grade !== state.assignmentData.max_grade) {
+    current.changed = true;
+    current.grade = state.assignmentData.max_grade;
+    markUnSynced();
+  }
   updateView();
 }
 
@@ -586,9 +635,13 @@ function handleKeyPress(e) {
 
   switch (e.key) {
     case "s":
-      saveSubmission().then(() => {
-        indicateSuccess("saved");
-      });
+      saveSubmission()
+        .then(() => {
+          indicateSuccess("saved");
+        })
+        .catch((e) => {
+          indicateFailure(e.message);
+        });
       break;
     case "Enter":
       // next or prev student
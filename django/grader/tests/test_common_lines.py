@@ -0,0 +1,63 @@
+# Copyright (C) 2022 John DeVries
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from unittest import TestCase
+
+from ..common_lines import count_lines, find_common_lines, flag_common_lines, line_hash
+
+
+class TestCommonLines(TestCase):
+    def test_line_hash_is_stable(self):
+        # the hashes are stored, so they must not change between processes
+        self.assertEqual(line_hash("foo"), line_hash("foo"))
+        self.assertEqual(line_hash(""), -5426141060434712860)
+
+    def test_count_lines(self):
+        lines, counts = count_lines([["a", "b", "b", ""], ["a", "  "], ["c", "a"]])
+        self.assertEqual(
+            dict(zip(lines, counts.tolist())),
+            # each document is counted once per line, and blank lines are
+            # ignored
+            {"a": 3, "b": 1, "c": 1},
+        )
+
+    def test_count_no_lines(self):
+        lines, counts = count_lines([])
+        self.assertEqual((lines, len(counts)), ([], 0))
+
+    def test_find_common_lines(self):
+        documents = [["a", "b"], ["a", "b"], ["a", "c"], ["d"]]
+        self.assertEqual(
+            set(find_common_lines(documents, threshold=0.5)),
+            {line_hash("a"), line_hash("b")},
+        )
+        self.assertEqual(find_common_lines(documents, threshold=0.75), [line_hash("a")])
+
+    def test_a_line_needs_two_students(self):
+        self.assertEqual(find_common_lines([["a"]], threshold=0.5), [])
+
+    def test_flag_common_lines(self):
+        diff = [
+            "--- teacher template",
+            "+++ student submission",
+            "@@ -1,2 +1,3 @@",
+            " a",
+            "-b",
+            "+b",
+            "+c",
+        ]
+        common = [line_hash("b"), line_hash("a"), line_hash("++ student submission")]
+        self.assertEqual(flag_common_lines(diff, common), [5])
+        self.assertEqual(flag_common_lines(diff, []), [])
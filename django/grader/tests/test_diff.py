@@ -0,0 +1,268 @@
+# Copyright (C) 2022 John DeVries
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import difflib
+import random
+from unittest import TestCase
+from unittest.mock import patch
+
+from django.test import override_settings
+
+from ..diff import (
+    DifflibEngine,
+    PatienceEngine,
+    check_diff_engine,
+    coarse_opcodes,
+    compact_opcodes,
+    get_engine,
+    prepare,
+    section_diff,
+    section_opcodes,
+    split_sections,
+    unified_diff,
+)
+
+
+def document(sections: dict[str, list[str]]) -> list[str]:
+    ret = []
+    for name, lines in sections.items():
+        ret += [name, "=" * len(name), *lines]
+    return ret
+
+
+def apply_opcodes(opcodes, a, b) -> list[str]:
+    """Rebuild `b` from `a`, checking that the opcodes are consistent."""
+    ret = []
+    i = j = 0
+    for tag, i1, i2, j1, j2 in opcodes:
+        assert (i1, j1) == (i, j), (tag, i1, i2, j1, j2)
+        if tag == "equal":
+            assert a[i1:i2] == b[j1:j2]
+            ret += a[i1:i2]
+        else:
+            ret += b[j1:j2]
+        i, j = i2, j2
+    assert (i, j) == (len(a), len(b))
+    return ret
+
+
+def random_documents(seed: int):
+    rng = random.Random(seed)
+    vocab = ["", "", "the answer is", "I don't know", "foo", "bar", "baz"]
+    a = [rng.choice(vocab) + str(rng.randrange(5)) for _ in range(rng.randrange(60))]
+    b = list(a)
+    for _ in range(rng.randrange(10)):
+        pos = rng.randrange(len(b) + 1)
+        if rng.random() < 0.5 and pos < len(b):
+            del b[pos]
+        else:
+            b.insert(pos, rng.choice(vocab))
+    return a, b
+
+
+class TestUnifiedDiff(TestCase):
+    def test_format_matches_difflib(self):
+        for seed in range(200):
+            a, b = random_documents(seed)
+            for n in (0, 1, 3):
+                self.assertEqual(
+                    unified_diff(
+                        a,
+                        b,
+                        fromfile="teacher template",
+                        tofile="student submission",
+                        n=n,
+                        engine=DifflibEngine(),
+                    ),
+                    list(
+                        difflib.unified_diff(
+                            a,
+                            b,
+                            fromfile="teacher template",
+                            tofile="student submission",
+                            n=n,
+                        )
+                    ),
+                    (seed, n),
+                )
+
+    def test_no_changes(self):
+        self.assertEqual(unified_diff(["a"], ["a"], engine=PatienceEngine()), [])
+        self.assertEqual(unified_diff([], [], engine=PatienceEngine()), [])
+
+    @override_settings(GRADER_DIFF_ENGINE={"BACKEND": "grader.diff.DifflibEngine"})
+    def test_engine_comes_from_settings(self):
+        self.assertIsInstance(get_engine(), DifflibEngine)
+
+    @override_settings(GRADER_DIFF_ENGINE={"BACKEND": "grader.diff.DiffEngine"})
+    def test_incomplete_engine_fails_to_load(self):
+        with self.assertRaises(TypeError):
+            get_engine()
+        self.assertEqual(
+            [e.id for e in check_diff_engine()],
+            ["grader.E001"],
+        )
+        with override_settings(
+            GRADER_DIFF_ENGINE={"BACKEND": "grader.diff.DifflibEngine"}
+        ):
+            self.assertEqual(check_diff_engine(), [])
+
+
+class TestPatienceEngine(TestCase):
+    def test_opcodes_are_valid(self):
+        for seed in range(200):
+            a, b = random_documents(seed)
+            self.assertEqual(
+                apply_opcodes(PatienceEngine().get_opcodes(a, b), a, b), b, seed
+            )
+
+    def test_simple_edit_matches_difflib(self):
+        a = document({"doc": ["question 1", "", "question 2", "", "question 3"]})
+        b = document(
+            {"doc": ["question 1", "answer 1", "", "question 2", "", "question 3"]}
+        )
+        self.assertEqual(
+            unified_diff(a, b, engine=PatienceEngine()),
+            list(difflib.unified_diff(a, b)),
+        )
+
+    def test_prepared_template_is_reused_unchanged(self):
+        a = document({"doc": ["question 1", "", "question 2"]})
+        prepared = prepare(a)
+        self.assertEqual(prepared.headers, ["doc"])
+        table = dict(prepared.line_ids)
+        for seed in range(20):
+            _, b = random_documents(seed)
+            self.assertEqual(
+                PatienceEngine().get_opcodes(a, b, prepared=prepared),
+                PatienceEngine().get_opcodes(a, b),
+            )
+        self.assertEqual(prepared.line_ids, table)
+
+    def test_repeated_lines(self):
+        a = ["", "x"] * 500 + ["unique"]
+        b = ["x", ""] * 500 + ["unique", "added"]
+        opcodes = PatienceEngine().get_opcodes(a, b)
+        self.assertEqual(apply_opcodes(opcodes, a, b), b)
+        self.assertEqual(opcodes[-1][0], "insert")
+
+    def test_falls_back_to_sections_over_budget(self):
+        a = document(
+            {"one": ["same"], "two": [str(i) for i in range(50)], "three": ["same"]}
+        )
+        b = document(
+            {"one": ["same"], "two": [str(-i) for i in range(50)], "three": ["same"]}
+        )
+        for engine in (
+            PatienceEngine(max_edits=5),
+            PatienceEngine(timeout=-1),
+            PatienceEngine(max_lines=10),
+        ):
+            opcodes = engine.get_opcodes(a, b)
+            self.assertEqual(opcodes, coarse_opcodes(a, b))
+            self.assertEqual(apply_opcodes(opcodes, a, b), b)
+
+        # the unchanged sections are still matched; only "two" is replaced
+        self.assertEqual(
+            [tag for tag, *_ in coarse_opcodes(a, b)], ["equal", "replace", "equal"]
+        )
+
+    def test_coarse_diff_with_moved_sections(self):
+        one, two = {"one": ["1"]}, {"two": ["2"]}
+        a = document({**one, **two})
+        b = document({**two, **one, "new": ["3"]})
+        self.assertEqual(apply_opcodes(coarse_opcodes(a, b), a, b), b)
+
+
+class TestSections(TestCase):
+    a = ["preamble", *document({"one": ["1", "", "x"], "two": ["2"], "three": ["3"]})]
+
+    def test_split_sections(self):
+        self.assertEqual(
+            [(s.name, s.start, s.end) for s in split_sections(self.a)],
+            [("", 0, 1), ("one", 1, 6), ("two", 6, 9), ("three", 9, 12)],
+        )
+
+    def test_section_opcodes_are_valid(self):
+        prepared = prepare(self.a)
+        for b in (
+            self.a,
+            [],
+            document({"one": ["1", "", "y"], "three": ["3"], "four": ["4"]}),
+            document({"three": ["3"], "two": ["2", "2"]}),
+            ["preamble", "changed", *document({"one": ["1"]})],
+        ):
+            opcodes, _ = section_opcodes(
+                prepared, b, split_sections(b), engine=PatienceEngine()
+            )
+            self.assertEqual(apply_opcodes(opcodes, self.a, b), b)
+
+    def test_only_changed_sections_are_diffed_again(self):
+        prepared = prepare(self.a)
+        b = ["preamble", *document({"one": ["1", "answer"], "two": ["2"], "three": []})]
+        _, cache = section_opcodes(prepared, b, split_sections(b))
+        self.assertEqual(len(cache), 4)
+
+        b[b.index("answer")] = "new answer"
+        engine = PatienceEngine()
+        with patch.object(engine, "get_opcodes", wraps=engine.get_opcodes) as spy:
+            opcodes, new_cache = section_opcodes(
+                prepared, b, split_sections(b), engine=engine, cache=cache
+            )
+        spy.assert_called_once()
+        self.assertEqual(apply_opcodes(opcodes, self.a, b), b)
+        self.assertEqual(len(new_cache), 4)
+
+        # the composed diff renders like a diff of the whole document
+        self.assertEqual(
+            unified_diff(self.a, b, engine=PatienceEngine()),
+            unified_diff(self.a, b, engine=DifflibEngine()),
+        )
+
+    def test_section_diff(self):
+        prepared = prepare(self.a)
+        b = document({"one": ["1", "", "y"], "four": ["4"]})
+        self.assertEqual(
+            section_diff(prepared, b, split_sections(b), "one"),
+            ["--- \n", "+++ \n", "@@ -2,4 +2,4 @@\n", " ===", " 1", " ", "-x", "+y"],
+        )
+        self.assertEqual(
+            section_diff(prepared, b, split_sections(b), "four")[2:],
+            ["@@ -0,0 +1,3 @@\n", "+four", "+====", "+4"],
+        )
+        with self.assertRaises(KeyError):
+            section_diff(prepared, b, split_sections(b), "five")
+
+
+class TestCompactOpcodes(TestCase):
+    def test_rebuilds_b_from_a(self):
+        for seed in range(20):
+            a, b = random_documents(seed)
+            ops = compact_opcodes(PatienceEngine().get_opcodes(a, b), a, b)
+            rebuilt = []
+            for op in ops:
+                if op[0] == "=":
+                    rebuilt += a[op[1] : op[2]]
+                elif op[0] == "+":
+                    rebuilt += op[1]
+            self.assertEqual(rebuilt, b)
+
+    def test_unchanged_lines_are_referenced_by_index(self):
+        a = ["a", "b", "c", "d"]
+        b = ["a", "b", "x", "d"]
+        self.assertEqual(
+            compact_opcodes(DifflibEngine().get_opcodes(a, b), a, b),
+            [["=", 0, 2], ["-", ["c"]], ["+", ["x"]], ["=", 3, 4]],
+        )
@@ -0,0 +1,369 @@
+# Copyright (C) 2022 John DeVries
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import json
+from datetime import timedelta
+from unittest.mock import MagicMock, patch
+
+import httplib2
+from allauth.socialaccount.models import SocialAccount, SocialApp, SocialToken
+from cachetools import LRUCache
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
+from google.oauth2.credentials import Credentials
+from googleapiclient.errors import HttpError
+
+from ..google_api import (
+    TokenBucket,
+    background_priority,
+    build_service,
+    clear_credentials_cache,
+    clear_service_cache,
+    execute,
+    execute_batch,
+    get_credentials,
+    get_error_counts,
+    is_retryable,
+)
+
+
+def make_credentials(refresh_token="refresh", token="token"):
+    return Credentials(token=token, refresh_token=refresh_token)
+
+
+class TestBuildService(SimpleTestCase):
+    def setUp(self):
+        clear_service_cache()
+
+    def test_service_is_reused_for_the_same_credential(self):
+        a = build_service(
+            service="classroom", version="v1", credentials=make_credentials()
+        )
+        # a new access token for the same grant still hits the cache
+        b = build_service(
+            service="classroom",
+            version="v1",
+            credentials=make_credentials(token="refreshed"),
+        )
+        self.assertIs(a, b)
+
+    def test_services_are_distinct_per_credential_and_api(self):
+        classroom = build_service(
+            service="classroom", version="v1", credentials=make_credentials()
+        )
+        drive = build_service(
+            service="drive", version="v3", credentials=make_credentials()
+        )
+        other_user = build_service(
+            service="classroom",
+            version="v1",
+            credentials=make_credentials(refresh_token="other"),
+        )
+        self.assertIsNot(classroom, drive)
+        self.assertIsNot(classroom, other_user)
+
+    @patch("grader.google_api.build_from_document")
+    def test_cache_is_bounded(self, mock_build):
+        mock_build.side_effect = lambda *a, **kw: object()
+        with patch("grader.google_api._service_cache", LRUCache(maxsize=2)):
+            first = build_service(
+                service="drive", version="v3", credentials=make_credentials("1")
+            )
+            for token in ("2", "3"):
+                build_service(
+                    service="drive", version="v3", credentials=make_credentials(token)
+                )
+            # the first service was evicted, so it is built again
+            again = build_service(
+                service="drive", version="v3", credentials=make_credentials("1")
+            )
+        self.assertIsNot(first, again)
+        self.assertEqual(mock_build.call_count, 4)
+
+    def test_unknown_service_raises(self):
+        with self.assertRaises(ValueError):
+            build_service(
+                service="not_a_service", version="v0", credentials=make_credentials()
+            )
+
+
+class TestGetCredentials(TestCase):
+    def setUp(self):
+        clear_credentials_cache()
+        self.user = User.objects.create_user(username="foo", password="bar")
+        app = SocialApp.objects.create(provider="google", name="google")
+        account = SocialAccount.objects.create(
+            user=self.user, provider="google", uid="1"
+        )
+        self.token = SocialToken.objects.create(
+            app=app,
+            account=account,
+            token="expired",
+            token_secret="refresh",
+            expires_at=timezone.now() - timedelta(minutes=5),
+        )
+
+    @staticmethod
+    def fake_refresh(credentials, _):
+        credentials.token = "fresh"
+        credentials.expiry = (timezone.now() + timedelta(hours=1)).replace(tzinfo=None)
+
+    def test_credentials_are_cached_per_user(self):
+        self.assertIs(get_credentials(user=self.user), get_credentials(user=self.user))
+
+    @patch("grader.google_api.Credentials.refresh", autospec=True)
+    def test_refreshed_token_is_persisted(self, mock_refresh):
+        mock_refresh.side_effect = self.fake_refresh
+        credentials = get_credentials(user=self.user)
+        self.assertFalse(credentials.valid)
+
+        credentials.refresh(None)
+
+        self.token.refresh_from_db()
+        self.assertEqual(self.token.token, "fresh")
+        self.assertGreater(self.token.expires_at, timezone.now())
+        self.assertTrue(get_credentials(user=self.user).valid)
+
+    @patch("grader.google_api.Credentials.refresh", autospec=True)
+    def test_token_refreshed_elsewhere_is_adopted(self, mock_refresh):
+        credentials = get_credentials(user=self.user)
+
+        # meanwhile, another worker refreshes the token
+        self.token.token = "refreshed by another worker"
+        self.token.expires_at = timezone.now() + timedelta(hours=1)
+        self.token.save()
+
+        credentials.refresh(None)
+
+        mock_refresh.assert_not_called()
+        self.assertEqual(credentials.token, "refreshed by another worker")
+        self.assertTrue(credentials.valid)
+
+    @patch("grader.google_api.Credentials.refresh", autospec=True)
+    def test_each_worker_does_not_refresh_again(self, mock_refresh):
+        mock_refresh.side_effect = self.fake_refresh
+        credentials = get_credentials(user=self.user)
+
+        # a second worker process loaded the same expired token
+        clear_credentials_cache()
+        other_worker_credentials = get_credentials(user=self.user)
+        self.assertIsNot(credentials, other_worker_credentials)
+
+        credentials.refresh(None)
+        other_worker_credentials.refresh(None)
+
+        self.assertEqual(mock_refresh.call_count, 1)
+        self.assertEqual(other_worker_credentials.token, "fresh")
+
+
+def http_error(status, reason=None):
+    errors = [{"reason": reason}] if reason else []
+    content = json.dumps({"error": {"code": status, "errors": errors}})
+    return HttpError(httplib2.Response({"status": status}), bytes(content, "utf8"))
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.slept = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+class TestTokenBucket(SimpleTestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = patch("grader.google_api.time", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_burst_then_steady_rate(self):
+        bucket = TokenBucket(rate=10, capacity=5)
+        for _ in range(5):
+            bucket.acquire()
+        self.assertEqual(self.clock.slept, [])
+
+        bucket.acquire()
+        self.assertAlmostEqual(sum(self.clock.slept), 0.1)
+
+    def test_reserve_is_left_for_other_callers(self):
+        bucket = TokenBucket(rate=10, capacity=8)
+        for _ in range(6):
+            bucket.acquire(reserve=0.25)
+        self.assertEqual(self.clock.slept, [])
+
+        # the last two tokens are only available to callers without a reserve
+        bucket.acquire(reserve=0.25)
+        self.assertEqual(len(self.clock.slept), 1)
+        bucket.acquire()
+        self.assertEqual(len(self.clock.slept), 1)
+
+    def test_take_does_not_wait(self):
+        bucket = TokenBucket(rate=10, capacity=2)
+        for _ in range(4):
+            bucket.take()
+        self.assertEqual(self.clock.slept, [])
+
+        # waiters pay off the debt first
+        bucket.acquire()
+        self.assertAlmostEqual(sum(self.clock.slept), 0.3)
+
+
+@patch("grader.google_api._backoff")
+class TestExecute(SimpleTestCase):
+    def setUp(self):
+        self.user = User(pk=1, username="foo")
+
+    def request(self, *side_effect):
+        request = MagicMock(methodId="classroom.courses.get")
+        request.execute.side_effect = side_effect
+        return request
+
+    def test_transient_errors_are_retried(self, mock_backoff):
+        before = get_error_counts().get(("classroom.courses.get", 503), 0)
+        request = self.request(http_error(503), http_error(429), {"id": "1"})
+
+        self.assertEqual(execute(request, user=self.user), {"id": "1"})
+
+        self.assertEqual(request.execute.call_count, 3)
+        self.assertEqual([c.args for c in mock_backoff.call_args_list], [(0,), (1,)])
+        self.assertEqual(get_error_counts()[("classroom.courses.get", 503)], before + 1)
+
+    def test_other_errors_are_raised(self, mock_backoff):
+        request = self.request(http_error(404))
+        with self.assertRaises(HttpError):
+            execute(request, user=self.user)
+        mock_backoff.assert_not_called()
+
+    def test_gives_up_eventually(self, mock_backoff):
+        request = self.request(*[http_error(500)] * 10)
+        with self.assertRaises(HttpError):
+            execute(request, user=self.user)
+        self.assertEqual(request.execute.call_count, 6)
+
+    def test_kwargs_are_passed_through(self, _):
+        request = self.request({})
+        execute(request, user=self.user, http="transport")
+        request.execute.assert_called_once_with(http="transport")
+
+    def test_batch_retries_failed_calls_only(self, mock_backoff):
+        executed = []
+
+        class FakeBatch:
+            def __init__(self, callback):
+                self.callback = callback
+                self.requests = {}
+
+            def add(self, request, request_id):
+                self.requests[request_id] = request
+
+            def execute(self):
+                executed.append(sorted(self.requests))
+                for id_, request in self.requests.items():
+                    try:
+                        self.callback(id_, request.execute(), None)
+                    except HttpError as e:
+                        self.callback(id_, None, e)
+
+        service = MagicMock()
+        service.new_batch_http_request.side_effect = FakeBatch
+        results = execute_batch(
+            service=service,
+            user=self.user,
+            requests={
+                "a": self.request({"id": "a"}),
+                "b": self.request(
+                    http_error(403, "userRateLimitExceeded"), {"id": "b"}
+                ),
+                "c": self.request(http_error(403, "forbidden")),
+            },
+        )
+
+        self.assertEqual(executed, [["a", "b", "c"], ["b"]])
+        self.assertEqual(results["a"], {"id": "a"})
+        self.assertEqual(results["b"], {"id": "b"})
+        self.assertIsInstance(results["c"], HttpError)
+        mock_backoff.assert_called_once()
+
+    def test_failed_batch_is_recorded_once(self, mock_backoff):
+        counts_before = get_error_counts()
+
+        class FakeBatch:
+            attempts = 0
+
+            def __init__(self, callback):
+                self.callback = callback
+                self.ids = []
+
+            def add(self, _, request_id):
+                self.ids.append(request_id)
+
+            def execute(self):
+                FakeBatch.attempts += 1
+                if FakeBatch.attempts == 1:
+                    raise http_error(503)
+                for id_ in self.ids:
+                    self.callback(id_, {"id": id_}, None)
+
+        service = MagicMock()
+        service.new_batch_http_request.side_effect = FakeBatch
+        results = execute_batch(
+            service=service,
+            user=self.user,
+            requests={id_: self.request() for id_ in "abc"},
+        )
+
+        self.assertEqual(results, {id_: {"id": id_} for id_ in "abc"})
+        counts = get_error_counts()
+        self.assertEqual(
+            counts.get(("batch", 503), 0), counts_before.get(("batch", 503), 0) + 1
+        )
+        self.assertEqual(
+            counts.get(("classroom.courses.get", 503), 0),
+            counts_before.get(("classroom.courses.get", 503), 0),
+        )
+
+
+class TestRetryPolicy(SimpleTestCase):
+    def test_is_retryable(self):
+        self.assertTrue(is_retryable(http_error(429)))
+        self.assertTrue(is_retryable(http_error(503)))
+        self.assertTrue(is_retryable(http_error(403, "rateLimitExceeded")))
+        self.assertTrue(is_retryable(ConnectionResetError()))
+        self.assertFalse(is_retryable(http_error(403, "insufficientPermissions")))
+        self.assertFalse(is_retryable(http_error(404)))
+        self.assertFalse(is_retryable(ValueError()))
+
+    @patch("grader.google_api._project_bucket")
+    def test_only_background_calls_are_throttled(self, mock_bucket):
+        request = MagicMock(methodId="drive.files.export")
+        user = User(pk=2, username="bar")
+
+        execute(request, user=user)
+        mock_bucket.take.assert_called_once()
+        mock_bucket.acquire.assert_not_called()
+
+        with background_priority():
+            execute(request, user=user)
+        mock_bucket.acquire.assert_called_once_with(
+            reserve=settings.GOOGLE_API_BACKGROUND_RESERVE
+        )
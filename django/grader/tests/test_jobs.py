@@ -0,0 +1,179 @@
+# Copyright (C) 2022 John DeVries
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from datetime import timedelta
+from io import StringIO
+from unittest.mock import Mock, patch
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import timezone
+
+from ..jobs import (
+    HANDLERS,
+    MAX_ATTEMPTS,
+    claim_jobs,
+    delete_finished_jobs,
+    enqueue_session_diff,
+    enqueue_submission_refreshes,
+    run_jobs,
+    run_pending_jobs,
+)
+from ..models import AssignmentSubmission, BackgroundJob, CourseModel, GradingSession
+
+
+class TestJobs(TestCase):
+    def setUp(self):
+        user = User.objects.create_user(username="foo", password="bar")
+        course = CourseModel.objects.create(owner=user, name="c", api_course_id="c")
+        self.sessions = [
+            GradingSession.objects.create(
+                course=course, api_assignment_id=str(i), max_grade=10
+            )
+            for i in range(2)
+        ]
+        self.submissions = AssignmentSubmission.objects.bulk_create(
+            [
+                AssignmentSubmission(
+                    assignment=session,
+                    api_student_profile_id=str(i),
+                    api_student_submission_id=str(i),
+                )
+                for session in self.sessions
+                for i in range(3)
+            ]
+        )
+
+    def test_pending_refreshes_are_not_duplicated(self):
+        self.assertEqual(len(enqueue_submission_refreshes(self.submissions[:4])), 4)
+        self.assertEqual(len(enqueue_submission_refreshes(self.submissions)), 2)
+        self.assertEqual(BackgroundJob.objects.count(), 6)
+
+    @patch("grader.services.update_submissions")
+    def test_refreshes_are_batched_per_session(self, mock_update):
+        enqueue_submission_refreshes(self.submissions)
+
+        self.assertEqual(run_pending_jobs(), 6)
+
+        self.assertEqual(mock_update.call_count, 2)
+        for call in mock_update.mock_calls:
+            self.assertEqual(
+                len({s.assignment_id for s in call.kwargs["submissions"]}), 1
+            )
+        self.assertEqual(
+            BackgroundJob.objects.filter(state=BackgroundJob.State.DONE).count(), 6
+        )
+        self.assertEqual(run_pending_jobs(), 0)
+
+    @patch("grader.services.update_submissions")
+    def test_failed_jobs_are_retried(self, mock_update):
+        mock_update.side_effect = Exception("google is down")
+        enqueue_submission_refreshes(self.submissions[:1])
+
+        for _ in range(MAX_ATTEMPTS):
+            self.assertEqual(run_pending_jobs(), 1)
+        self.assertEqual(run_pending_jobs(), 0)
+
+        job = BackgroundJob.objects.get()
+        self.assertEqual(job.state, BackgroundJob.State.FAILED)
+        self.assertEqual(job.attempts, MAX_ATTEMPTS)
+        self.assertIn("google is down", job.error)
+
+    @patch("grader.services.update_submissions")
+    def test_failures_are_isolated_per_session(self, mock_update):
+        failing = self.sessions[0].pk
+
+        def update(*, submissions, **_):
+            if submissions[0].assignment_id == failing:
+                raise Exception("google is down")
+
+        mock_update.side_effect = update
+        enqueue_submission_refreshes(self.submissions)
+
+        self.assertEqual(run_pending_jobs(), 6)
+
+        self.assertEqual(
+            set(
+                BackgroundJob.objects.filter(
+                    state=BackgroundJob.State.PENDING
+                ).values_list("payload__session_pk", flat=True)
+            ),
+            {failing},
+        )
+        self.assertEqual(
+            BackgroundJob.objects.filter(state=BackgroundJob.State.DONE).count(), 3
+        )
+
+    @patch("grader.services.update_submissions")
+    def test_only_forced_refreshes_are_forced(self, mock_update):
+        enqueue_submission_refreshes(self.submissions[:2])
+        enqueue_submission_refreshes(self.submissions[2:3], force_update=True)
+
+        run_pending_jobs()
+
+        self.assertEqual(
+            sorted(
+                (len(c.kwargs["submissions"]), c.kwargs["force_update"])
+                for c in mock_update.mock_calls
+            ),
+            [(1, True), (2, False)],
+        )
+
+    def test_diff_waits_for_refreshes_of_its_session(self):
+        session = self.sessions[0]
+        # the pending diff was queued before the refreshes
+        diff_job = enqueue_session_diff(session)
+        enqueue_submission_refreshes(self.submissions[:3])
+        self.assertIsNone(enqueue_session_diff(session))
+
+        refreshes = claim_jobs(limit=10)
+        self.assertNotIn(diff_job, refreshes)
+        self.assertEqual(len(refreshes), 3)
+        # another worker can't claim it while the refreshes are running
+        self.assertEqual(claim_jobs(limit=10), [])
+
+        with patch.dict(HANDLERS, {BackgroundJob.Kind.REFRESH_SUBMISSION: Mock()}):
+            run_jobs(refreshes)
+        self.assertEqual(claim_jobs(limit=10), [diff_job])
+
+    def test_old_finished_jobs_are_deleted(self):
+        for state in BackgroundJob.State:
+            BackgroundJob.objects.create(
+                kind=BackgroundJob.Kind.DIFF_SESSION,
+                payload={"session_pk": self.sessions[0].pk},
+                state=state,
+            )
+        self.assertEqual(delete_finished_jobs(), 0)
+
+        BackgroundJob.objects.update(last_updated=timezone.now() - timedelta(days=8))
+        self.assertEqual(delete_finished_jobs(), 2)
+        self.assertEqual(
+            set(BackgroundJob.objects.values_list("state", flat=True)),
+            {BackgroundJob.State.PENDING, BackgroundJob.State.RUNNING},
+        )
+
+    # closing the connection would break the test's transaction
+    @patch("grader.management.commands.run_worker.close_old_connections")
+    @patch("grader.services.update_submissions")
+    def test_run_worker_command(self, mock_update, mock_close):
+        enqueue_submission_refreshes(self.submissions)
+        call_command("run_worker", "--once", "--batch-size", "4", stdout=StringIO())
+        self.assertEqual(mock_update.call_count, 3)
+        # once before each batch, and once before finding the queue empty
+        self.assertEqual(mock_close.call_count, 3)
+        self.assertFalse(
+            BackgroundJob.objects.exclude(state=BackgroundJob.State.DONE).exists()
+        )
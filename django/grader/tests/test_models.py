@@ -0,0 +1,327 @@
+# Copyright (C) 2022 John DeVries
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+from datetime import timedelta
+from unittest.mock import patch
+
+from django.contrib.auth.models import User
+from django.test import TestCase
+from django.utils import timezone
+
+from ..models import (
+    AssignmentSubmission,
+    ContentBlob,
+    CourseModel,
+    GradingSession,
+    TeacherTemplate,
+)
+
+
+class TestContentBlobs(TestCase):
+    def setUp(self):
+        user = User.objects.create_user(username="foo", password="bar")
+        course = CourseModel.objects.create(owner=user, name="c", api_course_id="c")
+        self.session = GradingSession.objects.create(
+            course=course, api_assignment_id="a", max_grade=10
+        )
+        self.template = TeacherTemplate.objects.create(content="doc\n===\n" * 100)
+
+    def create_submission(self, student, content) -> AssignmentSubmission:
+        return AssignmentSubmission.objects.create(
+            assignment=self.session,
+            teacher_template=self.template,
+            api_student_profile_id=student,
+            api_student_submission_id=f"s{student}",
+            submission=content,
+        )
+
+    def test_identical_content_is_stored_once(self):
+        for student in "123":
+            self.create_submission(student, self.template.content)
+        self.create_submission("4", "something else")
+
+        self.assertEqual(ContentBlob.objects.count(), 2)
+        blob = ContentBlob.objects.get(pk=self.template.get_content_hash())
+        self.assertEqual(blob.text, self.template.content)
+        # compressed
+        self.assertLess(len(blob.data), blob.size)
+
+        fetched = AssignmentSubmission.objects.get(api_student_profile_id="1")
+        self.assertEqual(fetched.submission, self.template.content)
+
+    def test_unchanged_content_is_not_written(self):
+        submission = self.create_submission("1", "foo")
+        submission = AssignmentSubmission.objects.get(pk=submission.pk)
+        submission.submission = "foo"
+        with patch.object(ContentBlob.objects, "store") as mock_store:
+            submission.save()
+        mock_store.assert_not_called()
+
+    def test_unused_blobs_are_deleted(self):
+        submission = self.create_submission("1", "foo")
+        other = self.create_submission("2", "shared")
+        submission.submission = "shared"
+        submission.save(update_fields=["submission"])
+        ContentBlob.objects.delete_unused(grace=timedelta(0))
+
+        self.assertEqual(
+            set(ContentBlob.objects.values_list("hash", flat=True)),
+            {self.template.get_content_hash(), other.get_submission_hash()},
+        )
+        self.assertEqual(
+            AssignmentSubmission.objects.get(pk=submission.pk).submission, "shared"
+        )
+
+        # blobs are only deleted once they have been unused for a while
+        self.session.delete()
+        self.assertEqual(ContentBlob.objects.delete_unused(), 0)
+        self.assertEqual(ContentBlob.objects.delete_unused(grace=timedelta(0)), 1)
+        self.assertEqual(
+            list(ContentBlob.objects.values_list("hash", flat=True)),
+            [self.template.get_content_hash()],
+        )
+
+    def test_storing_marks_blobs_as_used(self):
+        key = ContentBlob.objects.store("foo")
+        ContentBlob.objects.update(last_used=timezone.now() - timedelta(days=1))
+        self.assertEqual(ContentBlob.objects.store("foo"), key)
+
+        # e.g. a submission that is about to refer to it
+        self.assertEqual(ContentBlob.objects.delete_unused(), 0)
+
+    def test_bulk_create_stores_content(self):
+        (submission,) = AssignmentSubmission.objects.bulk_create(
+            [
+                AssignmentSubmission(
+                    assignment=self.session,
+                    api_student_profile_id="1",
+                    api_student_submission_id="s1",
+                    submission="foo",
+                )
+            ]
+        )
+        self.assertEqual(
+            AssignmentSubmission.objects.get(pk=submission.pk).submission, "foo"
+        )
+
+    def test_submissions_that_were_not_fetched(self):
+        (submission,) = AssignmentSubmission.objects.bulk_create(
+            [
+                AssignmentSubmission(
+                    assignment=self.session,
+                    api_student_profile_id="1",
+                    api_student_submission_id="s1",
+                )
+            ]
+        )
+        submission = AssignmentSubmission.objects.get(pk=submission.pk)
+        self.assertIsNone(submission.submission_blob_id)
+        self.assertEqual(submission.submission, "no attachments found")
+
+
+class TestStoredDiff(TestCase):
+    def setUp(self):
+        user = User.objects.create_user(username="foo", password="bar")
+        course = CourseModel.objects.create(owner=user, name="c", api_course_id="c")
+        session = GradingSession.objects.create(
+            course=course, api_assignment_id="a", max_grade=10
+        )
+        self.template = TeacherTemplate.objects.create(content="a\nb\nc")
+        self.submission = AssignmentSubmission.objects.create(
+            assignment=session,
+            teacher_template=self.template,
+            api_student_profile_id="1",
+            api_student_submission_id="s1",
+            submission="a\nB\nc",
+        )
+
+    def fetch(self) -> AssignmentSubmission:
+        return AssignmentSubmission.objects.select_related("teacher_template").get(
+            pk=self.submission.pk
+        )
+
+    def test_diff_is_computed_once(self):
+        diff = self.fetch().diff
+        self.assertIn("+B", diff)
+
+        with patch("grader.models.section_opcodes") as mock_diff:
+            self.assertEqual(self.fetch().diff, diff)
+        mock_diff.assert_not_called()
+
+    def test_diff_does_not_touch_last_updated(self):
+        before = self.fetch().last_updated
+        self.fetch().diff
+        self.assertEqual(self.fetch().last_updated, before)
+
+    def test_submission_change_invalidates_diff(self):
+        self.fetch().diff
+        self.submission.submission = "a\nb\nc\nd"
+        self.submission.save(update_fields=["submission"])
+
+        diff = self.fetch().diff
+        self.assertIn("+d", diff)
+        self.assertNotIn("+B", diff)
+
+    def test_template_change_invalidates_diff(self):
+        self.fetch().diff
+        self.template.content = "a\nB\nc"
+        self.template.save()
+
+        self.assertEqual(
+            [l for l in self.fetch().diff if l[0] in "+-" and l[1] not in "+-"],
+            [],
+        )
+
+    def test_diff_ops(self):
+        submission = self.fetch()
+        self.assertEqual(
+            submission.diff_ops, [["=", 0, 1], ["-", ["b"]], ["+", ["B"]], ["=", 2, 3]]
+        )
+
+    def test_rows_without_sections(self):
+        # rows from before sections were stored
+        AssignmentSubmission.objects.filter(pk=self.submission.pk).update(
+            submission_sections=[]
+        )
+        self.assertIn("+B", self.fetch().diff)
+        with patch("grader.models.section_opcodes") as mock_diff:
+            self.fetch().diff
+        mock_diff.assert_not_called()
+
+
+class TestSectionDiffs(TestCase):
+    def setUp(self):
+        user = User.objects.create_user(username="foo", password="bar")
+        course = CourseModel.objects.create(owner=user, name="c", api_course_id="c")
+        session = GradingSession.objects.create(
+            course=course, api_assignment_id="a", max_grade=10
+        )
+        template = TeacherTemplate.objects.create(
+            content="one\n===\nquestion 1\ntwo\n===\nquestion 2"
+        )
+        self.submission = AssignmentSubmission.objects.create(
+            assignment=session,
+            teacher_template=template,
+            api_student_profile_id="1",
+            api_student_submission_id="s1",
+            submission="one\n===\nquestion 1\nanswer 1\ntwo\n===\nquestion 2",
+        )
+
+    def test_only_changed_sections_are_diffed(self):
+        self.submission.diff
+        self.submission.submission += "\nanswer 2"
+        self.submission.save()
+
+        with patch(
+            "grader.diff.PatienceEngine.get_opcodes", autospec=True, return_value=[]
+        ) as mock_opcodes:
+            AssignmentSubmission.objects.get(pk=self.submission.pk).diff
+        # only section "two" changed
+        mock_opcodes.assert_called_once()
+        self.assertEqual(mock_opcodes.call_args.args[1][0], "two")
+
+    def test_section_diff(self):
+        self.assertEqual(
+            self.submission.section_diff("one")[2:],
+            ["@@ -1,3 +1,4 @@\n", " one", " ===", " question 1", "+answer 1"],
+        )
+        self.assertEqual(self.submission.section_diff("two"), [])
+        with self.assertRaises(KeyError):
+            self.submission.section_diff("three")
+
+
+class TestGradeStats(TestCase):
+    def setUp(self):
+        user = User.objects.create_user(username="foo", password="bar")
+        course = CourseModel.objects.create(owner=user, name="c", api_course_id="c")
+        self.session = GradingSession.objects.create(
+            course=course, api_assignment_id="a", max_grade=10
+        )
+        self.submissions = [
+            AssignmentSubmission.objects.create(
+                assignment=self.session,
+                api_student_profile_id=str(i),
+                api_student_submission_id=f"s{i}",
+                grade=grade,
+            )
+            for i, grade in enumerate([3, 7, 10, None])
+        ]
+
+    def assertStats(self, count, total, low, high):
+        session = GradingSession.objects.get(pk=self.session.pk)
+        self.assertEqual(
+            (
+                session.graded_count,
+                session.grade_sum,
+                session.grade_min,
+                session.grade_max,
+            ),
+            (count, total, low, high),
+        )
+        self.assertEqual(sum(session.grade_histogram), count)
+        return session
+
+    def test_stats_follow_grades(self):
+        session = self.assertStats(3, 20, 3, 10)
+        self.assertEqual(session.grade_histogram, [0, 0, 0, 1, 0, 0, 0, 1, 0, 1])
+        with self.assertNumQueries(0):
+            self.assertAlmostEqual(session.average_grade, 20 / 3)
+
+        ungraded = self.submissions[3]
+        ungraded.grade = 1
+        ungraded.save()
+        self.assertStats(4, 21, 1, 10)
+
+        # removing the maximum rescans the remaining grades
+        top = AssignmentSubmission.objects.get(pk=self.submissions[2].pk)
+        top.removed = True
+        top.save(update_fields=["removed"])
+        self.assertStats(3, 11, 1, 7)
+
+        middle = AssignmentSubmission.objects.get(pk=self.submissions[1].pk)
+        middle.grade = None
+        middle.save()
+        self.assertStats(2, 4, 1, 3)
+
+    def test_unchanged_grade_does_not_touch_session(self):
+        submission = AssignmentSubmission.objects.get(pk=self.submissions[0].pk)
+        submission.student_name = "someone"
+        with self.assertNumQueries(1):
+            submission.save(update_fields=["student_name"])
+
+    def test_recompute_matches_incremental(self):
+        GradingSession.objects.filter(pk=self.session.pk).update(
+            graded_count=0, grade_sum=0, grade_min=None, grade_max=None
+        )
+        self.session.recompute_grade_stats()
+        self.assertStats(3, 20, 3, 10)
+
+    def test_ungraded_session_has_no_average(self):
+        self.session.max_grade = 0
+        self.assertIsNone(self.session.average_grade)
+
+    def test_grade_version_follows_grade_changes(self):
+        submission = AssignmentSubmission.objects.get(pk=self.submissions[0].pk)
+        submission.student_name = "someone"
+        submission.save()
+        self.assertEqual(submission.grade_version, 0)
+
+        submission.grade = 4
+        submission.save(update_fields=["grade"])
+        submission.grade = 5
+        submission.save()
+        self.assertEqual(
+            AssignmentSubmission.objects.get(pk=submission.pk).grade_version, 2
+        )
@@ -0,0 +1,168 @@
+# Copyright (C) 2022 John DeVries
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Query budgets for the grader and extension endpoints. Each endpoint is
+requested for sessions of several class sizes, and must run the same number
+of queries for all of them; a query per student shows up as a failure here
+long before it shows up as a slow page."""
+
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+
+from ..models import AssignmentSubmission, CourseModel, GradingSession, TeacherTemplate
+
+
+CLASS_SIZES = (10, 100, 500)
+
+
+# full pages link to static files, which are not collected during tests
+@override_settings(
+    STATICFILES_STORAGE="django.contrib.staticfiles.storage.StaticFilesStorage"
+)
+class TestQueryCounts(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.classes = [cls.create_class(size) for size in CLASS_SIZES]
+
+    @staticmethod
+    def create_class(size: int) -> GradingSession:
+        """A session of `size` students whose content is up to date, so that
+        serving it makes no Google API calls."""
+        user = User.objects.create_user(username=f"teacher{size}", password="bar")
+        course = CourseModel.objects.create(
+            owner=user, name="c", api_course_id=f"c{size}"
+        )
+        template = TeacherTemplate.objects.create(content="doc\n===\nquestion")
+        session = GradingSession.objects.create(
+            course=course,
+            api_assignment_id=f"a{size}",
+            assignment_name="essay",
+            max_grade=10,
+            template=template,
+        )
+        AssignmentSubmission.objects.bulk_create(
+            [
+                AssignmentSubmission(
+                    assignment=session,
+                    teacher_template=template,
+                    api_student_profile_id=str(i),
+                    api_student_submission_id=f"s{i}",
+                    student_name=f"student {i}",
+                    _profile_photo_url="https://example.com/photo",
+                    submission=f"doc\n===\nquestion\nanswer {i}",
+                    grade=i % 11,
+                )
+                for i in range(size)
+            ]
+        )
+        session.recompute_grade_stats()
+        return session
+
+    def assertQueryBudget(self, budget: int, url: str, **headers):
+        """`url` is formatted with `session` and `submission` (the session's
+        first one) of each class, and must take `budget` queries to serve."""
+        for session in self.classes:
+            with self.subTest(students=session.submissions.count()):
+                self.client.force_login(session.course.owner)
+                formatted = url.format(
+                    session=session.pk, submission=session.submissions.first().pk
+                )
+                with self.assertNumQueries(budget):
+                    res = self.client.get(formatted, **headers)
+                self.assertEqual(res.status_code, 200)
+
+    def assertExtQueryBudget(self, budget: int, url: str):
+        self.assertQueryBudget(
+            budget, url, HTTP_ACCEPT="text/html", HTTP_HX_REQUEST="true"
+        )
+
+    def test_grader(self):
+        self.assertQueryBudget(2, "/grader/")
+
+    def test_resume_grading(self):
+        self.assertQueryBudget(7, "/grader/{session}/")
+
+    def test_user_selections(self):
+        self.client.force_login(self.classes[0].course.owner)
+        self.client.get("/grader/{}/".format(self.classes[0].pk))
+        with self.assertNumQueries(3):
+            self.client.get("/grader/user_selections/")
+
+    def test_session_detail(self):
+        self.assertQueryBudget(4, "/grader/session/{session}/")
+
+    def test_delete_session_form(self):
+        self.assertQueryBudget(3, "/grader/session/{session}/delete/")
+
+    def test_session_viewset(self):
+        self.assertQueryBudget(4, "/grader/session_viewset/")
+        self.assertQueryBudget(4, "/grader/session_viewset/{session}/")
+        self.assertQueryBudget(4, "/grader/session_viewset/{session}/clusters/")
+
+    def test_deep_session(self):
+        self.assertQueryBudget(4, "/grader/deep_session/")
+        self.assertQueryBudget(4, "/grader/deep_session/{session}/")
+
+    def test_session_lists_do_not_grow_with_sessions(self):
+        first = self.classes[0]
+        for i in range(5):
+            session = GradingSession.objects.create(
+                course=first.course,
+                api_assignment_id=f"extra{i}",
+                assignment_name="extra",
+                max_grade=10,
+            )
+            AssignmentSubmission.objects.bulk_create(
+                [
+                    AssignmentSubmission(
+                        assignment=session,
+                        api_student_profile_id=str(j),
+                        api_student_submission_id=f"extra{i}-{j}",
+                        grade=j,
+                    )
+                    for j in range(3)
+                ]
+            )
+        self.test_session_viewset()
+        self.test_deep_session()
+        self.test_ext_sessions_list()
+
+    def test_assignment_submission(self):
+        self.assertQueryBudget(3, "/grader/assignment_submission/")
+        self.assertQueryBudget(3, "/grader/assignment_submission/{submission}/")
+        self.assertQueryBudget(
+            3, "/grader/assignment_submission/{submission}/?stream=true"
+        )
+
+    def test_assignment_submission_diff(self):
+        # the diff is stored the first time it is served
+        self.assertQueryBudget(
+            4, "/grader/assignment_submission/{submission}/?diff=true"
+        )
+        self.assertQueryBudget(
+            3, "/grader/assignment_submission/{submission}/?diff=true"
+        )
+        self.assertQueryBudget(
+            3, "/grader/assignment_submission/{submission}/?diff=ops"
+        )
+
+    def test_teacher_template(self):
+        self.assertQueryBudget(3, "/grader/teacher_template/")
+
+    def test_ext_sessions_list(self):
+        self.assertExtQueryBudget(4, "/ext/session/")
+
+    def test_ext_session_detail(self):
+        self.assertExtQueryBudget(4, "/ext/session/{session}/")
@@ -13,14 +13,19 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import json
 from unittest.mock import MagicMock
 from unittest.mock import patch
 from django.core.exceptions import ValidationError
+from rest_framework.exceptions import NotFound, ParseError
 
 from django.test import TestCase
 
+from grader.common_lines import line_hash
+from grader.models import AssignmentSubmission
 from grader.serializers import (
     AssignmentSubmissionSerializer,
+    parse_line_range,
 )
 
 
@@ -40,6 +45,59 @@ class TestAssignmentSubmissionSerializer(TestCase):
         self.assertEqual(result["submission"], ["foo", "bar"])
         updater_mock.assert_called_once()
 
+    @patch("grader.serializers.update_submission")
+    def test_section_diff(self, _):
+        request = MagicMock(query_params={"diff": "true", "section": "doc"})
+        self.mock.section_diff.return_value = ["diff"]
+        instance = AssignmentSubmissionSerializer(context={"request": request})
+
+        result = instance.to_representation(self.mock)
+
+        self.assertEqual(result["submission"], ["diff"])
+        self.mock.section_diff.assert_called_once_with("doc")
+
+        self.mock.section_diff.side_effect = KeyError
+        with self.assertRaises(NotFound):
+            instance.to_representation(self.mock)
+
+    @patch("grader.serializers.update_submission")
+    def test_common_lines_are_flagged(self, _):
+        request = MagicMock(query_params={"diff": "true"})
+        self.mock.diff = ["--- a", "+++ b", "@@ -0,0 +1,2 @@", "+mine", "+copied"]
+        self.mock.assignment.common_line_hashes = [line_hash("copied")]
+        instance = AssignmentSubmissionSerializer(context={"request": request})
+
+        result = instance.to_representation(self.mock)
+
+        self.assertEqual(result["common_lines"], [4])
+
+    @patch("grader.serializers.update_submission")
+    def test_streaming_representation(self, _):
+        request = MagicMock(query_params={"lines": "1-3"})
+        submission = AssignmentSubmission(submission="a\nb\nc\nd")
+        instance = AssignmentSubmissionSerializer(context={"request": request})
+
+        result = json.loads("".join(instance.to_streaming_representation(submission)))
+
+        self.assertEqual(result["submission"], ["b", "c"])
+        self.assertEqual(result["lines"], [1, 3])
+        self.assertEqual(result["total_lines"], 4)
+
+    def test_parse_line_range(self):
+        for value, expected in (
+            (None, (0, 10)),
+            ("", (0, 10)),
+            ("2-5", (2, 5)),
+            ("2-", (2, 10)),
+            ("-5", (0, 5)),
+            ("5-500", (5, 10)),
+            ("50-60", (10, 10)),
+        ):
+            self.assertEqual(parse_line_range(value, total=10), expected)
+        for value in ("5", "a-b", "5-2", "1-2-3"):
+            with self.assertRaises(ParseError):
+                parse_line_range(value, total=10)
+
     def test_validate_submission_joins_lists(self):
         result = self.instance.validate_submission(["join", "lists"])
         self.assertEqual(result, "join\nlists")
@@ -0,0 +1,90 @@
+# Copyright (C) 2022 John DeVries
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import random
+from unittest import TestCase
+
+from ..similarity import (
+    band_keys,
+    cluster,
+    group_buckets,
+    minhash,
+    shingles,
+    similarity,
+)
+
+
+def essay(seed: int, length: int = 50) -> list[str]:
+    rng = random.Random(seed)
+    return [f"sentence {rng.randrange(10 ** 6)}" for _ in range(length)]
+
+
+class TestMinHash(TestCase):
+    def test_shingles(self):
+        self.assertEqual(
+            shingles(
+                ["  Foo   bar ", "foo bar", "", "question 1"], exclude={"question 1"}
+            ),
+            {"foo bar"},
+        )
+
+    def test_signatures_are_stable(self):
+        # signatures are stored, so they must not change between processes
+        items = {"a", "b", "c"}
+        self.assertEqual(minhash(items, num_perm=4), minhash(items, num_perm=4))
+        self.assertEqual(len(minhash(items, num_perm=128)), 128)  # type: ignore
+        self.assertIsNone(minhash(set(), num_perm=128))
+
+    def test_similarity_estimates_jaccard(self):
+        lines = essay(0, 200)
+        a = set(lines)
+        b = set(lines[:150]) | set(essay(1, 50))
+        jaccard = len(a & b) / len(a | b)
+        estimate = similarity(minhash(a, num_perm=256), minhash(b, num_perm=256))  # type: ignore
+        self.assertAlmostEqual(estimate, jaccard, delta=0.1)
+
+    def test_band_keys(self):
+        signature = minhash(set(essay(0)), num_perm=128)
+        keys = band_keys(signature, bands=16)  # type: ignore
+        self.assertEqual(len(keys), 16)
+        # changing one row only changes the key of its band
+        signature[0] += 1  # type: ignore
+        changed = band_keys(signature, bands=16)  # type: ignore
+        self.assertNotEqual(keys[0], changed[0])
+        self.assertEqual(keys[1:], changed[1:])
+
+
+class TestCluster(TestCase):
+    def test_group_buckets(self):
+        rows = [(0, 10, 1), (0, 10, 2), (1, 10, 3), (0, 11, 4), (1, 12, 1), (1, 12, 4)]
+        self.assertEqual(group_buckets(rows), [[1, 2], [1, 4]])
+
+    def test_cluster(self):
+        lines = essay(0)
+        original = set(lines)
+        copy = set(lines[:-2]) | {"a", "b"}
+        signatures = {
+            pk: minhash(lines, num_perm=128)
+            for pk, lines in {
+                1: original,
+                2: copy,
+                3: copy | {"c"},
+                4: set(essay(1)),
+                5: set(essay(2)),
+            }.items()
+        }
+        # 4 and 5 share a bucket, but are not similar
+        buckets = [[1, 2], [2, 3], [4, 5], [1, 3]]
+        self.assertEqual(cluster(buckets, signatures, threshold=0.8), [[1, 2, 3]])
@@ -14,9 +14,10 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 
+import json
 from unittest import TestCase
 
-from ..utils import normalize_protocol_url
+from ..utils import iter_lines, normalize_protocol_url, stream_json
 
 
 class TestNormalizeProtocolUrl(TestCase):
@@ -33,3 +34,18 @@ class TestNormalizeProtocolUrl(TestCase):
             ({"url": "ftp://foo.com/bar", "protocol": "https"}, "ftp://foo.com/bar"),
         ):
             self.assertEqual(normalize_protocol_url(**input_), output)  # type: ignore
+
+
+class TestIterLines(TestCase):
+    def test_matches_split(self):
+        for text in ("", "a", "a\nb", "\n\na\n", "\n"):
+            self.assertEqual(list(iter_lines(text)), text.split("\n"))
+
+
+class TestStreamJson(TestCase):
+    def test_stream_json(self):
+        for n in range(6):
+            chunks = list(stream_json({"a": 1, "b": "x"}, "b", range(n), chunk_size=2))
+            self.assertEqual(json.loads("".join(chunks)), {"a": 1, "b": list(range(n))})
+            # head, ceil(n / 2) chunks of items, and the closing brackets
+            self.assertEqual(len(chunks), 2 + (n + 1) // 2)
@@ -13,15 +13,175 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import json
 from unittest.mock import patch
 
 from django.contrib.auth.models import User
 from django.test import TestCase
 from django.urls.base import reverse
 
+from ..models import AssignmentSubmission, CourseModel, GradingSession, TeacherTemplate
 from ..services import CourseResource, CourseList
 
 
+class TestTeacherTemplateViewSet(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="foo", password="bar")
+        other = User.objects.create_user(username="other", password="bar")
+        self.template = self.create_template(self.user, "a\nb")
+        self.other_template = self.create_template(other, "c")
+        self.client.force_login(self.user)
+
+    def create_template(self, user, content) -> TeacherTemplate:
+        course = CourseModel.objects.create(
+            owner=user, name="c", api_course_id=user.username
+        )
+        session = GradingSession.objects.create(
+            course=course, api_assignment_id=user.username, max_grade=10
+        )
+        template = TeacherTemplate.objects.create(content=content)
+        AssignmentSubmission.objects.create(
+            assignment=session,
+            teacher_template=template,
+            api_student_profile_id="1",
+            api_student_submission_id=user.username,
+        )
+        return template
+
+    def test_retrieve(self):
+        response = self.client.get(
+            reverse("teacher_template-detail", args=[self.template.pk])
+        )
+        self.assertEqual(
+            response.json(),
+            {
+                "pk": self.template.pk,
+                "content_hash": self.template.get_content_hash(),
+                "lines": ["a", "b"],
+            },
+        )
+
+    def test_other_users_templates_are_hidden(self):
+        response = self.client.get(
+            reverse("teacher_template-detail", args=[self.other_template.pk])
+        )
+        self.assertEqual(response.status_code, 404)
+
+
+class TestGradingSessionViewSet(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="foo", password="bar")
+        self.client.force_login(self.user)
+        course = CourseModel.objects.create(
+            owner=self.user, name="c", api_course_id="c"
+        )
+        self.session = GradingSession.objects.create(
+            course=course, api_assignment_id="a", max_grade=10
+        )
+
+    @patch("grader.views.cluster_similar_submissions")
+    def test_clusters(self, mock):
+        submission = AssignmentSubmission(
+            pk=1, assignment=self.session, student_name="Jane"
+        )
+        mock.return_value = [[submission]]
+        url = reverse("session_viewset-clusters", args=[self.session.pk])
+
+        response = self.client.get(url)
+        self.assertEqual(
+            response.json(),
+            [[{"pk": 1, "session": self.session.pk, "student_name": "Jane"}]],
+        )
+        mock.assert_called_once_with(self.session, course_wide=False)
+
+        self.client.get(url, {"scope": "course"})
+        mock.assert_called_with(self.session, course_wide=True)
+
+    def test_bulk_grade_update(self):
+        submissions = [
+            AssignmentSubmission.objects.create(
+                assignment=self.session,
+                api_student_profile_id=str(i),
+                api_student_submission_id=f"s{i}",
+            )
+            for i in range(2)
+        ]
+        url = reverse("session_viewset-grades", args=[self.session.pk])
+        updates = [{"pk": s.pk, "grade": 10, "grade_version": 0} for s in submissions]
+
+        response = self.client.post(url, updates, content_type="application/json")
+        self.assertEqual(
+            response.json(),
+            {"grade_versions": [{"pk": s.pk, "grade_version": 1} for s in submissions]},
+        )
+
+        # sending the same grades again is a no-op, even with old versions
+        response = self.client.post(url, updates, content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+
+        # the versions sent are now out of date
+        for update in updates:
+            update["grade"] = 5
+        response = self.client.post(url, updates, content_type="application/json")
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(
+            response.json()["grade_versions"],
+            [{"pk": s.pk, "grade_version": 1} for s in submissions],
+        )
+
+        response = self.client.post(
+            url, updates[:1] * 2, content_type="application/json"
+        )
+        self.assertEqual(response.status_code, 400)
+
+
+class TestAssignmentSubmissionViewSet(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="foo", password="bar")
+        self.client.force_login(self.user)
+        course = CourseModel.objects.create(
+            owner=self.user, name="c", api_course_id="c"
+        )
+        session = GradingSession.objects.create(
+            course=course, api_assignment_id="a", max_grade=10
+        )
+        self.submission = AssignmentSubmission.objects.create(
+            assignment=session,
+            api_student_profile_id="1",
+            api_student_submission_id="s1",
+            submission="\n".join(f"line {i}" for i in range(5000)),
+        )
+        self.url = f"/grader/assignment_submission/{self.submission.pk}/"
+
+    @patch("grader.serializers.update_submission")
+    def test_stream_line_range(self, _):
+        response = self.client.get(self.url, {"lines": "1000-1003"})
+
+        self.assertTrue(response.streaming)
+        result = json.loads(b"".join(response.streaming_content))
+        self.assertEqual(result["submission"], ["line 1000", "line 1001", "line 1002"])
+        self.assertEqual(result["total_lines"], 5000)
+
+    @patch("grader.serializers.update_submission")
+    def test_stream_everything(self, _):
+        response = self.client.get(self.url, {"stream": "true"})
+
+        result = json.loads(b"".join(response.streaming_content))
+        self.assertEqual(len(result["submission"]), 5000)
+        self.assertEqual(result["lines"], [0, 5000])
+
+    @patch("grader.serializers.update_submission")
+    def test_bad_line_range(self, _):
+        response = self.client.get(self.url, {"lines": "10-5"})
+        self.assertEqual(response.status_code, 400)
+
+    @patch("grader.serializers.update_submission")
+    def test_no_streaming_by_default(self, _):
+        response = self.client.get(self.url)
+        self.assertFalse(response.streaming)
+        self.assertEqual(len(response.json()["submission"]), 5000)
+
+
 class TestChooseCourseView(TestCase):
     def setUp(self):
         self.user = User.objects.create_user(
@@ -29,6 +29,7 @@ from .views import (
     ChooseAssignmentView,
     GradingSessionViewSet,
     AssignmentSubmissionViewSet,
+    TeacherTemplateViewSet,
 )
 
 urlpatterns = [
@@ -53,4 +54,5 @@ router.register(r"session_viewset", GradingSessionViewSet, "session_viewset")
 router.register(
     r"deep_session", DeepAssignmentSubmissionViewSet, "deep_session_viewset"
 )
+router.register(r"teacher_template", TeacherTemplateViewSet, "teacher_template")
 urlpatterns += router.urls
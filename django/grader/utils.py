@@ -13,7 +13,9 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-from typing import Union
+import hashlib
+import json
+from typing import Iterable, Iterator, Union
 
 
 def normalize_protocol_url(*, url: Union[None, str], protocol: str = "https") -> str:
@@ -25,3 +27,46 @@ def normalize_protocol_url(*, url: Union[None, str], protocol: str = "https") ->
     if url and url.startswith("//"):
         return f"{protocol}:{url}"
     return url or ""
+
+
+def content_hash(content: str) -> str:
+    """Stable hash of a text field, for telling when it has changed without
+    comparing the whole thing."""
+    return hashlib.sha256(content.encode("utf8")).hexdigest()
+
+
+def iter_lines(text: str) -> Iterator[str]:
+    """Like `text.split("\\n")`, without building the whole list."""
+    start = 0
+    while (end := text.find("\n", start)) != -1:
+        yield text[start:end]
+        start = end + 1
+    yield text[start:]
+
+
+def stream_json(
+    obj: dict,
+    key: str,
+    items: Iterable,
+    *,
+    encoder: Union[type[json.JSONEncoder], None] = None,
+    chunk_size: int = 1000,
+) -> Iterator[str]:
+    """Render `obj` as JSON, with a list of `items` under `key`, in chunks of
+    `chunk_size` items, so that the whole list never has to be in memory."""
+    head = json.dumps(
+        {**{k: v for k, v in obj.items() if k != key}, key: []}, cls=encoder
+    )
+    # the list goes last: `head` ends with `[]}`
+    yield head[:-2]
+    separator = ""
+    chunk = []
+    for item in items:
+        chunk.append(json.dumps(item, cls=encoder))
+        if len(chunk) == chunk_size:
+            yield separator + ", ".join(chunk)
+            separator = ", "
+            chunk = []
+    if chunk:
+        yield separator + ", ".join(chunk)
+    yield "]}"
@@ -16,9 +16,14 @@
 import logging
 
 from django.contrib.auth.models import User
-from django.http.response import Http404
+from django.http.response import Http404, StreamingHttpResponse
 from django.contrib.auth.mixins import LoginRequiredMixin
-from grader.models import AssignmentSubmission, CourseModel, GradingSession
+from grader.models import (
+    AssignmentSubmission,
+    CourseModel,
+    GradingSession,
+    TeacherTemplate,
+)
 from django.contrib.auth.decorators import login_required
 from django.shortcuts import render, redirect
 from django.utils.decorators import method_decorator
@@ -26,23 +31,29 @@ from django.urls import reverse
 from django.views import View
 from django.views.defaults import bad_request, page_not_found
 
-from rest_framework.decorators import api_view, permission_classes
-from rest_framework.viewsets import ModelViewSet
+from rest_framework.decorators import action, api_view, permission_classes
+from rest_framework.viewsets import ModelViewSet, ReadOnlyModelViewSet
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
 from rest_framework import status
 
 from .services import (
     CourseResource,
+    GradeConflict,
+    cluster_similar_submissions,
     create_or_get_grading_session,
     list_all_class_names,
     list_all_assignment_names,
+    update_grades,
 )
 
 from .serializers import (
     AssignmentSubmissionSerializer,
+    ContentlessAssignmentSubmissionSerializer,
     DeepGradingSessionSerializer,
+    GradeUpdateSerializer,
     GradingSessionSerializer,
+    TeacherTemplateSerializer,
 )
 
 
@@ -129,7 +140,7 @@ def user_selections(request):
         return flush_selections(request)
 
     return Response(
-        {"selected_course": session.course.pk, "selected_assignment": session.pk}
+        {"selected_course": session.course_id, "selected_assignment": session.pk}
     )
 
 
@@ -408,7 +419,57 @@ class GradingSessionViewSet(ModelViewSet):
     serializer_class = GradingSessionSerializer
 
     def get_queryset(self):
-        return GradingSession.objects.filter(course__owner=self.request.user)
+        qs = GradingSession.objects.filter(course__owner=self.request.user)
+        if self.action in ("clusters", "grades"):
+            return qs
+        return qs.prefetch_active_submissions("pk")
+
+    @action(detail=True)
+    def clusters(self, request, pk=None):
+        """Clusters of near-identical submissions. Pass `scope=course` to
+        also look for matches in the other sessions in the course."""
+        clusters = cluster_similar_submissions(
+            self.get_object(),
+            course_wide=request.query_params.get("scope") == "course",
+        )
+        return Response(
+            [
+                [
+                    {
+                        "pk": s.pk,
+                        "session": s.assignment_id,  # type: ignore
+                        "student_name": s.student_name,
+                    }
+                    for s in c
+                ]
+                for c in clusters
+            ]
+        )
+
+    @action(detail=True, methods=["post"])
+    def grades(self, request, pk=None):
+        """Set the grades of many submissions at once, from a list of
+        `{pk, grade, grade_version}`. `grade_version` is the version the
+        client last saw; if any of them changed since, nothing is saved, and
+        the current versions are returned with a 409. Otherwise, the new
+        versions are returned."""
+        serializer = GradeUpdateSerializer(data=request.data, many=True)
+        serializer.is_valid(raise_exception=True)
+        try:
+            versions = update_grades(self.get_object(), serializer.validated_data)
+        except GradeConflict as e:
+            return Response(
+                {
+                    "message": "grades were changed by someone else",
+                    "grade_versions": to_version_list(e.versions),
+                },
+                status=status.HTTP_409_CONFLICT,
+            )
+        return Response({"grade_versions": to_version_list(versions)})
+
+
+def to_version_list(versions: dict[int, int]) -> list[dict]:
+    return [{"pk": pk, "grade_version": v} for pk, v in sorted(versions.items())]
 
 
 class DeepAssignmentSubmissionViewSet(ModelViewSet):
@@ -416,7 +477,11 @@ class DeepAssignmentSubmissionViewSet(ModelViewSet):
     serializer_class = DeepGradingSessionSerializer
 
     def get_queryset(self):
-        return GradingSession.objects.filter(course__owner=self.request.user)
+        return GradingSession.objects.filter(
+            course__owner=self.request.user
+        ).prefetch_active_submissions(
+            *ContentlessAssignmentSubmissionSerializer.model_fields
+        )
 
 
 class AssignmentSubmissionViewSet(ModelViewSet):
@@ -424,16 +489,51 @@ class AssignmentSubmissionViewSet(ModelViewSet):
     serializer_class = AssignmentSubmissionSerializer
 
     def get_queryset(self):
+        # everything the serializer's freshness check and diff touch
         return AssignmentSubmission.objects.filter(
             assignment__course__owner=self.request.user
+        ).select_related(
+            "assignment__course__owner",
+            "assignment__template",
+            "teacher_template__content_blob",
+            "submission_blob",
         )
 
+    def retrieve(self, request, *args, **kwargs):
+        """With `stream=true`, or a range of `lines=<start>-<stop>`, the
+        content is streamed, so that huge documents are never held in
+        memory as a whole response."""
+        params = request.query_params
+        if params.get("stream") != "true" and "lines" not in params:
+            return super().retrieve(request, *args, **kwargs)
+        serializer = self.get_serializer()
+        return StreamingHttpResponse(
+            serializer.to_streaming_representation(self.get_object()),
+            content_type="application/json",
+        )
+
+
+class TeacherTemplateViewSet(ReadOnlyModelViewSet):
+    permission_classes = [IsAuthenticated]
+    serializer_class = TeacherTemplateSerializer
+
+    def get_queryset(self):
+        return TeacherTemplate.objects.filter(
+            assignmentsubmission__assignment__course__owner=self.request.user
+        ).distinct()
+
+
+# the fields of each submission shown by grader/partials/session_detail.html
+SESSION_DETAIL_FIELDS = ("student_name", "_profile_photo_url", "grade")
+
 
 @login_required
 def session_detail(request, pk):
     """Traditional HTML view for showing the grades and comments inputted."""
     try:
-        obj = GradingSession.objects.get(pk=pk, course__owner=request.user)
+        obj = GradingSession.objects.prefetch_active_submissions(
+            *SESSION_DETAIL_FIELDS
+        ).get(pk=pk, course__owner=request.user)
     except GradingSession.DoesNotExist:
         raise Http404("session does not exist") from None
 
@@ -42,6 +42,8 @@ resource "random_password" "django_secret" {
   special = true
 }
 
+# the container's entrypoint (scripts/entrypoint_prod.sh) also runs the
+# background job worker, `manage.py run_worker`, next to the web server
 module "basic-deployment" {
   source  = "jdevries3133/basic-deployment/kubernetes"
   version = "0.1.2"
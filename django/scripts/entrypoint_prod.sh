@@ -2,6 +2,17 @@
 
 python3 manage.py migrate
 
+# the background job queue is drained from the same container as the web
+# server, restarting the worker if it ever exits. Workers claim jobs with
+# SKIP LOCKED, so every replica can run one
+(
+    while true;
+    do
+        python3 manage.py run_worker
+        sleep 5;
+    done
+) &
+
 exec gunicorn --access-logfile - \
     --workers 3 \
     --bind 0.0.0.0:8000 \